@@ -33,7 +33,11 @@ f.close ()
 
 setup \
     ( name             = "snxvpn"
-    , py_modules       = ['snxconnect', 'snxvpnversion']
+    , py_modules       = \
+        [ 'snxconnect', 'snxasync', 'snxbatch', 'snxclient', 'snxgateway'
+        , 'snxhold', 'snxhttp', 'snxlog', 'snxmetrics', 'snxotp', 'snxprobe'
+        , 'snxproto', 'snxsession', 'snxsupervise', 'snxtrace', 'snxvpnversion'
+        ]
     , version          = VERSION
     , description      =
         "Command-line utility to connect to a Checkpoint SSL VPN "
@@ -44,7 +48,8 @@ setup \
     , platforms        = 'Linux'
     , url              = "https://github.com/schlatterbeck/snxvpn"
     , scripts          = ['snxconnect']
-    , install_requires = [ 'beautifulsoup4', 'rsa', 'lxml' ]
+    , install_requires = [ 'rsa' ]
+    , extras_require   = dict (openssl = [ 'cryptography' ])
     , classifiers      = \
         [ 'Development Status :: 3 - Alpha'
         , 'License :: OSI Approved :: ' + license
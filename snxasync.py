@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+
+""" Asyncio-based login engine for snxconnect.
+    The Async_HTML_Requester has the same API as the HTML_Requester but
+    runs the requests that do not depend on each other concurrently
+    (the DNS lookups for portal and gateway are already started in the
+    background by the resolver of the HTML_Requester):
+    - With cookies the Portal/Main page and the extender page are
+      requested at the same time, the extender page is only used if the
+      portal accepted our cookies
+    - The RSA javascript is retrieved while the user is prompted for
+      username and password
+    Each stage has its own timeout (the --timeout option for requests,
+    --otp-timeout for the code of an OTP provider, only a prompt waits
+    for the user without a timeout) and is cancelled when it exceeds it
+    or when the user interrupts the login. Since urllib is blocking,
+    requests run in the default executor, everything else on the thread
+    of the event loop.
+"""
+
+from __future__ import print_function
+import io
+import asyncio
+from snxconnect import HTML_Requester, PW_Encode
+from snxhttp    import Page_Scraper
+
+class Stage_Timeout (Exception) :
+    pass
+# end class Stage_Timeout
+
+class Async_HTML_Requester (HTML_Requester) :
+    """ Login with the mock portal, first with the password and a
+        MultiChallenge code, then with the saved cookies:
+    >>> import os, shutil, tempfile
+    >>> from snxconnect import option_parser
+    >>> from snxmock    import Mock_Portal
+    >>> portal = Mock_Portal (mfa = '4711')
+    >>> portal.start ()
+    >>> d    = tempfile.mkdtemp ()
+    >>> host = '127.0.0.1:%d' % portal.port
+    >>> args = option_parser ({}).parse_args \\
+    ...     ( [ '-H', host, '-p', 'http', '-U', 'user', '-P', 'secret'
+    ...       , '-MC', '4711', '-s', '-c', os.path.join (d, 'cookies')
+    ...       ]
+    ...     )
+    >>> rq = Async_HTML_Requester (args)
+    >>> rq.quiet = True
+    >>> rq.login (), rq.login_path, len (rq.snx_info)
+    (True, 'password', 984)
+    >>> rq.close ()
+    >>> rq = Async_HTML_Requester (args)
+    >>> rq.quiet = True
+    >>> rq.login (), rq.login_path, len (rq.snx_info)
+    (True, 'cookie', 984)
+    >>> rq.close ()
+    >>> portal.shutdown ()
+    >>> portal.server_close ()
+    >>> shutil.rmtree (d)
+    """
+
+    def login (self) :
+        loop = asyncio.new_event_loop ()
+        task = loop.create_task (self.login_async ())
+        span = self.tracer.span \
+            ('login', host = self.args.host, engine = 'async')
+        try :
+            with span :
+                result = loop.run_until_complete (task)
+                span.set (path = self.login_path, ok = bool (result))
+                return result
+        except Stage_Timeout as err :
+            self.error ("Timeout in stage %s, cannot login" % err)
+        except KeyboardInterrupt :
+            task.cancel ()
+            loop.run_until_complete (asyncio.gather (task, return_exceptions = True))
+            raise
+        finally :
+            loop.close ()
+    # end def login
+
+    async def stage (self, name, func, *args, timeout = True) :
+        """ Run blocking func in the executor, timeout=None is used for
+            stages waiting for user input. Only fetches (and waiting for
+            the user or the OTP provider) run in the executor, they do
+            not modify the requester: their results are applied here on
+            the loop thread. So a stage that timed out cannot change our
+            state when its thread finally returns.
+        """
+        self.debug ("stage: %s" % name)
+        loop = asyncio.get_event_loop ()
+        fut  = loop.run_in_executor (None, func, *args)
+        if timeout is True :
+            timeout = self.args.timeout
+        try :
+            return await asyncio.wait_for (fut, timeout)
+        except asyncio.TimeoutError :
+            raise Stage_Timeout (name)
+    # end def stage
+
+    def fetch_body (self, filepart = None, data = None, headers = None) :
+        """ Fetch without parsing and read the body in the executor,
+            so reading it is covered by the timeout of the stage.
+        """
+        response   = self.fetch (filepart, data, False, headers)
+        response.f = io.BytesIO (response.f.read ())
+        return response
+    # end def fetch_body
+
+    async def login_async (self) :
+        if self.has_cookies and await self.login_with_cookies_async () :
+            self.login_path = 'cookie'
+            return True
+        return await self.login_with_password_async ()
+    # end def login_async
+
+    async def login_with_cookies_async (self) :
+        self.debug ("has cookie")
+        self.nextfile = 'Portal/Main'
+        main, extender = await asyncio.gather \
+            ( self.stage ('Portal/Main', self.fetch, 'Portal/Main')
+            , self.stage
+                ( 'extender', self.fetch, 'sslvpn/SNX/extender'
+                , None, True, None, Page_Scraper.has_extender
+                )
+            )
+        self.use (main)
+        self.debug (self.purl)
+        if self.purl.endswith ('Portal/Main') :
+            self.use (extender)
+            if not self.parse_extender () :
+                return False
+            return await self.generate_snx_info_async ()
+        self.forget_cookies ()
+        return False
+    # end def login_with_cookies_async
+
+    async def login_with_password_async (self) :
+        start = self.nextfile
+        entry = await self.cached_login_params_async ()
+        self.login_path = 'password' if entry is None else 'cached'
+        if entry is None :
+            if not await self.get_login_params_async () :
+                return
+        else :
+            self.args.username, self.args.password = await self.stage \
+                ('credentials', self.ask_credentials, timeout = None)
+        enc = PW_Encode (modulus = self.modulus, exponent = self.exponent)
+        self.use (await self.stage \
+            ('login', self.fetch, None, self.credentials_form (enc)))
+        self.debug (self.purl)
+        self.debug (self.info)
+        if entry is not None and not self.accepted () :
+            error = self.page.error
+            self.invalidate_login_params (start)
+            if not await self.get_login_params_async () :
+                return
+            if not self.check_login_params (entry, error) :
+                return
+            self.login_path = 'password'
+            enc = PW_Encode (modulus = self.modulus, exponent = self.exponent)
+            self.use (await self.stage \
+                ('login', self.fetch, None, self.credentials_form (enc)))
+        if not await self.answer_challenges_async (enc) :
+            return
+        return await self.activate_async ()
+    # end def login_with_password_async
+
+    async def cached_login_params_async (self) :
+        """ Like cached_login_params, only the validation of an expired
+            entry needs the portal.
+        """
+        from snxhttp import HTTPError
+        entry, headers = self.lookup_login_params ()
+        if headers :
+            try :
+                response = await self.stage \
+                    ( 'rsa cache', self.fetch_body
+                    , entry ['script'], None, headers
+                    )
+            except HTTPError as err :
+                if err.code != 304 :
+                    raise
+                response = None
+            entry = self.validate_login_params (entry, response)
+        return self.use_login_params (entry)
+    # end def cached_login_params_async
+
+    async def get_login_params_async (self) :
+        """ Like get_login_params but prompts for the credentials while
+            the RSA javascript is retrieved.
+        """
+        self.debug (self.nextfile)
+        self.use (await self.stage
+            ( 'login page', self.fetch
+            , None, None, True, None, Page_Scraper.has_login_params
+            ))
+        self.debug (self.purl)
+        if not self.find_rsa_script () :
+            return False
+        script = self.nextfile
+        rsa, credentials = await asyncio.gather \
+            ( self.stage ('rsa script', self.fetch_body)
+            , self.stage
+                ('credentials', self.ask_credentials, timeout = None)
+            )
+        self.args.username, self.args.password = credentials
+        self.use (rsa)
+        self.parse_rsa_params ()
+        if not self.modulus :
+            # Error message already given in parse_rsa_params
+            return False
+        self.find_login_form ()
+        self.cache_login_params (script)
+        return True
+    # end def get_login_params_async
+
+    async def answer_challenges_async (self, enc) :
+        """ Like answer_challenges, the provider has --otp-timeout for
+            a code (a prompt waits for the user).
+        """
+        from snxotp import OTP_Error, Prompt_Provider
+        otp = self.otp_provider ()
+        if not otp :
+            return True
+        timeout = None
+        if not isinstance (otp, Prompt_Provider) :
+            timeout = self.args.otp_timeout + 1
+        attempt = 0
+        while 'MultiChallenge' in self.purl :
+            try :
+                with self.tracer.span ('otp', attempt = attempt) :
+                    self.otp_code = await self.stage \
+                        ( 'otp', otp.code, attempt, self.args.otp_timeout
+                        , timeout = timeout
+                        )
+            except OTP_Error as err :
+                self.error ("MultiChallenge: %s" % err)
+                return False
+            self.use (await self.stage \
+                ('challenge', self.fetch, None, self.challenge_form (enc)))
+            self.debug ("info: %s" % self.info)
+            if self.check_error () :
+                attempt += 1
+                if not self.retry_challenge (otp, attempt) :
+                    return False
+                # Get the challenge form again unless the error page has it
+                if not self.page.form (name = 'MCForm') :
+                    self.use (await self.stage ('challenge form', self.fetch))
+        return True
+    # end def answer_challenges_async
+
+    async def activate_async (self) :
+        """ Like activate """
+        if self.purl.endswith ('Login/ActivateLogin') :
+            self.save_cookies ()
+            self.debug ("purl: %s" % self.purl)
+            self.use (await self.stage \
+                ('activate', self.fetch, self.activate_url))
+
+        if self.check_error () :
+            return
+
+        if self.purl.endswith ('Portal/Main') :
+            self.save_cookies ()
+            self.debug ("purl: %s" % self.purl)
+            self.use (await self.stage
+                ( 'extender', self.fetch, 'sslvpn/SNX/extender'
+                , None, True, None, Page_Scraper.has_extender
+                ))
+            self.debug (self.purl)
+            self.debug (self.info)
+            if not self.parse_extender () :
+                return False
+            return await self.generate_snx_info_async ()
+        else :
+            self.check_error ()
+            self.error ("Unexpected response, try again.")
+            self.debug ("purl: %s" % self.purl)
+            return
+    # end def activate_async
+
+    async def generate_snx_info_async (self) :
+        """ Resolve the gateway in the executor, then generate_snx_info
+        """
+        gw_host = self.gateway_host ()
+        gw_ip   = await self.stage ('resolve', self.resolve, gw_host)
+        self.generate_snx_info (gw_ip)
+        return True
+    # end def generate_snx_info_async
+
+# end class Async_HTML_Requester
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+
+""" Batch login health-check: Log in with many profiles in parallel up
+    to retrieving the extender parameters, snx is not called. The
+    profile file contains one profile per line:
+        host [realm [username [password]]]
+    Missing fields are taken from the options, a missing password is
+    looked up in netrc. Empty lines and lines starting with '#' are
+    ignored. For each profile a JSON line with the result and the
+    latency of each request is printed. MultiChallenge is answered only
+    with an OTP provider (-MC is ignored), the workers share it.
+"""
+
+from __future__        import print_function, unicode_literals
+import sys
+import copy
+import json
+import time
+import threading
+try :
+    from Queue import Queue, Empty
+except ImportError :
+    from queue import Queue, Empty
+
+def read_profiles (args) :
+    """ Return list of args for each profile
+    >>> import tempfile
+    >>> class Args (object) :
+    ...     realm = 'ssl_vpn'
+    ...     username = 'default'
+    ...     password = None
+    >>> with tempfile.NamedTemporaryFile ('w', suffix = 'prof') as f :
+    ...     n = f.write ('# comment\\n\\nvpn1 r1 user1 pw\\nvpn2\\n')
+    ...     f.flush ()
+    ...     args = Args ()
+    ...     args.batch = f.name
+    ...     p = read_profiles (args)
+    >>> [(a.host, a.realm, a.username, a.password) for a in p]
+    [('vpn1', 'r1', 'user1', 'pw'), ('vpn2', 'ssl_vpn', 'default', None)]
+    """
+    profiles = []
+    with open (args.batch, 'r') as f :
+        for line in f :
+            line = line.strip ()
+            if not line or line.startswith ('#') :
+                continue
+            fields   = line.split ()
+            defaults = [args.realm, args.username, args.password]
+            fields   = fields + defaults [len (fields) - 1:]
+            a = copy.copy (args)
+            a.host, a.realm, a.username, a.password = fields [:4]
+            profiles.append (a)
+    return profiles
+# end def read_profiles
+
+def check_profile (requester, args, tracer = None, otp = None) :
+    """ Login with one profile, returns the report as a dict. The OTP
+        provider otp is shared with the other workers.
+    """
+    from netrc import netrc, NetrcParseError
+    # Each profile has its own cookie jar, nothing is saved
+    args.cookiefile       = None
+    args.session_store    = None
+    args.save_cookies     = False
+    args.multi_challenge  = False
+    args.warm_reconnect   = False
+    report = dict (host = args.host, realm = args.realm, user = args.username)
+    if not args.password :
+        try :
+            a = netrc ().authenticators (args.host)
+        except (IOError, NetrcParseError) :
+            a = None
+        if a :
+            args.password = a [2]
+    if not args.username or not args.password :
+        report.update (ok = False, error = 'No username or password')
+        return report
+    start = time.time ()
+    rq = None
+    try :
+        rq = requester (args, tracer)
+        rq.quiet = True
+        rq.otp   = otp
+        ok = bool (rq.login ())
+        report.update (ok = ok, error = '; '.join (rq.errors) or None)
+        if not ok and not rq.errors :
+            report ['error'] = 'Login failed'
+    except Exception as err :
+        report.update (ok = False, error = '%s: %s' % (type (err).__name__, err))
+    report ['total'] = round (time.time () - start, 4)
+    if rq :
+        report ['stages'] = [(n, round (t, 4)) for n, t in rq.timings]
+        rq.close ()
+    return report
+# end def check_profile
+
+def run_batch (args, requester) :
+    """ Check all profiles with a pool of args.workers threads, return
+        the number of failed profiles.
+    """
+    from snxtrace import open_tracer
+    from snxotp   import make_provider, Shared_Provider
+    profiles = read_profiles (args)
+    tracer   = open_tracer (args.trace)
+    provider = otp = None
+    if args.otp_provider :
+        provider = make_provider (args.otp_provider)
+        otp      = Shared_Provider (provider)
+    queue    = Queue ()
+    lock     = threading.Lock ()
+    failed   = []
+    for p in profiles :
+        queue.put (p)
+    def worker () :
+        while True :
+            try :
+                p = queue.get_nowait ()
+            except Empty :
+                return
+            report = check_profile (requester, p, tracer, otp)
+            with lock :
+                if not report ['ok'] :
+                    failed.append (report)
+                print (json.dumps (report, sort_keys = True))
+                sys.stdout.flush ()
+    threads = []
+    for i in range (min (args.workers, len (profiles))) :
+        t = threading.Thread (target = worker)
+        t.daemon = True
+        t.start ()
+        threads.append (t)
+    for t in threads :
+        t.join ()
+    if hasattr (provider, 'close') :
+        provider.close ()
+    tracer.close ()
+    return len (failed)
+# end def run_batch
@@ -0,0 +1,387 @@
+#!/usr/bin/python3
+
+""" Benchmarks for snxconnect, call with --help for the list of
+    benchmarks. These are not installed, they are intended to be run
+    from a source checkout.
+"""
+
+from __future__        import print_function, unicode_literals
+import os
+import sys
+import json
+import time
+import resource
+import tempfile
+import threading
+import tracemalloc
+import subprocess
+from argparse          import ArgumentParser
+try :
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError :
+    from http.server    import HTTPServer, BaseHTTPRequestHandler
+
+here = os.path.dirname (os.path.abspath (__file__))
+
+# Synthetic pages resembling the portal pages, the padding stands in for
+# the inline javascript and i18n tables of the real pages. Use --pages
+# to benchmark with pages captured from a real portal.
+padding = ''.join \
+    ( '<script>var msg%d = "%s";</script>\n' % (i, 'x' * 200)
+      for i in range (200)
+    )
+pages = dict \
+    ( login =
+        ( '<html><head><script src="/sslvpn/js/RSA.js"></script>\n'
+          '</head><body><form id="loginForm" action="/sslvpn/Login/Login"'
+          ' method="post"><input name="userName"><input type="password"'
+          ' name="password"></form>\n%s</body></html>' % padding
+        )
+    , extender =
+        ( '<html><head><script>\n/* Extender.user_name = "u";'
+          ' Extender.password = "pw"; Extender.host_name = "gw";'
+          ' Extender.port = "443"; */\n</script></head><body>%s'
+          '</body></html>' % padding
+        )
+    , error =
+        ( '<html><body>%s<span class="errorMessage">Access denied</span>'
+          '</body></html>' % padding
+        )
+    )
+
+def measure (func, count) :
+    """ Return CPU seconds per call and peak memory in bytes """
+    func ()
+    t = time.process_time ()
+    for i in range (count) :
+        func ()
+    t = (time.process_time () - t) / count
+    tracemalloc.start ()
+    func ()
+    peak = tracemalloc.get_traced_memory () [1]
+    tracemalloc.stop ()
+    return t, peak
+# end def measure
+
+def bench_parse (args) :
+    """ Compare the streaming Page_Scraper with a full BeautifulSoup
+        parse, both produce the data used by the requester.
+    """
+    from snxhttp import Page_Scraper
+    try :
+        from bs4 import BeautifulSoup
+    except ImportError :
+        BeautifulSoup = None
+    todo = dict (pages)
+    if args.pages :
+        todo = {}
+        for fn in sorted (os.listdir (args.pages)) :
+            with open (os.path.join (args.pages, fn), 'rb') as f :
+                todo [fn] = f.read ().decode ('utf-8', 'replace')
+    for name, page in sorted (todo.items ()) :
+        until = None
+        if 'extender' in name :
+            until = Page_Scraper.has_extender
+        elif 'login' in name :
+            until = Page_Scraper.has_login_params
+        def scrape () :
+            p = Page_Scraper (until)
+            for i in range (0, len (page), 8192) :
+                p.feed (page [i:i+8192])
+                if p.done :
+                    break
+            p.close ()
+            return p.scripts, p.forms, p.error
+        def soup () :
+            s = BeautifulSoup (page, 'lxml')
+            return s.find_all ('script'), s.find_all ('form'), \
+                s.select_one ('.errorMessage')
+        print ("%s (%d bytes)" % (name, len (page)))
+        candidates = [('scraper', scrape)]
+        if BeautifulSoup :
+            candidates.append (('bs4+lxml', soup))
+        for label, func in candidates :
+            t, peak = measure (func, args.count)
+            print ("  %-10s %8.3f ms %10d bytes peak" % (label, t * 1e3, peak))
+# end def bench_parse
+
+def bench_crypto (args) :
+    """ Compare the backends for the password encryption
+    """
+    import rsa
+    from snxconnect import PW_Encode
+    pub, priv = rsa.newkeys (args.bits)
+    for b in PW_Encode.backends :
+        if not b.available () :
+            print ("%-12s not available" % b.name)
+            continue
+        key = lambda: b (pub.n, pub.e)
+        t, peak = measure (key, args.count)
+        print ("%-12s key     %8.3f ms" % (b.name, t * 1e3))
+        enc = PW_Encode (pub.n, pub.e, backend = b.name)
+        t, peak = measure (lambda: enc.encrypt ('secret'), args.count)
+        print ("%-12s encrypt %8.3f ms" % (b.name, t * 1e3))
+# end def bench_crypto
+
+def median (values) :
+    values = sorted (values)
+    return values [len (values) // 2]
+# end def median
+
+class First_Request_Handler (BaseHTTPRequestHandler) :
+    """ Record the arrival of the first request and give up """
+
+    def do_GET (self) :
+        self.server.arrival = time.time ()
+        self.send_response (503)
+        self.send_header ('Content-Length', '0')
+        self.end_headers ()
+    # end def do_GET
+
+    def log_message (self, *args) :
+        pass
+    # end def log_message
+
+# end class First_Request_Handler
+
+def bench_startup (args) :
+    """ Measure import time and time to first request of the entry points
+    """
+    env = dict (os.environ, HOME = tempfile.mkdtemp ())
+    env ['PYTHONPATH'] = here
+    py  = sys.executable
+    entry_points = dict \
+        ( script = [py, os.path.join (here, 'snxconnect')]
+        , main   = [py, '-c', 'import snxconnect; snxconnect.main ()']
+        )
+    code = 'import time; t = time.time (); import snxconnect; ' \
+           'print (time.time () - t)'
+    times = []
+    for i in range (args.count) :
+        out = subprocess.check_output ([py, '-c', code], env = env)
+        times.append (float (out))
+    print ("import snxconnect: %8.1f ms" % (median (times) * 1e3))
+    server = HTTPServer (('127.0.0.1', 0), First_Request_Handler)
+    port   = server.server_address [1]
+    t = threading.Thread (target = server.serve_forever)
+    t.daemon = True
+    t.start ()
+    fail = False
+    for name, cmd in sorted (entry_points.items ()) :
+        for opts in (['--version'], ['--help']) :
+            times = []
+            for i in range (args.count) :
+                start = time.time ()
+                subprocess.check_output (cmd + opts, env = env)
+                times.append (time.time () - start)
+            print \
+                ( "%-6s %-9s %8.1f ms"
+                % (name, opts [0], median (times) * 1e3)
+                )
+        times  = []
+        failed = 0
+        opts   = \
+            [ '-H', '127.0.0.1:%d' % port, '-p', 'http', '-U', 'user'
+            , '-P', 'secret', '-c', os.path.join (env ['HOME'], 'cookies')
+            ]
+        for i in range (args.count) :
+            server.arrival = None
+            start = time.time ()
+            subprocess.call \
+                ( cmd + opts, env = env
+                , stdout = subprocess.PIPE, stderr = subprocess.PIPE
+                )
+            if server.arrival is None :
+                failed += 1
+                continue
+            times.append (server.arrival - start)
+        if failed :
+            print \
+                ( "%-6s no request in %d of %d runs"
+                % (name, failed, args.count)
+                )
+            fail = True
+        if not times :
+            continue
+        ttfr = median (times) * 1e3
+        print ("%-6s first request %4.1f ms" % (name, ttfr))
+        if args.budget and ttfr > args.budget :
+            print ("  over budget of %.1f ms" % args.budget)
+            fail = True
+    server.shutdown ()
+    if fail :
+        sys.exit (1)
+# end def bench_startup
+
+def login_once () :
+    """ Run in a child process by bench_login: Login with the options
+        from the command line and call snx, print a JSON line with the
+        timings.
+    """
+    from snxconnect import option_parser, HTML_Requester
+    start  = time.time ()
+    args   = option_parser ().parse_args ()
+    rq     = HTML_Requester (args)
+    ok     = rq.login ()
+    stages = list (rq.timings)
+    if ok :
+        t  = time.time ()
+        ok = rq.call_snx ()
+        stages.append (('snx', time.time () - t))
+    result = dict (ok = bool (ok), total = time.time () - start, stages = stages)
+    print (json.dumps (result))
+# end def login_once
+
+def bench_login (args) :
+    """ End-to-end login against the mock portal and fake snx
+    """
+    from snxmock import Mock_Portal
+    portal = Mock_Portal \
+        ( latency      = args.latency
+        , page_size    = args.page_size
+        , failure_rate = args.failure_rate
+        )
+    portal.start ()
+    home    = tempfile.mkdtemp ()
+    cookies = os.path.join (home, 'cookies')
+    snx     = os.path.join (home, 'snx')
+    with open (snx, 'w') as f :
+        f.write \
+            ( '#!/bin/sh\nexec "%s" "%s" "$@"\n'
+            % (sys.executable, os.path.join (here, 'snxmock.py'))
+            )
+    os.chmod (snx, 0o755)
+    env  = dict (os.environ, HOME = home, PYTHONPATH = here)
+    opts = \
+        [ '-H', '127.0.0.1:%d' % portal.port, '-p', 'http'
+        , '-U', 'user', '-P', 'secret', '-S', snx, '-c', cookies, '-s'
+        ]
+    code = 'import snxbench; snxbench.login_once ()'
+    for path in ('full', 'cookie') :
+        runs = []
+        for i in range (args.count) :
+            if path == 'full' and os.path.exists (cookies) :
+                os.unlink (cookies)
+            start = time.time ()
+            ru    = resource.getrusage (resource.RUSAGE_CHILDREN)
+            p = subprocess.Popen \
+                ( [sys.executable, '-c', code] + opts
+                , env = env, stdout = subprocess.PIPE
+                )
+            try :
+                out = p.communicate (timeout = args.timeout) [0]
+            except subprocess.TimeoutExpired :
+                p.kill ()
+                out = b''
+                p.communicate ()
+                print ("%s path: run %d timed out" % (path, i + 1))
+            wall = time.time () - start
+            # The child is reaped by communicate, its usage is the
+            # difference of the usage of all waited-for children
+            after = resource.getrusage (resource.RUSAGE_CHILDREN)
+            out   = out.decode ('utf-8').strip ()
+            try :
+                r = json.loads (out.split ('\n') [-1])
+            except (ValueError, IndexError) :
+                r = dict (ok = False, stages = [], total = 0)
+            r.update \
+                ( wall = wall
+                , cpu  = after.ru_utime + after.ru_stime
+                       - ru.ru_utime - ru.ru_stime
+                , rss  = after.ru_maxrss
+                )
+            runs.append (r)
+        ok = [r for r in runs if r ['ok']]
+        print ("%s path: %d of %d ok" % (path, len (ok), len (runs)))
+        if not ok :
+            continue
+        stages = {}
+        # The same URL may be requested more than once during a login
+        # (e.g., GET and POST of the login form), keep them apart
+        for r in ok :
+            for n, (name, t) in enumerate (r ['stages']) :
+                stages.setdefault ('%d %s' % (n + 1, name), []).append (t)
+        for k in ('total', 'wall', 'cpu') :
+            stages [k] = [r [k] for r in ok]
+        for name in stages :
+            print ("  %-30s %8.1f ms" % (name, median (stages [name]) * 1e3))
+        print ("  %-30s %8d kB" % ('peak rss', max (r ['rss'] for r in ok)))
+    portal.shutdown ()
+# end def bench_login
+
+def main () :
+    cmd = ArgumentParser ()
+    cmd.add_argument \
+        ( '-n', '--count'
+        , help    = 'Number of iterations, default=%(default)s'
+        , type    = int
+        , default = 100
+        )
+    sub = cmd.add_subparsers (dest = 'benchmark')
+    p = sub.add_parser ('parse', help = bench_parse.__doc__.split ('\n') [0])
+    p.add_argument \
+        ( '--pages'
+        , help    = 'Directory with captured portal pages, the file name'
+                    ' should contain "login" or "extender" for the'
+                    ' respective pages'
+        )
+    p.set_defaults (func = bench_parse)
+    p = sub.add_parser \
+        ('startup', help = bench_startup.__doc__.split ('\n') [0])
+    p.add_argument \
+        ( '--budget'
+        , help    = 'Fail if time to first request exceeds this many'
+                    ' milliseconds (or a run makes no request),'
+                    ' default=%(default)s'
+        , type    = float
+        , default = 100
+        )
+    p.set_defaults (func = bench_startup)
+    p = sub.add_parser \
+        ('login', help = bench_login.__doc__.split ('\n') [0])
+    p.add_argument \
+        ( '-l', '--latency'
+        , help    = 'Delay of the portal for each request in seconds,'
+                    ' default=%(default)s'
+        , type    = float
+        , default = 0.02
+        )
+    p.add_argument \
+        ( '-t', '--timeout'
+        , help    = 'Seconds until a login run is killed and counted as'
+                    ' failed, default=%(default)s'
+        , type    = float
+        , default = 60
+        )
+    p.add_argument \
+        ( '-s', '--page-size'
+        , help    = 'Padding added to each portal page, default=%(default)s'
+        , type    = int
+        , default = 50000
+        )
+    p.add_argument \
+        ( '-f', '--failure-rate'
+        , help    = 'Fraction of failed portal requests,'
+                    ' default=%(default)s'
+        , type    = float
+        , default = 0
+        )
+    p.set_defaults (func = bench_login)
+    p = sub.add_parser \
+        ('crypto', help = bench_crypto.__doc__.split ('\n') [0])
+    p.add_argument \
+        ( '-b', '--bits'
+        , help    = 'Size of the RSA key, default=%(default)s'
+        , type    = int
+        , default = 2048
+        )
+    p.set_defaults (func = bench_crypto)
+    args = cmd.parse_args ()
+    if not args.benchmark :
+        cmd.print_help ()
+        sys.exit (1)
+    args.func (args)
+# end def main
+
+if __name__ == '__main__' :
+    main ()
@@ -0,0 +1,246 @@
+#!/usr/bin/python
+
+""" Library API for using snxconnect from a long-running python process
+    instead of the command line, e.g.:
+
+    from snxclient import Config, Session, Session_Error
+    config = Config (host = 'vpn.example.com', username = 'user'
+                    , password = 'secret', keepalive = 300)
+    with Session (config) as session :
+        session.connect ()
+        while not session.wait (timeout = 60) :
+            pass # do something else, snx is still connected
+
+    Each Session has its own cookie jar, connection pool, tracer and
+    metrics, nothing is shared between sessions via global state.
+    Nothing is printed and there is no interaction: Errors are raised
+    as Session_Error (or a subclass), missing credentials are a
+    Config_Error instead of a prompt. Debug messages go to the loggers
+    snxconnect.<subsystem> (see snxlog) with credentials redacted. Note that there is only one snx
+    per host (it listens on a fixed port), so only one session can be
+    connected at a time, any number of sessions may log in.
+"""
+
+from __future__        import print_function, unicode_literals
+try :
+    from httplib import HTTPException
+except ImportError :
+    from http.client import HTTPException
+
+class Session_Error (Exception) :
+    pass
+# end class Session_Error
+
+class Config_Error (Session_Error, ValueError) :
+    pass
+# end class Config_Error
+
+class Login_Error (Session_Error) :
+    pass
+# end class Login_Error
+
+class Connect_Error (Session_Error) :
+    pass
+# end class Connect_Error
+
+class Config (object) :
+    """ Options of a Session, the names are those of the command line
+        options (with '_' instead of '-') and the defaults are the same
+        except that nothing is read from ~/.snxvpnrc or netrc and that
+        cookies, snx info and gateway history are not stored in files
+        unless configured.
+    >>> c = Config (host = 'vpn.example.com', username = 'user')
+    >>> c.host, c.realm, c.timeout, c.cookiefile, c.save_cookies
+    ('vpn.example.com', 'ssl_vpn', 10.0, None, False)
+    >>> try :
+    ...     Config (hots = 'vpn.example.com')
+    ... except Config_Error as err :
+    ...     print (err)
+    unknown option: hots
+    >>> try :
+    ...     c.password = 'secret'
+    ...     c.save_cookies = True
+    ...     c.check ()
+    ... except Config_Error as err :
+    ...     print (err)
+    save_cookies needs cookiefile or session_store
+    """
+
+    def __init__ (self, **options) :
+        from snxconnect import option_parser
+        defaults = vars (option_parser ({}).parse_args ([]))
+        defaults.update \
+            (cookiefile = None, snx_info_file = None, gateway_history = None)
+        unknown = sorted (set (options) - set (defaults))
+        if unknown :
+            raise Config_Error ("unknown option: %s" % ', '.join (unknown))
+        self.__dict__.update (defaults)
+        self.__dict__.update (options)
+    # end def __init__
+
+    def check (self) :
+        """ Raise Config_Error if the options cannot work without
+            interaction.
+        """
+        if not self.host :
+            raise Config_Error ("host is required")
+        if not self.username or not self.password :
+            raise Config_Error ("username and password are required")
+        if self.multi_challenge is True and not self.otp_provider :
+            raise Config_Error \
+                ("multi_challenge must be the code or use otp_provider")
+        if self.hold == 'exec' :
+            raise Config_Error ("hold exec is not possible in a library")
+        if self.otp_provider :
+            from snxotp import parse_provider
+            try :
+                parse_provider (self.otp_provider)
+            except ValueError as err :
+                raise Config_Error (str (err))
+        if self.save_cookies and not (self.cookiefile or self.session_store) :
+            raise Config_Error \
+                ("save_cookies needs cookiefile or session_store")
+        if self.warm_reconnect and not \
+            (self.snx_info_file or self.session_store) :
+            raise Config_Error \
+                ("warm_reconnect needs snx_info_file or session_store")
+    # end def check
+
+# end class Config
+
+class Session (object) :
+    """ Login to the portal and connection via snx for one profile:
+        login retrieves the snx parameters, connect starts snx (and
+        logs in first if necessary), wait blocks until snx terminates,
+        close terminates snx and releases all resources. A tracer may
+        be shared by several sessions. Keepalive and metrics (if
+        configured) run while waiting.
+    """
+
+    def __init__ (self, config, tracer = None) :
+        config.check ()
+        if config.async_login :
+            from snxasync import Async_HTML_Requester as requester
+        else :
+            from snxconnect import HTML_Requester as requester
+        self.config    = config
+        self.rq        = requester (config, tracer)
+        self.rq.quiet  = True
+        self.sock      = None
+        self.logged_in = False
+    # end def __init__
+
+    def __enter__ (self) :
+        return self
+    # end def __enter__
+
+    def __exit__ (self, tp, value, tb) :
+        self.close ()
+    # end def __exit__
+
+    @property
+    def connected (self) :
+        return self.sock is not None
+    # end def connected
+
+    @property
+    def drop_cause (self) :
+        """ Why snx was terminated by us (e.g. 'tunnel degraded') """
+        return self.rq.drop_cause
+    # end def drop_cause
+
+    def close (self) :
+        """ Disconnect and release connections and files """
+        try :
+            self.disconnect ()
+        finally :
+            self.rq.close ()
+    # end def close
+
+    def connect (self) :
+        """ Start snx with the parameters of the last login, with warm
+            reconnect the saved snx info is tried first. Logs in if
+            necessary. If snx does not accept the parameters the next
+            connect logs in again. With hold lean the login state is
+            released when snx is connected.
+        """
+        rq = self.rq
+        if self.sock :
+            raise Connect_Error ("already connected")
+        if not self.logged_in :
+            if self.config.warm_reconnect and rq.load_snx_info () :
+                self.sock = self.start_snx ()
+                if not self.sock :
+                    rq.forget_snx_info ()
+            if not self.sock :
+                self.login ()
+        if not self.sock :
+            self.sock = self.start_snx ()
+            if not self.sock :
+                self.logged_in = False
+                raise Connect_Error (self.last_error ('snx did not connect'))
+        if self.config.hold == 'lean' :
+            rq.release_login_state ()
+    # end def connect
+
+    def disconnect (self) :
+        """ Terminate snx (with 'snx -d') if we are connected """
+        rq = self.rq
+        if not self.sock :
+            return
+        del rq.errors [:]
+        try :
+            rq.reap_snx ()
+            if not rq.wait_snx (self.sock, 1) :
+                self.sock.close ()
+        finally :
+            self.sock = None
+    # end def disconnect
+
+    def last_error (self, default) :
+        if self.rq.errors :
+            return self.rq.errors [-1]
+        return default
+    # end def last_error
+
+    def login (self) :
+        """ Log in to the portal (with the cookies of an earlier login
+            if possible) and retrieve the parameters for snx.
+        """
+        rq = self.rq
+        rq.nextfile = self.config.file
+        del rq.errors [:]
+        try :
+            ok = rq.login ()
+        except (EnvironmentError, HTTPException) as err :
+            raise Login_Error (str (err))
+        if not ok :
+            raise Login_Error (self.last_error ('login failed'))
+        # The session cookies are in our jar now
+        rq.has_cookies = True
+        if self.config.warm_reconnect :
+            rq.save_snx_info ()
+        self.logged_in = True
+    # end def login
+
+    def start_snx (self) :
+        del self.rq.errors [:]
+        try :
+            return self.rq.start_snx ()
+        except EnvironmentError as err :
+            raise Connect_Error (str (err))
+    # end def start_snx
+
+    def wait (self, timeout = None) :
+        """ Wait until snx terminates (return True) or at most timeout
+            seconds (return False).
+        """
+        if not self.sock :
+            raise Connect_Error ("not connected")
+        if self.rq.wait_snx (self.sock, timeout) :
+            self.sock = None
+            return True
+        return False
+    # end def wait
+
+# end class Session
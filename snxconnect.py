@@ -4,38 +4,25 @@ from __future__        import print_function, unicode_literals
 import os
 import os.path
 import sys
-import socket
-import ssl
-import rsa
-try :
-    from urllib2 import build_opener, HTTPCookieProcessor, Request
-    from urllib  import urlencode
-    from httplib import IncompleteRead
-except ImportError :
-    from urllib.request import build_opener, HTTPCookieProcessor, Request
-    from urllib.parse   import urlencode
-    from http.client    import IncompleteRead
-try :
-    from cookielib import LWPCookieJar
-except ImportError :
-    from http.cookiejar import LWPCookieJar
-from bs4               import BeautifulSoup
-from getpass           import getpass
+import time
 from argparse          import ArgumentParser
-from netrc             import netrc, NetrcParseError
-from struct            import pack, unpack
-from subprocess        import Popen, PIPE
+from struct            import unpack
+from binascii          import hexlify
 from snxvpnversion     import VERSION
 
+# Levels of the logging module, it is imported only when logging
+DEBUG, INFO, ERROR = 10, 20, 40
+
 """ Todo:
-    - timeout can be retrieved at /sslvpn/Portal/LoggedIn
-      Function to do this is RetrieveTimeoutVal (url_above) in portal
+    - The timeout retrieved at /sslvpn/Portal/LoggedIn (function
+      RetrieveTimeoutVal (url_above) in portal) is used by --keepalive.
       This seems to be in seconds. But my portal always displays
-      "nNextTimeout = 6;" content-type is text/javascript.
+      "nNextTimeout = 6;" content-type is text/javascript. So we only
+      use it to shorten the configured keepalive interval if it is
+      plausible as seconds (at least a minute).
     - We may want to get the RSA parameters from the javascript in the
       received html, RSA pubkey will probably be different for different
       deployments.
-    - Log debug logs to syslog
 """
 
 if sys.version_info >= (3,) :
@@ -69,37 +56,300 @@ def iterbytes (x) :
         yield (x [i:i+1])
 # end def iterbytes
 
+
+def ssl_context (skip_cert = False) :
+    import ssl
+    try:
+        if skip_cert:
+            return ssl._create_unverified_context ()
+        return ssl.create_default_context ()
+    except AttributeError:
+        # Legacy Python that doesn't verify HTTPS certificates by default
+        return None
+# end def ssl_context
+
+def write_private (filename, text) :
+    """ Write text to a file only readable by the user, we write to a
+        temporary file and rename for atomic update. Each writer has
+        its own temporary file, so concurrent writers (threads or
+        processes) do not interfere, the last rename wins.
+    >>> import tempfile, shutil, threading
+    >>> d  = tempfile.mkdtemp ()
+    >>> fn = os.path.join (d, 'cache')
+    >>> def write (i) :
+    ...     write_private (fn, str (i) * 1000)
+    >>> ts = [threading.Thread (target = write, args = (i,)) for i in range (8)]
+    >>> for t in ts :
+    ...     t.start ()
+    >>> for t in ts :
+    ...     t.join ()
+    >>> text = open (fn).read ()
+    >>> len (text), len (set (text)), os.listdir (d)
+    (1000, 1, ['cache'])
+    >>> oct (os.stat (fn).st_mode & 0o777)
+    '0o600'
+    >>> shutil.rmtree (d)
+    """
+    import tempfile
+    fd, tmp = tempfile.mkstemp \
+        (dir = os.path.dirname (filename) or '.', prefix = '.tmp')
+    try :
+        with os.fdopen (fd, 'w') as f :
+            f.write (text)
+        # os.replace is python3 only, rename replaces on POSIX, too
+        getattr (os, 'replace', os.rename) (tmp, filename)
+    except BaseException :
+        os.unlink (tmp)
+        raise
+# end def write_private
+
+class RSA_Cache (object) :
+    """ On-disk cache of the RSA parameters, the URL of the RSA
+        javascript and the action of the login form by host and realm.
+        The cache is a JSON file only readable by the user.
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp ()
+    >>> c = RSA_Cache (os.path.join (d, 'cache'), ttl = 60)
+    >>> c.put ('vpn.example.com', 'ssl_vpn', modulus = 'c3', exponent = '3')
+    >>> c = RSA_Cache (os.path.join (d, 'cache'), ttl = 60)
+    >>> c.get ('vpn.example.com', 'ssl_vpn') ['modulus']
+    'c3'
+    >>> c.is_fresh (c.get ('vpn.example.com', 'ssl_vpn'))
+    True
+    >>> c.invalidate ('vpn.example.com', 'ssl_vpn')
+    >>> print (c.get ('vpn.example.com', 'ssl_vpn'))
+    None
+    """
+
+    def __init__ (self, filename, ttl) :
+        self.filename = filename
+        self.ttl      = ttl
+        self.entries  = {}
+        import json
+        try :
+            with open (filename, 'r') as f :
+                self.entries = json.load (f)
+        except (IOError, OSError, ValueError) :
+            pass
+    # end def __init__
+
+    def get (self, host, realm) :
+        return self.entries.get (self.key (host, realm))
+    # end def get
+
+    def invalidate (self, host, realm) :
+        self.entries.pop (self.key (host, realm), None)
+        self.save ()
+    # end def invalidate
+
+    def is_fresh (self, entry) :
+        return time.time () - entry ['time'] < self.ttl
+    # end def is_fresh
+
+    def key (self, host, realm) :
+        return ' '.join ((host, realm))
+    # end def key
+
+    def put (self, host, realm, **entry) :
+        entry ['time'] = time.time ()
+        self.entries [self.key (host, realm)] = entry
+        self.save ()
+    # end def put
+
+    def save (self) :
+        import json
+        write_private (self.filename, json.dumps (self.entries))
+    # end def save
+
+# end class RSA_Cache
+
 class HTML_Requester (object) :
 
-    def __init__ (self, args) :
+    chunksize = 8192
+    # Shorter session timeouts of the portal are not plausible seconds
+    min_portal_timeout = 60
+    # Extender variables needed for the connection info of snx
+    extender_keys = \
+        ( 'host_name', 'port', 'server_cn', 'user_name', 'password'
+        , 'server_fingerprint'
+        )
+    activate_url = \
+        ( 'sslvpn/Login/ActivateLogin?ActivateLogin=activate'
+          '&LangSelect=en_US&submit=Continue&HeightData='
+        )
+
+    def __init__ (self, args, tracer = None, resolver = None) :
+        """ The tracer may be shared by several requesters, by default
+            it is opened from args.trace. A resolver passed in (e.g.,
+            the one used for probing the gateways) keeps its cache.
+        """
+        from snxhttp import LWPCookieJar, Connection_Pool, Keepalive_Handler
+        from snxhttp import build_opener, HTTPCookieProcessor, make_resolver
+        from snxhttp import split_host
+        from snxtrace import open_tracer
+        from snxlog   import Redactor
+        import socket
         self.modulus     = None
         self.exponent    = None
         self.args        = args
+        self.redactor    = Redactor (self.secrets)
+        self.metrics     = None
+        self.own_tracer  = tracer is None
+        if tracer is None and (args.metrics_listen or args.metrics_file) :
+            from snxmetrics import Metrics, Metrics_Tracer
+            self.metrics = Metrics ()
+            f = open (args.trace, 'a') if args.trace else None
+            tracer = Metrics_Tracer (self.metrics, f)
+        self.tracer      = tracer or open_tracer (args.trace)
+        if resolver :
+            # Further lookups are traced with the login
+            resolver.tracer = self.tracer
+        self.resolver    = resolver or make_resolver (args, self.tracer)
+        # Start lookup of portal and (most likely) gateway right away
+        host = split_host (args.host) [0]
+        self.resolver.prefetch (host)
+        self.resolver.prefetch (host, socket.AF_INET)
+        self.listeners   = []
+        self.errors      = []
+        self.timings     = []
+        self.transfers   = []
+        self.quiet       = False
+        self.timers      = []
+        self.keepalive_scheduled = False
+        if self.metrics and args.metrics_listen :
+            from snxmetrics import Metrics_Server
+            try :
+                srv = Metrics_Server \
+                    (args.metrics_listen, self.metrics, self.listeners)
+                self.listeners.append (srv)
+            except socket.error as err :
+                self.error \
+                    ( "Cannot serve metrics on %s: %s"
+                    % (args.metrics_listen, err)
+                    , 'metrics'
+                    )
+        if self.metrics and args.metrics_file :
+            self.add_timer (args.metrics_interval, self.metrics_timer)
+        self.prober      = None
+        self.drop_cause  = None
+        if args.probe :
+            from snxprobe import Prober
+            self.prober = Prober (self)
         self.jar         = j = LWPCookieJar ()
 
-        if self.args.skip_cert:
-            try:
-                _create_unverified_https_context = ssl._create_unverified_context
-            except AttributeError:
-                # Legacy Python that doesn't verify HTTPS certificates by default
-                pass
-            else:
-                # Handle target environment that doesn't support HTTPS verification
-                ssl._create_default_https_context = _create_unverified_https_context
-
         self.has_cookies = False
-        if self.args.cookiefile :
+        self.store       = None
+        self.profile     = (args.host, args.realm, args.username or '')
+        if self.args.session_store :
+            from snxsession import Session_Store
+            self.store = Session_Store \
+                (self.args.session_store, self.args.session_ttl)
+            self.has_cookies = self.store.load_cookies (self.profile, j)
+        elif self.args.cookiefile :
             self.has_cookies = True
             try :
                 j.load (self.args.cookiefile, ignore_discard = True)
             except IOError :
                 self.has_cookies = False
-        self.opener   = build_opener (HTTPCookieProcessor (j))
+        self.rsa_cache = None
+        if self.args.rsa_cache :
+            self.rsa_cache = RSA_Cache \
+                (self.args.rsa_cache, self.args.rsa_cache_ttl)
+        self.pool     = Connection_Pool \
+            (self.make_context, self.resolver, self.tracer)
+        self.opener   = build_opener \
+            (HTTPCookieProcessor (j), Keepalive_Handler (self.pool))
         self.nextfile = args.file
+        self.otp      = None
+        self.otp_code = None
+        self.login_path = 'password'
+        self.connect_error = None
 
     # end def __init__
 
-    def call_snx (self) :
+    def close (self) :
+        """ Release connections, listeners and files of the requester,
+            a tracer passed in by the caller is not closed.
+        """
+        for l in list (self.listeners) :
+            l.close ()
+        del self.listeners [:]
+        del self.timers [:]
+        self.keepalive_scheduled = False
+        self.pool.close ()
+        if hasattr (self.otp, 'close') :
+            self.otp.close ()
+            self.otp = None
+        if self.store :
+            self.store.close ()
+        if self.own_tracer :
+            self.tracer.close ()
+    # end def close
+
+    def connect_snx (self) :
+        """ Log in and start snx, return the control socket or None,
+            connect_error then tells why (login failed or snx rejected
+            connection). With --warm-reconnect the saved snx info is
+            tried first, if snx rejects it, it is forgotten and we log
+            in to the portal.
+            Here the fake snx of snxmock rejects a broken snx info:
+        >>> import shutil, tempfile
+        >>> from snxmock import Mock_Portal
+        >>> portal = Mock_Portal ()
+        >>> portal.start ()
+        >>> here = os.path.dirname (os.path.abspath (__file__))
+        >>> d    = tempfile.mkdtemp ()
+        >>> snx  = os.path.join (d, 'snx')
+        >>> with open (snx, 'w') as f :
+        ...     n = f.write ('#!/bin/sh\\nexec "%s" "%s" "$@"\\n'
+        ...         % (sys.executable, os.path.join (here, 'snxmock.py')))
+        >>> os.chmod (snx, 0o755)
+        >>> os.environ ['SNXMOCK_LOG'] = os.path.join (d, 'log')
+        >>> args = option_parser ({}).parse_args \\
+        ...     ( [ '-H', '127.0.0.1:%d' % portal.port, '-p', 'http'
+        ...       , '-U', 'user', '-P', 'secret', '-S', snx, '--snx-reap'
+        ...       , '-c', os.path.join (d, 'cookies'), '--warm-reconnect'
+        ...       , '--snx-info-file', os.path.join (d, 'info')
+        ...       ]
+        ...     )
+        >>> rq = HTML_Requester (args)
+        >>> rq.quiet = True
+        >>> rq.snx_info = b'\\0' * 984
+        >>> rq.save_snx_info ()
+        >>> sock = rq.connect_snx ()
+        >>> rq.login_path, rq.wait_snx (sock)
+        ('password', True)
+        >>> with open (os.environ.pop ('SNXMOCK_LOG')) as f :
+        ...     print (f.read ().strip ())
+        bad magic 0000
+        ok
+        >>> rq.close ()
+        >>> rq = HTML_Requester (args)
+        >>> rq.load_snx_info ()
+        True
+        >>> rq.close ()
+        >>> portal.shutdown ()
+        >>> portal.server_close ()
+        >>> shutil.rmtree (d)
+        """
+        self.connect_error = None
+        if self.args.warm_reconnect and self.load_snx_info () :
+            sock = self.start_snx ()
+            if sock :
+                return sock
+            self.forget_snx_info ()
+        if not self.login () :
+            self.connect_error = 'login failed'
+            return None
+        if self.args.warm_reconnect :
+            self.save_snx_info ()
+        sock = self.start_snx ()
+        if not sock :
+            self.connect_error = 'snx rejected connection'
+        return sock
+    # end def connect_snx
+
+    def call_snx (self, sock = None) :
         """ The snx binary usually lives in the default snxpath and is
             setuid root. We call it with the undocumented '-Z' option.
             When everything is well it forks a subprocess and exists
@@ -110,159 +360,904 @@ class HTML_Requester (object) :
             and waits for us to pass the binary-encoded parameters via
             this socket. It later sends back an answer. It seems to keep
             the socket open, so we do another read to wait for snx to
-            terminate.
+            terminate. The control socket sock is passed if snx was
+            already started, e.g., by connect_snx.
+            Returns False if snx did not accept the connection info.
         """
+        sock = sock or self.start_snx ()
+        if not sock :
+            return False
+        self.notice \
+            ("SNX connected, to leave VPN open, leave this running!", 'snx')
+        if self.args.hold == 'exec' :
+            self.exec_watcher (sock)
+        elif self.args.hold == 'lean' :
+            self.release_login_state ()
+        self.wait_snx (sock)
+        return True
+    # end def call_snx
+
+    def exec_watcher (self, sock) :
+        """ Replace the process by the minimal watcher of snxhold
+            (--hold exec), after releasing connections and files and
+            writing the log. Only returns if the exec fails, we then
+            hold the tunnel in this process.
+        """
+        from snxhold import exec_watcher, rss_kb
+        from snxlog  import stop_logging
+        rss = rss_kb ()
+        self.debug ("exec watcher, RSS %s kB" % rss, 'snx', rss_kb = rss)
+        self.close ()
+        stop_logging ()
+        try :
+            exec_watcher (sock, self.args)
+        except OSError as err :
+            print ("Cannot exec watcher: %s" % err, file = sys.stderr)
+    # end def exec_watcher
+
+    def release_login_state (self) :
+        """ Drop what is only needed during a login after the handoff to
+            snx (--hold lean): The last page and response, the extender
+            and RSA parameters, the statistics of the requests and, if
+            there is no keepalive, the idle connections. A keepalive or
+            a new login retrieves everything again. The freed memory is
+            given back to the OS and the RSS before and after is logged.
+        """
+        from snxhold import rss_kb, trim_memory
+        before = rss_kb ()
+        self.f = self.page = self.info = self.extender_vars = None
+        self.modulus = self.exponent = None
+        del self.timings [:]
+        del self.transfers [:]
+        if not self.args.keepalive :
+            self.pool.close ()
+        trim_memory ()
+        after = rss_kb ()
+        self.notice \
+            ( "Released login state: RSS %s kB before, %s kB after"
+            % (before, after)
+            , 'snx'
+            , rss_before_kb = before, rss_after_kb = after
+            )
+    # end def release_login_state
+
+    def start_snx (self) :
+        """ Start snx and pass it the connection info. Returns the
+            socket or None if snx is not listening or closes the socket
+            without an answer (which happens for stale credentials) or
+            does not answer within the timeout.
+        """
+        import socket
+        from subprocess import Popen, PIPE
+        from snxproto   import read_answer
         sp  = self.args.snxpath
-        snx = Popen ([sp, '-Z'], stdin = PIPE, stdout = PIPE, stderr = PIPE)
-        stdout, stderr = snx.communicate ('')
-        rc = snx.returncode
+        self.drop_cause = None
+        if not self.clear_snx_port () :
+            return None
+        with self.tracer.span ('snx.spawn', path = sp) as span :
+            snx = Popen \
+                ([sp, '-Z'], stdin = PIPE, stdout = PIPE, stderr = PIPE)
+            stdout, stderr = snx.communicate (b'')
+            rc = snx.returncode
+            span.set (returncode = rc)
         if rc != 0 :
-            print ("SNX terminated with error: %d %s%s" % (rc, stdout, stderr))
-        sock = socket.socket (socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect (("127.0.0.1", 7776))
-        sock.sendall (self.snx_info)
-        answer = sock.recv (4096)
-        if self.args.debug :
-            f = open ('snxanswer', 'wb')
-            f.write (answer)
-            f.close ()
-        print ("SNX connected, to leave VPN open, leave this running!")
-        answer = sock.recv (4096) # should block until snx dies
-    # end def call_snx
+            self.error \
+                ( "SNX terminated with error: %d %s%s" % (rc, stdout, stderr)
+                , 'snx'
+                )
+        sock = self.snx_ready ()
+        if not sock :
+            return None
+        try :
+            with self.tracer.span ('snx.handshake') as span :
+                sock.sendall (self.snx_info)
+                answer = read_answer (sock, self.args.snx_timeout or None)
+                if answer :
+                    span.set \
+                        ( answer = len (answer.payload)
+                        , framed = answer.framed
+                        , status = answer.status
+                        )
+        except socket.error as err :
+            self.error ("SNX connection failed: %s" % err, 'snx')
+            sock.close ()
+            return None
+        if not answer :
+            self.error ("SNX closed the connection or did not answer", 'snx')
+            sock.close ()
+            return None
+        self.debug \
+            ( "snx answer: %r" % answer, 'snx'
+            , framed = answer.framed, status = answer.status
+            )
+        return sock
+    # end def start_snx
+
+    def clear_snx_port (self) :
+        """ Make sure no snx is listening, we don't want to pass the
+            credentials to an snx we didn't start. A running snx is
+            terminated with --snx-reap. Return False if the port is in
+            use.
+        """
+        from snxproto import listening_inodes
+        if not listening_inodes () :
+            return True
+        if not self.args.snx_reap :
+            self.error \
+                ( "Port 7776 is in use, probably by a stale snx,"
+                  " use --snx-reap to terminate it"
+                , 'snx'
+                )
+            return False
+        return self.reap_snx ()
+    # end def clear_snx_port
+
+    def reap_snx (self) :
+        """ Terminate a running snx with 'snx -d' and wait until the
+            port is free. Return False if this fails.
+        """
+        from subprocess import Popen, PIPE
+        from snxproto   import listening_inodes
+        with self.tracer.span ('snx.reap') :
+            self.debug ("terminating stale snx", 'snx')
+            snx = Popen \
+                ( [self.args.snxpath, '-d']
+                , stdin = PIPE, stdout = PIPE, stderr = PIPE
+                )
+            snx.communicate (b'')
+            end = time.time () + self.args.snx_ready_timeout
+            while listening_inodes () :
+                if time.time () >= end :
+                    self.error ("Stale snx did not terminate", 'snx')
+                    return False
+                time.sleep (0.05)
+        return True
+    # end def reap_snx
+
+    def snx_ready (self) :
+        """ Wait until the snx we just started listens on its port and
+            return the connected socket or None. The daemon is forked
+            by snx, it may not be listening when snx returns. We poll
+            with increasing intervals (5ms up to 50ms) for at most
+            --snx-ready-timeout seconds. Since we made sure that no snx
+            was listening before, a listener is the snx we started.
+            Without /proc we retry the connect instead.
+        """
+        import socket
+        from snxproto   import listening_inodes
+        with self.tracer.span ('snx.ready') as span :
+            start = time.time ()
+            end   = start + self.args.snx_ready_timeout
+            delay = 0.005
+            polls = 0
+            while True :
+                polls += 1
+                if listening_inodes () != set () :
+                    sock = socket.socket (socket.AF_INET, socket.SOCK_STREAM)
+                    try :
+                        sock.connect (("127.0.0.1", 7776))
+                        break
+                    except socket.error as err :
+                        sock.close ()
+                        if time.time () >= end :
+                            self.error \
+                                ("SNX connection failed: %s" % err, 'snx')
+                            return None
+                elif time.time () >= end :
+                    self.error \
+                        ( "SNX not listening after %s seconds"
+                        % self.args.snx_ready_timeout
+                        , 'snx'
+                        )
+                    return None
+                time.sleep (delay)
+                delay = min (delay * 2, 0.05)
+            span.set (polls = polls)
+        ms = (time.time () - start) * 1e3
+        self.debug \
+            ( "snx ready after %.1f ms, %d polls" % (ms, polls), 'snx'
+            , ready_ms = round (ms, 1), polls = polls
+            )
+        return sock
+    # end def snx_ready
+
+    def wait_snx (self, sock, duration = None) :
+        """ Block until snx dies and closes the control socket or for
+            at most duration seconds. The socket is closed when snx
+            terminated. Returns True if snx terminated.
+        """
+        if self.args.keepalive and not self.keepalive_scheduled :
+            self.keepalive_scheduled = True
+            self.add_timer (self.args.keepalive, self.keepalive)
+        if self.metrics and self.metrics.since is None :
+            self.metrics.tunnel (True)
+            self.write_metrics ()
+        if self.prober and not self.prober.active and not self.drop_cause :
+            self.prober.start ()
+        if not self.serve (sock, duration) :
+            return False
+        sock.close ()
+        if self.prober :
+            self.prober.stop ()
+        if self.metrics :
+            self.metrics.tunnel (False)
+            self.write_metrics ()
+        return True
+    # end def wait_snx
+
+    def keepalive (self) :
+        """ Timer keeping the portal session alive while snx runs: We
+            request Portal/LoggedIn, which returns the session timeout
+            (nNextTimeout), and refresh the extender parameters. So a
+            restart of snx (with the cookies or the saved snx info) does
+            not need a new login. The next keepalive is scheduled after
+            --keepalive seconds or 80% of the timeout if this is
+            shorter. The unit of the timeout is not known (see Todo),
+            a timeout below min_portal_timeout is ignored. If the
+            session has expired we stop.
+        """
+        import re
+        from snxhttp import HTTPException, Page_Scraper
+        interval = self.args.keepalive
+        with self.tracer.span ('keepalive') as span :
+            try :
+                r = self.fetch ('sslvpn/Portal/LoggedIn', do_parse = False)
+                body = r.f.read ().decode ('utf-8', 'replace')
+                if 'Portal/LoggedIn' not in r.purl :
+                    self.error \
+                        ("Portal session expired, keepalive stopped", 'keepalive')
+                    self.keepalive_scheduled = False
+                    span.set (expired = True)
+                    return
+                m = re.search (r'nNextTimeout\s*=\s*(\d+)', body)
+                if m and int (m.group (1)) >= self.min_portal_timeout :
+                    interval = min (interval, 0.8 * int (m.group (1)))
+                self.open \
+                    ('sslvpn/SNX/extender', until = Page_Scraper.has_extender)
+                # Keep the snx parameters we have if the portal did not
+                # send new ones, e.g. the session expired meanwhile
+                if self.parse_extender () :
+                    self.generate_snx_info ()
+                    self.save_cookies ()
+                    if self.args.warm_reconnect :
+                        self.save_snx_info ()
+                    self.debug \
+                        ( "keepalive ok, next in %.0f seconds" % interval
+                        , 'keepalive', interval = interval
+                        )
+                else :
+                    span.set (extender = False)
+            except (EnvironmentError, HTTPException) as err :
+                self.error ("Keepalive failed: %s" % err, 'keepalive')
+            span.set (interval = interval)
+        self.add_timer (interval, self.keepalive)
+    # end def keepalive
 
-    def debug (self, s) :
-        if self.args.debug :
-            print (s)
+    def tunnel_degraded (self, reason) :
+        """ Called by the prober when the tunnel is degraded: We
+            terminate snx, so wait_snx returns and the supervisor
+            reconnects.
+        """
+        self.error \
+            ("Tunnel degraded (%s), restarting snx" % reason, 'probe')
+        self.drop_cause = 'tunnel degraded'
+        self.reap_snx ()
+    # end def tunnel_degraded
+
+    def metrics_timer (self) :
+        self.write_metrics ()
+        self.add_timer (self.args.metrics_interval, self.metrics_timer)
+    # end def metrics_timer
+
+    def write_metrics (self) :
+        """ Write the metrics file if configured """
+        from snxmetrics import write_textfile
+        if not self.args.metrics_file :
+            return
+        try :
+            write_textfile (self.args.metrics_file, self.metrics)
+        except (IOError, OSError) as err :
+            self.error ("Cannot write metrics: %s" % err, 'metrics')
+    # end def write_metrics
+
+    def add_timer (self, delay, callback) :
+        self.timers.append ((time.time () + delay, callback))
+    # end def add_timer
+
+    def serve (self, sock = None, duration = None) :
+        """ Wait until snx closes the control socket sock or for
+            duration seconds. Meanwhile we serve the listeners (objects
+            with fileno and handle methods, e.g., the status socket of
+            the supervisor, listeners with a true writing attribute are
+            also handled when they become writable) and run timers that
+            are due.
+            Returns True if the socket was closed.
+        """
+        import select
+        end = None
+        if duration is not None :
+            end = time.time () + duration
+        while True :
+            now = time.time ()
+            for t in sorted (self.timers, key = lambda x: x [0]) :
+                if t [0] <= now :
+                    self.timers.remove (t)
+                    t [1] ()
+            if end is not None and now >= end :
+                return False
+            times = [t [0] for t in self.timers]
+            if end is not None :
+                times.append (end)
+            timeout = None
+            if times :
+                timeout = max (0, min (times) - time.time ())
+            rd = list (self.listeners)
+            wr = [l for l in rd if getattr (l, 'writing', False)]
+            if sock :
+                rd.append (sock)
+            r, w, x = select.select (rd, wr, [], timeout)
+            if sock in r :
+                if not sock.recv (4096) :
+                    return True
+            # A listener may be ready for reading and writing, it is
+            # handled once. It may close itself or others.
+            for l in r + [l for l in w if l not in r] :
+                if l is not sock and l in self.listeners :
+                    l.handle ()
+    # end def serve
+
+    def load_snx_info (self) :
+        """ Load the connection info for snx saved by a previous login
+            with warm reconnect enabled. Returns True if a valid, not
+            expired, entry for our host was found.
+        """
+        import json
+        if self.store :
+            entry = self.store.load_snx_info (self.profile)
+            if not entry :
+                return False
+            host, self.snx_info = entry
+            self.debug ("Using saved snx info", 'snx')
+            return True
+        try :
+            with open (self.args.snx_info_file, 'r') as f :
+                d = json.load (f)
+        except (IOError, OSError, ValueError) :
+            return False
+        if d.get ('host') != self.args.host or d ['expires'] < time.time () :
+            return False
+        self.snx_info = bytes (bytearray.fromhex (d ['snx_info']))
+        self.debug ("Using saved snx info", 'snx')
+        return True
+    # end def load_snx_info
+
+    def save_snx_info (self) :
+        import json
+        if self.store :
+            self.store.save_snx_info \
+                ( self.profile, self.args.host, self.snx_info
+                , self.args.snx_info_ttl
+                )
+            return
+        d = dict \
+            ( host     = self.args.host
+            , expires  = time.time () + self.args.snx_info_ttl
+            , snx_info = ''.join ('%02x' % b_ord (c) for c in self.snx_info)
+            )
+        write_private (self.args.snx_info_file, json.dumps (d))
+    # end def save_snx_info
+
+    def forget_snx_info (self) :
+        if self.store :
+            self.store.forget (self.profile, 'snx_info')
+            return
+        try :
+            os.unlink (self.args.snx_info_file)
+        except OSError :
+            pass
+    # end def forget_snx_info
+
+    def debug (self, s, subsystem = 'login', **fields) :
+        self.log (DEBUG, s, subsystem, fields)
     # end def debug
 
-    def generate_snx_info (self) :
+    def error (self, s, subsystem = 'login', **fields) :
+        """ Report an error, errors are kept in self.errors for callers
+            that don't want them logged as errors (quiet).
+        """
+        self.errors.append (s)
+        level = DEBUG if self.quiet else ERROR
+        self.log (level, s, subsystem, fields)
+    # end def error
+
+    def notice (self, s, subsystem = 'login', **fields) :
+        """ Log at level info, the name info is taken by the headers """
+        self.log (INFO, s, subsystem, fields)
+    # end def notice
+
+    def log (self, level, s, subsystem, fields) :
+        """ Log to the logger of subsystem (see snxlog) with redacted
+            credentials, structured fields are passed as extra.
+        """
+        from snxlog import logger
+        log = logger (subsystem)
+        if log.isEnabledFor (level) :
+            msg = self.redactor.redact ('%s' % s)
+            log.log (level, msg, extra = dict (fields = fields))
+    # end def log
+
+    def secrets (self) :
+        """ Credentials that must not be logged """
+        secrets = [self.args.password]
+        if isinstance (self.args.multi_challenge, string_type) :
+            secrets.append (self.args.multi_challenge)
+        secrets.append (self.otp_code)
+        return secrets
+    # end def secrets
+
+    def gateway_host (self) :
+        """ The host name of the gateway passed to snx """
+        if self.args.use_host_as_gw :
+            return self.args.host.encode ('utf-8')
+        return self.extender_vars ['host_name']
+    # end def gateway_host
+
+    def generate_snx_info (self, gw_ip = None) :
         """ Communication with SNX (originally by the java framework) is
             done via an undocumented binary format. We try to reproduce
             this here. We asume native byte-order but we don't know if
             snx binaries exist for other architectures with a different
-            byte-order.
+            byte-order. The address of the gateway is resolved unless
+            given as gw_ip.
         """
-        magic  = b'\x13\x11\x00\x00'
-        length = 0x3d0
-        gw_host = self.args.host.encode('utf-8') if self.args.use_host_as_gw else self.extender_vars ['host_name']
-        gw_ip  = socket.gethostbyname(gw_host)
+        import socket
+        from snxproto import Connection_Info
+        gw_host = self.gateway_host ()
+        gw_ip  = gw_ip or self.resolve (gw_host)
         gw_int = unpack("!I", socket.inet_aton(gw_ip))[0]
-        fmt    = b'=4sLL64sL6s256s256s128s256sH'
-        info   = pack \
-            ( fmt
-            , magic
-            , length
-            , gw_int
-            , gw_host
-            , int (self.extender_vars ['port'])
-            , b''
-            , self.extender_vars ['server_cn']
-            , self.extender_vars ['user_name']
-            , self.extender_vars ['password']
-            , self.extender_vars ['server_fingerprint']
-            , 1 # ???
+        info   = Connection_Info \
+            ( gateway_ip   = gw_int
+            , gateway_host = gw_host
+            , port         = int (self.extender_vars ['port'])
+            , server_cn    = self.extender_vars ['server_cn']
+            , user_name    = self.extender_vars ['user_name']
+            , password     = self.extender_vars ['password']
+            , fingerprint  = self.extender_vars ['server_fingerprint']
             )
-        assert len (info) == length + 8 # magic + length
-        self.snx_info = info
+        self.snx_info = info.encode ()
     # end def generate_snx_info
 
     def login (self) :
-        if self.has_cookies :
-            self.debug ("has cookie")
-            self.nextfile = 'Portal/Main'
-            self.open ()
-            self.debug (self.purl)
-            if self.purl.endswith ('Portal/Main') :
-                self.open ('sslvpn/SNX/extender')
-                self.parse_extender ()
-                self.generate_snx_info ()
-                return True
-            else :
-                # Forget Cookies, otherwise we get a 400 bad request later
-                self.jar.clear ()
-                self.next_file (self.purl)
-        self.debug (self.nextfile)
+        """ Login with cookies if we have any, else with the password.
+            The login span records the result and the path (cookie,
+            cached for cached RSA parameters or password).
+        """
+        with self.tracer.span ('login', host = self.args.host) as span :
+            if self.has_cookies :
+                with self.tracer.span ('login.cookies') as s :
+                    result = self.login_with_cookies ()
+                    s.set (ok = result)
+                if result :
+                    self.login_path = 'cookie'
+                    span.set (path = self.login_path, ok = True)
+                    return True
+            with self.tracer.span ('login.password') as s :
+                result = self.login_with_password ()
+                s.set (ok = bool (result))
+            span.set (path = self.login_path, ok = bool (result))
+            return result
+    # end def login
+
+    def login_with_cookies (self) :
+        """ Try to reuse the session from the saved cookies. If the
+            portal sends us back to the login page we forget the cookies
+            and continue with the login page we've been redirected to.
+        """
+        from snxhttp import Page_Scraper
+        self.debug ("has cookie")
+        self.nextfile = 'Portal/Main'
         self.open ()
         self.debug (self.purl)
-        # Get the RSA parameters from the javascript in the received html
-        for script in self.soup.find_all ('script') :
-            if 'RSA' in script.attrs.get ('src', '') :
-                self.next_file (script ['src'])
-                self.debug (self.nextfile)
-                break
-        else :
-            print ('No RSA javascript file found, cannot login')
+        if self.purl.endswith ('Portal/Main') :
+            self.open ('sslvpn/SNX/extender', until = Page_Scraper.has_extender)
+            if not self.parse_extender () :
+                return False
+            self.generate_snx_info ()
+            return True
+        self.forget_cookies ()
+        return False
+    # end def login_with_cookies
+
+    def login_with_password (self) :
+        start = self.nextfile
+        entry = self.cached_login_params ()
+        self.login_path = 'password' if entry is None else 'cached'
+        if entry is None and not self.get_login_params () :
             return
-        self.open (do_soup = False)
+        self.prompt_credentials ()
+        enc = PW_Encode (modulus = self.modulus, exponent = self.exponent)
+        self.submit_credentials (enc)
+        if entry is not None and not self.accepted () :
+            if not self.refresh_login_params (entry, start) :
+                return
+            self.login_path = 'password'
+            enc = PW_Encode (modulus = self.modulus, exponent = self.exponent)
+            self.submit_credentials (enc)
+        if not self.answer_challenges (enc) :
+            return
+        return self.activate ()
+    # end def login_with_password
+
+    def get_login_params (self) :
+        """ Get RSA parameters and login form from the login page """
+        from snxhttp import Page_Scraper
+        self.debug (self.nextfile)
+        self.open (until = Page_Scraper.has_login_params)
+        self.debug (self.purl)
+        if not self.find_rsa_script () :
+            return False
+        script = self.nextfile
+        self.open (do_parse = False)
         self.parse_rsa_params ()
         if not self.modulus :
             # Error message already given in parse_rsa_params
+            return False
+        self.find_login_form ()
+        self.cache_login_params (script)
+        return True
+    # end def get_login_params
+
+    def accepted (self) :
+        """ Check if the portal accepted our login credentials """
+        return \
+            (  'MultiChallenge' in self.purl
+            or self.purl.endswith ('Login/ActivateLogin')
+            or self.purl.endswith ('Portal/Main')
+            )
+    # end def accepted
+
+    def cache_login_params (self, script) :
+        if not self.rsa_cache :
             return
-        for form in self.soup.find_all ('form') :
-            if 'id' in form.attrs and form ['id'] == 'loginForm' :
-                self.next_file (form ['action'])
-                assert form ['method'] == 'post'
-                break
+        self.rsa_cache.put \
+            ( self.args.host, self.args.realm
+            , modulus       = '%x' % self.modulus
+            , exponent      = '%x' % self.exponent
+            , script        = script
+            , action        = self.nextfile
+            , etag          = self.info.get ('ETag')
+            , last_modified = self.info.get ('Last-Modified')
+            )
+    # end def cache_login_params
+
+    def cached_login_params (self) :
+        """ Get RSA parameters and action of the login form from the
+            cache. If the entry is expired and validation is enabled we
+            ask the portal if the RSA javascript has changed. Return the
+            cache entry or None if the login page must be retrieved.
+        """
+        from snxhttp import HTTPError
+        entry, headers = self.lookup_login_params ()
+        if headers :
+            try :
+                response = self.fetch \
+                    (entry ['script'], do_parse = False, headers = headers)
+            except HTTPError as err :
+                if err.code != 304 :
+                    raise
+                response = None
+            entry = self.validate_login_params (entry, response)
+        return self.use_login_params (entry)
+    # end def cached_login_params
+
+    def lookup_login_params (self) :
+        """ The cache entry of the login parameters and the headers for
+            asking the portal if it is still valid, the headers are None
+            for a fresh entry. The entry is None if it is not usable.
+        """
+        if not self.rsa_cache :
+            return None, None
+        entry = self.rsa_cache.get (self.args.host, self.args.realm)
+        if not entry :
+            return None, None
+        if self.rsa_cache.is_fresh (entry) :
+            return entry, None
+        if not self.args.rsa_cache_validate :
+            return None, None
+        headers = {}
+        if entry ['etag'] :
+            headers ['If-None-Match'] = entry ['etag']
+        if entry ['last_modified'] :
+            headers ['If-Modified-Since'] = entry ['last_modified']
+        if not headers :
+            return None, None
+        return entry, headers
+    # end def lookup_login_params
+
+    def validate_login_params (self, entry, response) :
+        """ Update the cache entry from the response to the conditional
+            request for the RSA javascript, response is None if it was
+            not modified. Return None if the new javascript is unusable.
+        """
+        if response is None :
+            self.debug ("RSA javascript not modified", 'crypto')
+        else :
+            self.use (response)
+            self.parse_rsa_params ()
+            if not self.modulus :
+                return None
+            entry ['modulus']       = '%x' % self.modulus
+            entry ['exponent']      = '%x' % self.exponent
+            entry ['etag']          = self.info.get ('ETag')
+            entry ['last_modified'] = self.info.get ('Last-Modified')
+        self.rsa_cache.put (self.args.host, self.args.realm, **entry)
+        return entry
+    # end def validate_login_params
+
+    def use_login_params (self, entry) :
+        """ Use the login parameters of the cache entry if any """
+        if entry is None :
+            return None
+        self.debug ("Using cached RSA parameters", 'crypto')
+        self.modulus  = int (entry ['modulus'],  16)
+        self.exponent = int (entry ['exponent'], 16)
+        self.nextfile = entry ['action']
+        return entry
+    # end def use_login_params
+
+    def invalidate_login_params (self, start) :
+        """ The portal rejected the login with cached parameters, forget
+            them and continue with the login page.
+        """
+        self.debug ("Cached RSA parameters rejected", 'crypto')
+        self.rsa_cache.invalidate (self.args.host, self.args.realm)
+        self.modulus  = self.exponent = None
+        self.nextfile = start
+    # end def invalidate_login_params
+
+    def refresh_login_params (self, entry, start) :
+        """ The portal rejected the login with the cached parameters of
+            entry: Get them from the login page again, see
+            check_login_params. A wrong password is posted only once:
+        >>> import shutil, tempfile
+        >>> from snxmock import Mock_Portal
+        >>> portal = Mock_Portal ()
+        >>> portal.start ()
+        >>> d = tempfile.mkdtemp ()
+        >>> def login (password) :
+        ...     args = option_parser ({}).parse_args \\
+        ...         ( [ '-H', '127.0.0.1:%d' % portal.port, '-p', 'http'
+        ...           , '-U', 'user', '-P', password
+        ...           , '--rsa-cache', os.path.join (d, 'rsa')
+        ...           ]
+        ...         )
+        ...     rq = HTML_Requester (args)
+        ...     rq.quiet = True
+        ...     result = rq.login ()
+        ...     rq.close ()
+        ...     print (result, [p.split ('/') [-1] for p, t in rq.timings])
+        >>> login ('secret')
+        True ['Login', 'RSA.js', 'Login', 'ActivateLogin', 'extender']
+        >>> login ('wrong')
+        None ['Login', 'Login', 'RSA.js']
+        >>> portal.shutdown ()
+        >>> portal.server_close ()
+        >>> shutil.rmtree (d)
+        """
+        error = self.page.error
+        self.invalidate_login_params (start)
+        if not self.get_login_params () :
+            return False
+        return self.check_login_params (entry, error)
+    # end def refresh_login_params
+
+    def check_login_params (self, entry, error) :
+        """ Return True if the parameters from the login page differ
+            from the cached entry, only then the credentials are sent
+            again. Otherwise the credentials were wrong and the error
+            of the rejected login is reported: a wrong password must not
+            use up two attempts of a lockout policy.
+        """
+        changed = \
+            (  entry ['modulus']  != '%x' % self.modulus
+            or entry ['exponent'] != '%x' % self.exponent
+            or entry ['action']   != self.nextfile
+            )
+        if changed :
+            self.debug ("Cached login parameters were outdated", 'crypto')
+            return True
+        if error is not None :
+            self.error ("Error: %s" % error)
+        else :
+            self.error ("Login rejected")
+        return False
+    # end def check_login_params
+
+    def save_cookies (self) :
+        if not self.args.save_cookies :
+            return
+        if self.store :
+            self.store.save_cookies (self.profile, self.jar)
+        else :
+            self.jar.save (self.args.cookiefile, ignore_discard = True)
+    # end def save_cookies
+
+    def forget_cookies (self) :
+        # Forget Cookies, otherwise we get a 400 bad request later
+        self.jar.clear ()
+        self.next_file (self.purl)
+    # end def forget_cookies
+
+    def find_rsa_script (self) :
+        """ Get the RSA parameters from the javascript in the received html
+        """
+        for script in self.page.scripts :
+            if 'RSA' in script.attrs.get ('src', '') :
+                self.next_file (script ['src'])
+                self.debug (self.nextfile)
+                return True
+        self.error ('No RSA javascript file found, cannot login')
+        return False
+    # end def find_rsa_script
+
+    def find_login_form (self) :
+        form = self.page.form (id = 'loginForm')
+        if form :
+            self.next_file (form ['action'])
+            assert form ['method'] == 'post'
         self.debug (self.nextfile)
+    # end def find_login_form
 
-        # Prompt username and password if absent
-        if not self.args.username :
-            self.args.username = input ('Username: ')
-        if not self.args.password :
-            self.args.password = getpass ('Password: ')
+    def ask_credentials (self) :
+        """ Prompt username and password if absent, return both """
+        from getpass import getpass
+        username = self.args.username or input ('Username: ')
+        password = self.args.password or getpass ('Password: ')
+        return username, password
+    # end def ask_credentials
 
-        enc = PW_Encode (modulus = self.modulus, exponent = self.exponent)
+    def prompt_credentials (self) :
+        """ Prompt username and password if absent """
+        self.args.username, self.args.password = self.ask_credentials ()
+    # end def prompt_credentials
+
+    def encrypt (self, enc, password) :
+        with self.tracer.span ('rsa.encrypt') :
+            return enc.encrypt (password)
+    # end def encrypt
+
+    def credentials_form (self, enc) :
+        """ The form data of the login with the encrypted password """
+        from snxhttp import urlencode
         d = dict \
             ( selectedRealm = self.args.realm
             , loginType     = self.args.login_type
             , userName      = self.args.username
             , pin           = self.args.password
-            , password      = enc.encrypt (self.args.password)
+            , password      = self.encrypt (enc, self.args.password)
             , HeightData    = self.args.height_data
             )
-        self.open (data = urlencode (d))
+        return urlencode (d)
+    # end def credentials_form
+
+    def submit_credentials (self, enc) :
+        self.open (data = self.credentials_form (enc))
         self.debug (self.purl)
         self.debug (self.info)
+    # end def submit_credentials
 
-        if self.args.multi_challenge :
-            if not isinstance(self.args.multi_challenge, string_type) :
-                self.args.multi_challenge = input ('MultiChallenge code: ')
-            while 'MultiChallenge' in self.purl :
-                d = self.parse_pw_response ()
-                d ['pin'] = ''
-                d ['password'] = enc.encrypt (self.args.multi_challenge)
-                self.debug ("nextfile: %s" % self.nextfile)
-                self.debug ("purl: %s" % self.purl)
-                self.open (data = urlencode (d))
-                self.debug ("info: %s" % self.info)
-                if self.check_error () :
-                    return
+    def answer_challenges (self, enc) :
+        """ Answer MultiChallenge pages if enabled, the code comes from
+            the OTP provider (see snxotp). A rejected code is retried
+            with a new one up to --otp-retries times if the provider
+            can give another code. Return False on error.
+        """
+        from snxotp  import OTP_Error
+        otp = self.otp_provider ()
+        if not otp :
+            return True
+        attempt = 0
+        while 'MultiChallenge' in self.purl :
+            try :
+                with self.tracer.span ('otp', attempt = attempt) :
+                    self.otp_code = otp.code (attempt, self.args.otp_timeout)
+            except OTP_Error as err :
+                self.error ("MultiChallenge: %s" % err)
+                return False
+            self.open (data = self.challenge_form (enc))
+            self.debug ("info: %s" % self.info)
+            if self.check_error () :
+                attempt += 1
+                if not self.retry_challenge (otp, attempt) :
+                    return False
+                # Get the challenge form again unless the error page has it
+                if not self.page.form (name = 'MCForm') :
+                    self.open ()
+        return True
+    # end def answer_challenges
+
+    def challenge_form (self, enc) :
+        """ The form data answering the challenge with self.otp_code """
+        from snxhttp import urlencode
+        d = self.parse_pw_response ()
+        d ['pin'] = ''
+        d ['password'] = self.encrypt (enc, self.otp_code)
+        self.debug ("nextfile: %s" % self.nextfile)
+        self.debug ("purl: %s" % self.purl)
+        return urlencode (d)
+    # end def challenge_form
+
+    def retry_challenge (self, otp, attempt) :
+        """ Check if we may retry after attempt rejected codes """
+        if not otp.retry or attempt > self.args.otp_retries :
+            return False
+        self.notice \
+            ( "MultiChallenge code rejected, retrying", 'login'
+            , attempt = attempt
+            )
+        return True
+    # end def retry_challenge
 
+    def otp_provider (self) :
+        """ The provider of MultiChallenge codes: --otp-provider, the
+            code given with -MC or a prompt if -MC is given without a
+            code. None if MultiChallenge is not enabled.
+        """
+        from snxotp import make_provider, Static_Provider, Prompt_Provider
+        if self.otp is None :
+            if self.args.otp_provider :
+                self.otp = make_provider (self.args.otp_provider)
+            elif isinstance (self.args.multi_challenge, string_type) :
+                self.otp = Static_Provider (self.args.multi_challenge)
+            elif self.args.multi_challenge :
+                self.otp = Prompt_Provider ()
+        return self.otp
+    # end def otp_provider
+
+    def activate (self) :
+        """ Final steps after successful authentication: Activate the
+            login if necessary and retrieve the extender parameters.
+        """
+        from snxhttp import Page_Scraper
         if self.purl.endswith ('Login/ActivateLogin') :
-            if self.args.save_cookies :
-                self.jar.save (self.args.cookiefile, ignore_discard = True)
+            self.save_cookies ()
             self.debug ("purl: %s" % self.purl)
-            self.open('sslvpn/Login/ActivateLogin?ActivateLogin=activate&LangSelect=en_US&submit=Continue&HeightData=')
+            self.open (self.activate_url)
 
         if self.check_error () :
             return
 
         if self.purl.endswith ('Portal/Main') :
-            if self.args.save_cookies :
-                self.jar.save (self.args.cookiefile, ignore_discard = True)
+            self.save_cookies ()
             self.debug ("purl: %s" % self.purl)
-            self.open  ('sslvpn/SNX/extender')
+            self.open ('sslvpn/SNX/extender', until = Page_Scraper.has_extender)
             self.debug (self.purl)
             self.debug (self.info)
-            self.parse_extender ()
+            if not self.parse_extender () :
+                return False
             self.generate_snx_info ()
             return True
         else :
             self.check_error ()
-            print ("Unexpected response, try again.")
+            self.error ("Unexpected response, try again.")
             self.debug ("purl: %s" % self.purl)
             return
-    # end def login
+    # end def activate
+
+    def resolve (self, host) :
+        """ Resolve host to an IPv4 address, snx only supports IPv4 """
+        import socket
+        return self.resolver.resolve (host, socket.AF_INET)
+    # end def resolve
+
+    def make_context (self) :
+        """ SSL context for one host of the portal, this is created on
+            first use since loading the CA certificates takes some time.
+            TLS sessions can only be resumed with the context that
+            created them, so the pool keeps one per host.
+        """
+        return ssl_context (self.args.skip_cert)
+    # end def make_context
 
     def next_file (self, fname) :
         if fname.startswith ('/') :
@@ -277,42 +1272,177 @@ class HTML_Requester (object) :
             # We might try to remove '..' elements in the future
     # end def next_file
 
-    def open (self, filepart = None, data = None, do_soup = True) :
+    def fetch \
+        ( self
+        , filepart = None
+        , data     = None
+        , do_parse = True
+        , headers  = None
+        , until    = None
+        ) :
+        """ Request filepart from the portal and return a Response.
+            This does not modify the state of the requester, so several
+            fetches may run concurrently (the cookie jar does its own
+            locking).
+        """
+        from snxhttp import Request, Response, Decoded_Response
         filepart = filepart or self.nextfile
         url = '/'.join (('%s:/' % self.args.protocol, self.args.host, filepart))
         if data :
             data = data.encode ('ascii')
-        rq = Request (url, data, headers={'User-Agent': self.args.useragent})
-        self.f = f = self.opener.open (rq, timeout = 10)
-        if do_soup :
-            # Sometimes we get incomplete read. So we read everything
-            # the server sent us and hope this is ok. Note: This means
-            # we cannot pass the file to BeautifulSoup but need to read
-            # everything here.
-            try:
-                page = f.read ()
-            except IncompleteRead as e:
-                page = e.partial
-            self.soup = BeautifulSoup (page, "lxml")
-        self.purl = f.geturl ()
-        self.info = f.info ()
+        hdrs = {'User-Agent': self.args.useragent}
+        if self.args.compression :
+            hdrs ['Accept-Encoding'] = 'gzip, deflate'
+        hdrs.update (headers or {})
+        rq   = Request (url, data, headers = hdrs)
+        path = filepart.split ('?') [0]
+        with self.tracer.span ('request', path = path) as span :
+            start = time.time ()
+            # Fetches may run concurrently, the pool collects the
+            # connections of this request (with redirects) per thread
+            self.pool.collect ()
+            try :
+                f = self.opener.open (rq, timeout = self.args.timeout)
+            finally :
+                stats = self.pool.collected ()
+            for stat in stats :
+                self.debug \
+                    ( "connection: %s" % stat, 'http'
+                    , reused = stat.reused, tls_resumed = stat.resumed
+                    )
+                if self.metrics and stat.resumed is not None :
+                    self.metrics.inc \
+                        ( 'snxconnect_tls_handshakes_total'
+                        , resumed = ['no', 'yes'][stat.resumed]
+                        )
+            span.set (method = rq.get_method (), status = f.getcode ())
+            f = Decoded_Response \
+                ( f
+                , self.args.max_response_size
+                , self.chunksize
+                , done = self.transferred
+                )
+            page = None
+            if do_parse :
+                page = self.scrape (f, until)
+            self.timings.append ((path, time.time () - start))
+        return Response (f, page)
+    # end def fetch
+
+    def drain (self, f) :
+        """ Read the rest of a response so the connection can be reused
+        """
+        while f.read (self.chunksize) :
+            pass
+    # end def drain
+
+    def scrape (self, f, until = None) :
+        """ Parse the page while reading it. When the until function
+            tells us we have all we need, the rest is read but not
+            parsed. Sometimes we get incomplete read, we parse what the
+            server sent us and hope this is ok. The response is a
+            Decoded_Response, it decompresses and handles incomplete
+            reads for us.
+        """
+        import codecs
+        from snxhttp import Page_Scraper
+        charset = 'utf-8'
+        ctype   = f.info ().get ('Content-Type', '')
+        for param in ctype.split (';') [1:] :
+            k, _, v = param.strip ().partition ('=')
+            if k.lower () == 'charset' :
+                charset = v.strip ('"')
+        try :
+            decoder = codecs.getincrementaldecoder (charset) ('replace')
+        except LookupError :
+            decoder = codecs.getincrementaldecoder ('utf-8') ('replace')
+        page   = Page_Scraper (until)
+        parsed = 0
+        # Reading and parsing are interleaved: The parse time is summed
+        # up and reported as a separate span after the body span.
+        with self.tracer.span ('body') as span :
+            start = time.time ()
+            while not page.done :
+                chunk = f.read (self.chunksize)
+                t = time.time ()
+                page.feed (decoder.decode (chunk, not chunk))
+                parsed += time.time () - t
+                if not chunk :
+                    break
+            else :
+                self.drain (f)
+            page.close ()
+            span.set \
+                ( parse         = round (parsed, 6)
+                , stopped_early = page.done
+                , encoding      = f.encoding or 'identity'
+                , wire          = f.wire
+                , decoded       = f.decoded
+                , incomplete    = f.incomplete
+                )
+        self.tracer.record ('parse', start, parsed)
+        return page
+    # end def scrape
+
+    def transferred (self, f) :
+        """ Called by the Decoded_Response when the body has been read
+        """
+        url = f.geturl ().split ('?') [0]
+        self.transfers.append ((url, f.wire, f.decoded))
+        self.debug \
+            ( "%s: %d bytes on the wire (%s), %d bytes decoded%s"
+            % ( url, f.wire, f.encoding or 'identity', f.decoded
+              , ', incomplete read' if f.incomplete else ''
+              )
+            , 'http'
+            , url = url, wire = f.wire, decoded = f.decoded
+            , encoding = f.encoding or 'identity', incomplete = f.incomplete
+            )
+        if self.metrics :
+            self.metrics.inc \
+                ('snxconnect_response_bytes_total', f.wire, kind = 'wire')
+            self.metrics.inc \
+                ('snxconnect_response_bytes_total', f.decoded, kind = 'decoded')
+    # end def transferred
+
+    def use (self, response) :
+        """ Make response the current page. If the response was fetched
+            without parsing we keep the previous page.
+        """
+        self.f    = response.f
+        self.purl = response.purl
+        self.info = response.info
+        if response.page is not None :
+            self.page = response.page
+    # end def use
+
+    def open \
+        ( self
+        , filepart = None
+        , data     = None
+        , do_parse = True
+        , headers  = None
+        , until    = None
+        ) :
+        self.use (self.fetch (filepart, data, do_parse, headers, until))
     # end def open
 
     def parse_extender (self) :
         """ The SNX extender page contains the necessary credentials for
             connecting the VPN. This information then passed to the snx
             program via a socket.
+            Returns False if the page has no (complete) extender
+            variables, e.g. when the session expired, extender_vars is
+            not changed then.
         """
-        for script in self.soup.find_all ('script') :
-            if '/* Extender.user_name' in script.text :
-                break
-        else :
-            print ("Error retrieving extender variables")
-            return
+        script = self.page.extender_script () if self.page else None
+        if not script :
+            self.error ("Error retrieving extender variables", 'parse')
+            return False
         for line in script.text.split ('\n') :
             if '/* Extender.user_name' in line :
                 break
-        self.debug ('extender_line: %s' % line)
+        self.debug ('extender_line: %s' % line, 'parse')
         stmts = line.split (';')
         vars  = {}
         for stmt in stmts :
@@ -326,8 +1456,17 @@ class HTML_Requester (object) :
                 continue
             rhs = rhs.strip ().strip ('"')
             vars [lhs] = rhs.encode ('utf-8')
-        self.debug ('extender_vars: %s' % repr (vars))
+        self.debug ('extender_vars: %s' % repr (vars), 'parse')
+        missing = [k for k in self.extender_keys if k not in vars]
+        if missing :
+            self.error \
+                ( "Extender variables incomplete, missing %s"
+                % ', '.join (missing)
+                , 'parse'
+                )
+            return False
         self.extender_vars = vars
+        return True
     # end def parse_extender
 
     def parse_pw_response (self) :
@@ -335,13 +1474,13 @@ class HTML_Requester (object) :
             one-time password (in our case received via a message to the
             phone) must be entered.
         """
-        for form in self.soup.find_all ('form') :
-            if 'name' in form.attrs and form ['name'] == 'MCForm' :
+        for form in self.page.forms :
+            if form.attrs.get ('name') == 'MCForm' :
                 self.next_file (form ['action'])
                 assert form ['method'] == 'post'
                 break
         d = {}
-        for input in form.find_all ('input') :
+        for input in form.inputs :
             if input.attrs.get ('type') == 'password' :
                 continue
             if 'name' not in input.attrs :
@@ -365,49 +1504,132 @@ class HTML_Requester (object) :
                     vars [k] = val
                     break
             if len (vars) == 2 :
+                self.drain (self.f)
                 break
         else :
-            print ('No RSA parameters found, cannot login')
+            self.error ('No RSA parameters found, cannot login', 'crypto')
             return
-        self.debug (repr (vars))
+        self.debug (repr (vars), 'crypto')
         self.modulus  = int (vars ['modulus'],  16)
         self.exponent = int (vars ['exponent'], 16)
     # end def parse_rsa_params
 
     def check_error (self) :
-        errorMessage = self.soup.select_one(".errorMessage")
-        if errorMessage :
-            print ("Error: %s" % errorMessage.string)
+        if self.page.error is not None :
+            self.error ("Error: %s" % self.page.error)
             return True
         return False
     # end def check_error
 
 # end class HTML_Requester
 
+class RSA_Backend (object) :
+    """ PKCS#1 v1.5 encryption with the pure python rsa package """
+
+    name = 'rsa'
+
+    def __init__ (self, modulus, exponent) :
+        import rsa
+        self.pubkey = rsa.PublicKey (modulus, exponent)
+    # end def __init__
+
+    @staticmethod
+    def available () :
+        return True
+    # end def available
+
+    def encrypt (self, data) :
+        import rsa
+        return rsa.pkcs1.encrypt (data, self.pubkey)
+    # end def encrypt
+
+# end class RSA_Backend
+
+class OpenSSL_Backend (object) :
+    """ PKCS#1 v1.5 encryption with OpenSSL via the cryptography package
+    """
+
+    name = 'cryptography'
+
+    def __init__ (self, modulus, exponent) :
+        from cryptography.hazmat.primitives.asymmetric import rsa, padding
+        numbers      = rsa.RSAPublicNumbers (exponent, modulus)
+        self.pubkey  = numbers.public_key ()
+        self.padding = padding.PKCS1v15 ()
+    # end def __init__
+
+    @staticmethod
+    def available () :
+        try :
+            __import__ ('cryptography.hazmat.primitives.asymmetric.rsa')
+        except ImportError :
+            return False
+        return True
+    # end def available
+
+    def encrypt (self, data) :
+        return self.pubkey.encrypt (data, self.padding)
+    # end def encrypt
+
+# end class OpenSSL_Backend
+
 class PW_Encode (object) :
     """ RSA encryption module with special padding and reversing to be
-        compatible with checkpoints implementation.
+        compatible with checkpoints implementation. The backend is the
+        first available of backends unless given by name. Keys are
+        cached per backend, modulus and exponent for the process.
+    >>> import rsa
+    >>> pub, priv = rsa.newkeys (512)
+    >>> names = [b.name for b in PW_Encode.backends if b.available ()]
+    >>> for name in names :
+    ...     enc = PW_Encode (pub.n, pub.e, backend = name)
+    ...     for pw in ('', 'secret', 'p\xe4ssw\xf6rd', 'x' * 53) :
+    ...         e = enc.encrypt (pw)
+    ...         assert len (e) == 128 and e == e.lower ()
+    ...         c = bytes (bytearray.fromhex (e) [::-1])
+    ...         assert rsa.decrypt (c, priv).decode ('utf-8') == pw
+    >>> PW_Encode (pub.n, pub.e, backend = 'rsa').key \\
+    ...     is PW_Encode (pub.n, pub.e, backend = 'rsa').key
+    True
+    >>> PW_Encode (pub.n, pub.e, backend = 'des')
+    Traceback (most recent call last):
+    ...
+    ValueError: RSA backend des is not available
     """
 
-    def __init__ (self, modulus = None, exponent = None, testing = False) :
+    backends = [OpenSSL_Backend, RSA_Backend]
+    keys     = {}
+
+    def __init__ \
+        ( self
+        , modulus  = None
+        , exponent = None
+        , testing  = False
+        , backend  = None
+        ) :
         if modulus is None or exponent is None :
             raise TypeError("The modulus or exponent are undefined")
-        self.pubkey  = rsa.PublicKey(modulus, exponent)
+        for b in self.backends :
+            if (backend is None or b.name == backend) and b.available () :
+                break
+        else :
+            raise ValueError ("RSA backend %s is not available" % backend)
+        k = (b.name, modulus, exponent)
+        if k not in self.keys :
+            self.keys [k] = b (modulus, exponent)
+        self.key     = self.keys [k]
         self.testing = testing
     # end def __init__
 
     def encrypt (self, password) :
-        x = bytes (password, 'utf-8')
-        e = rsa.pkcs1.encrypt (x, self.pubkey)
-        e = ''.join ('%02x' % b_ord (c) for c in reversed (e))
-        return e
+        e = self.key.encrypt (password.encode ('utf-8'))
+        return hexlify (e [::-1]).decode ('ascii')
     # end def encrypt
 
 # end class PW_Encode
 
-def main () :
-    # First try to parse config-file ~/.snxvpnrc:
-    home = os.environ.get ('HOME')
+def read_config (home) :
+    """ Parse config-file ~/.snxvpnrc into a dict """
     cfgf = None
     if home :
         try :
@@ -415,7 +1637,11 @@ def main () :
         except (OSError, IOError) :
             pass
     cfg = {}
-    boolopts = ['debug', 'save_cookies', 'skip_cert', 'multi_challenge']
+    boolopts = \
+        [ 'debug', 'save_cookies', 'skip_cert', 'multi_challenge'
+        , 'async_login', 'rsa_cache_validate', 'warm_reconnect'
+        , 'supervise', 'snx_reap', 'compression'
+        ]
     if cfgf :
         for line in cfgf :
             line = line.strip ().decode ('utf-8')
@@ -428,10 +1654,51 @@ def main () :
             if k in boolopts :
                 v = (v.lower () in ('true', 'yes'))
             cfg [k] = v
+    return cfg
+# end def read_config
+
+def option_parser (cfg = None) :
+    """ Command line parser, defaults are taken from ~/.snxvpnrc unless
+        the config is given as a dict.
+    """
+    home = os.environ.get ('HOME')
+    if cfg is None :
+        cfg = read_config (home)
 
     host       = cfg.get ('host', '')
     cookiefile = cfg.get ('cookiefile', '%s/.snxcookies' % home)
+    infofile   = cfg.get ('snx_info_file', '%s/.snxinfo' % home)
+    gwhistory  = cfg.get ('gateway_history', '%s/.snxgateways' % home)
     cmd = ArgumentParser ()
+    cmd.add_argument \
+        ( '-a', '--async-login'
+        , help    = 'Run independent parts of the login concurrently'
+                    ' (needs python3)'
+        , action  = 'store_true'
+        , default = cfg.get ('async_login', False)
+        )
+    cmd.add_argument \
+        ( '--backoff-max'
+        , help    = 'Maximum seconds between reconnects when supervising,'
+                    ' default=%(default)s'
+        , type    = float
+        , default = float (cfg.get ('backoff_max', 300))
+        )
+    cmd.add_argument \
+        ( '--backoff-min'
+        , help    = 'Seconds before the first reconnect when supervising,'
+                    ' default=%(default)s'
+        , type    = float
+        , default = float (cfg.get ('backoff_min', 1))
+        )
+    cmd.add_argument \
+        ( '-B', '--batch'
+        , help    = 'Check login (without starting snx) for all profiles'
+                    ' in the given file, one profile per line:'
+                    ' host [realm [username [password]]], -MC is forced'
+                    ' off, MultiChallenge only works with --otp-provider'
+                    ' (shared by the workers)'
+        )
     cmd.add_argument \
         ( '-c', '--cookiefile'
         , help    = 'Specify cookiefile to save and attempt reconnect'
@@ -444,38 +1711,232 @@ def main () :
         , action  = 'store_true'
         , default = cfg.get ('debug', None)
         )
+    cmd.add_argument \
+        ( '--dns-ttl'
+        , help    = 'Seconds DNS lookups are cached, default=%(default)s'
+        , type    = int
+        , default = int (cfg.get ('dns_ttl', 300))
+        )
     cmd.add_argument \
         ( '-F', '--file'
         , help    = 'File part of URL default="%(default)s"'
         , default = cfg.get ('file', 'sslvpn/Login/Login')
         )
+    cmd.add_argument \
+        ( '-G', '--gateways'
+        , help    = 'Comma-separated list of portals, the fastest'
+                    ' reachable portal is used instead of --host'
+        , default = cfg.get ('gateways', None)
+        )
+    cmd.add_argument \
+        ( '--gateway-history'
+        , help    = 'File with the history of gateway probes,'
+                    ' default="%(default)s"'
+        , default = gwhistory
+        )
     cmd.add_argument \
         ( '-H', '--host'
         , help     = 'Host part of URL default="%(default)s"'
         , default  = host
-        , required = not host
         )
     cmd.add_argument \
         ( '--height-data'
         , help    = 'Height data in form, default "%(default)s"'
         , default = cfg.get ('height_data', '')
         )
+    cmd.add_argument \
+        ( '--hold'
+        , help    = 'How to wait while snx is connected: full keeps the'
+                    ' login state, lean releases it (this saves next to'
+                    ' nothing, most of the memory is the interpreter and'
+                    ' its modules), exec replaces the process by a'
+                    ' minimal watcher of the snx control socket (not with'
+                    ' --supervise, --keepalive, --probe or metrics),'
+                    ' default=%(default)s'
+        , choices = ('full', 'lean', 'exec')
+        , default = cfg.get ('hold', 'full')
+        )
+    cmd.add_argument \
+        ( '--keepalive'
+        , help    = 'Keep the portal session alive while snx runs by'
+                    ' requesting it every this many seconds (less if'
+                    ' the portal reports a shorter timeout of at least'
+                    ' a minute) and refresh'
+                    ' the snx parameters, 0 to disable, default=%(default)s'
+        , type    = float
+        , default = float (cfg.get ('keepalive', 0))
+        )
+    cmd.add_argument \
+        ( '--log'
+        , help    = 'Where to log: - for stdout, syslog (ends up in the'
+                    ' journal with systemd) or a file name (rotated at'
+                    ' --log-max-bytes), logging to syslog or a file does'
+                    ' not block, default="%(default)s"'
+        , default = cfg.get ('log', '-')
+        )
+    cmd.add_argument \
+        ( '--log-backups'
+        , help    = 'Number of rotated log files kept, default=%(default)s'
+        , type    = int
+        , default = int (cfg.get ('log_backups', 5))
+        )
+    cmd.add_argument \
+        ( '--log-format'
+        , help    = 'Log format, default is plain for stdout, kv'
+                    ' (key=value) otherwise'
+        , choices = ('plain', 'kv', 'json')
+        , default = cfg.get ('log_format')
+        )
+    cmd.add_argument \
+        ( '--log-level'
+        , help    = 'Log level, optionally per subsystem (login, http,'
+                    ' parse, crypto, snx, keepalive, probe, supervise,'
+                    ' gateway, metrics), e.g. info,http=debug; the'
+                    ' default is info or debug with -D'
+        , default = cfg.get ('log_level')
+        )
+    cmd.add_argument \
+        ( '--log-max-bytes'
+        , help    = 'Size at which the log file is rotated,'
+                    ' default=%(default)s'
+        , type    = int
+        , default = int (cfg.get ('log_max_bytes', 1 << 20))
+        )
     cmd.add_argument \
         ( '-L', '--login-type'
         , help    = 'Login type, default="%(default)s"'
         , default = cfg.get ('login_type', 'Standard')
         )
+    cmd.add_argument \
+        ( '--max-response-size'
+        , help    = 'Maximum size of a (decompressed) portal page in bytes,'
+                    ' 0 for no limit, default=%(default)s'
+        , type    = int
+        , default = int (cfg.get ('max_response_size', 16 << 20))
+        )
+    cmd.add_argument \
+        ( '--metrics-file'
+        , help    = 'Write metrics in Prometheus text format to this file'
+                    ' every --metrics-interval seconds and when snx'
+                    ' connects or terminates (e.g. for the textfile'
+                    ' collector of the node exporter), default=%(default)s'
+        , default = cfg.get ('metrics_file')
+        )
+    cmd.add_argument \
+        ( '--metrics-interval'
+        , help    = 'Interval for writing --metrics-file in seconds,'
+                    ' default=%(default)s'
+        , type    = float
+        , default = float (cfg.get ('metrics_interval', 15))
+        )
+    cmd.add_argument \
+        ( '--metrics-listen'
+        , help    = 'Serve metrics in Prometheus text format via HTTP on'
+                    ' this address, e.g. 127.0.0.1:9776 (the port defaults'
+                    ' to 9776), the path is /metrics, default=%(default)s'
+        , default = cfg.get ('metrics_listen')
+        )
     cmd.add_argument \
         ( '-MC', '--multi-challenge'
         , help    = 'MultiChallenge flag enablement or actual code, default="%(default)s"'
         , nargs   = '?', const = True
         , default = cfg.get ('multi_challenge', False)
         )
+    cmd.add_argument \
+        ( '--no-compression'
+        , help    = 'Do not ask the portal for gzip or deflate compressed'
+                    ' pages (config option compression)'
+        , dest    = 'compression'
+        , action  = 'store_false'
+        , default = cfg.get ('compression', True)
+        )
+    cmd.add_argument \
+        ( '--otp-provider'
+        , help    = 'Get MultiChallenge codes from totp:SEEDFILE (base32'
+                    ' seed or otpauth URI, only readable by the user),'
+                    ' fifo:PATH or fd:N (one code per line) or cmd:COMMAND'
+                    ' (first line of the output), implies -MC,'
+                    ' default=%(default)s'
+        , default = cfg.get ('otp_provider')
+        )
+    cmd.add_argument \
+        ( '--otp-retries'
+        , help    = 'Get a new MultiChallenge code this many times if the'
+                    ' portal rejects the code, default=%(default)s'
+        , type    = int
+        , default = int (cfg.get ('otp_retries', 2))
+        )
+    cmd.add_argument \
+        ( '--otp-timeout'
+        , help    = 'Seconds to wait for a MultiChallenge code from the'
+                    ' OTP provider, default=%(default)s'
+        , type    = float
+        , default = float (cfg.get ('otp_timeout', 30))
+        )
     cmd.add_argument \
         ( '-P', '--password'
         , help    = 'Login password, not a good idea to specify on commandline'
         , default = cfg.get ('password', None)
         )
+    cmd.add_argument \
+        ( '--prefer'
+        , help    = 'Preferred address family for the portal, the'
+                    ' gateway passed to snx is always IPv4,'
+                    ' default="%(default)s"'
+        , choices = ('any', 'ipv4', 'ipv6')
+        , default = cfg.get ('prefer', 'any')
+        )
+    cmd.add_argument \
+        ( '--probe'
+        , help    = 'Comma-separated targets behind the tunnel probed'
+                    ' while snx is connected: host:port (TCP connect)'
+                    ' or udp:host:port (UDP echo). If all targets exceed'
+                    ' a --probe-max threshold snx is restarted'
+                    ' (reconnect needs --supervise), default=%(default)s'
+        , default = cfg.get ('probe')
+        )
+    cmd.add_argument \
+        ( '--probe-interval'
+        , help    = 'Seconds between probes, a fifth of this after a'
+                    ' lost probe, default=%(default)s'
+        , type    = float
+        , default = float (cfg.get ('probe_interval', 30))
+        )
+    cmd.add_argument \
+        ( '--probe-max-jitter'
+        , help    = 'Jitter of the probes in seconds that counts as'
+                    ' degraded, 0 to ignore, default=%(default)s'
+        , type    = float
+        , default = float (cfg.get ('probe_max_jitter', 0))
+        )
+    cmd.add_argument \
+        ( '--probe-max-loss'
+        , help    = 'Fraction of lost probes that counts as degraded,'
+                    ' 0 to ignore, default=%(default)s'
+        , type    = float
+        , default = float (cfg.get ('probe_max_loss', 0.5))
+        )
+    cmd.add_argument \
+        ( '--probe-max-rtt'
+        , help    = 'Mean RTT of the probes in seconds that counts as'
+                    ' degraded, 0 to ignore, default=%(default)s'
+        , type    = float
+        , default = float (cfg.get ('probe_max_rtt', 0))
+        )
+    cmd.add_argument \
+        ( '--probe-timeout'
+        , help    = 'Seconds after which a probe counts as lost,'
+                    ' default=%(default)s'
+        , type    = float
+        , default = float (cfg.get ('probe_timeout', 2))
+        )
+    cmd.add_argument \
+        ( '--probe-window'
+        , help    = 'Number of recent probes per target the statistics'
+                    ' are computed from, default=%(default)s'
+        , type    = int
+        , default = int (cfg.get ('probe_window', 20))
+        )
     cmd.add_argument \
         ( '-p', '--protocol'
         , help    = 'http or https, should *always* be https except for tests'
@@ -486,6 +1947,26 @@ def main () :
         , help    = 'Selected realm, default="%(default)s"'
         , default = cfg.get ('realm', 'ssl_vpn')
         )
+    cmd.add_argument \
+        ( '--rsa-cache'
+        , help    = 'Cache RSA parameters and login form in this file,'
+                    ' this saves two requests on login, default="%(default)s"'
+        , default = cfg.get ('rsa_cache', None)
+        )
+    cmd.add_argument \
+        ( '--rsa-cache-ttl'
+        , help    = 'Seconds the RSA cache is valid, default=%(default)s'
+        , type    = int
+        , default = int (cfg.get ('rsa_cache_ttl', 86400))
+        )
+    cmd.add_argument \
+        ( '--rsa-cache-validate'
+        , help    = 'When the RSA cache is expired ask the portal if the'
+                    ' RSA parameters changed instead of loading the login'
+                    ' page'
+        , action  = 'store_true'
+        , default = cfg.get ('rsa_cache_validate', False)
+        )
     cmd.add_argument \
         ( '-s', '--save-cookies'
         , help    = 'Save cookies to %(cookiefile)s, might be a security risk,'
@@ -499,6 +1980,83 @@ def main () :
                     ' want a full path here'
         , default = cfg.get ('snxpath', 'snx')
         )
+    cmd.add_argument \
+        ( '--session-store'
+        , help    = 'SQLite database keeping cookies and snx info of all'
+                    ' profiles (host, realm, user), used instead of'
+                    ' --cookiefile and --snx-info-file, default=%(default)s'
+        , default = cfg.get ('session_store')
+        )
+    cmd.add_argument \
+        ( '--session-ttl'
+        , help    = 'Seconds session cookies are kept in the session'
+                    ' store, default=%(default)s'
+        , type    = int
+        , default = int (cfg.get ('session_ttl', 86400))
+        )
+    cmd.add_argument \
+        ( '--snx-info-file'
+        , help    = 'File for saving snx connection info for warm'
+                    ' reconnect, default="%(default)s"'
+        , default = infofile
+        )
+    cmd.add_argument \
+        ( '--snx-info-ttl'
+        , help    = 'Seconds the saved snx connection info is used,'
+                    ' default=%(default)s'
+        , type    = int
+        , default = int (cfg.get ('snx_info_ttl', 3600))
+        )
+    cmd.add_argument \
+        ( '--snx-reap'
+        , help    = 'Terminate an snx that is already running (with'
+                    ' "snx -d") before starting snx, otherwise we refuse'
+                    ' to connect'
+        , action  = 'store_true'
+        , default = cfg.get ('snx_reap', False)
+        )
+    cmd.add_argument \
+        ( '--snx-ready-timeout'
+        , help    = 'Seconds to wait for snx to listen after it is'
+                    ' started, default=%(default)s'
+        , type    = float
+        , default = float (cfg.get ('snx_ready_timeout', 5))
+        )
+    cmd.add_argument \
+        ( '--snx-timeout'
+        , help    = 'Seconds to wait for the answer of snx, it answers'
+                    ' after the VPN is established (which may wait for'
+                    ' the gateway or an MFA push), 0 to wait without a'
+                    ' timeout, default=%(default)s'
+        , type    = float
+        , default = float (cfg.get ('snx_timeout', 0))
+        )
+    cmd.add_argument \
+        ( '--status-socket'
+        , help    = 'Unix socket reporting the state when supervising'
+        , default = cfg.get ('status_socket', None)
+        )
+    cmd.add_argument \
+        ( '--supervise'
+        , help    = 'Keep running and reconnect when snx terminates'
+        , action  = 'store_true'
+        , default = cfg.get ('supervise', False)
+        )
+    cmd.add_argument \
+        ( '-T', '--timeout'
+        , help    = 'Timeout in seconds for each stage of the login,'
+                    ' default=%(default)s'
+        , type    = float
+        , default = float (cfg.get ('timeout', 10))
+        )
+    cmd.add_argument \
+        ( '--trace'
+        , help    = 'Append timing of each stage (DNS, connect, requests,'
+                    ' parsing, snx) as JSON lines to this file, use'
+                    ' /dev/fd/N to write to an open file descriptor,'
+                    ' default=%(default)s'
+        , default = cfg.get ('trace')
+        )
     cmd.add_argument \
         ( '-U', '--username'
         , help    = 'Login username, default="%(default)s"'
@@ -525,6 +2083,21 @@ def main () :
         , action='store_true'
         , default = cfg.get ('skip_cert', False)
         )
+    cmd.add_argument \
+        ( '-W', '--warm-reconnect'
+        , help    = 'Save the snx connection info and pass it directly'
+                    ' to snx on the next start, login only if snx'
+                    ' rejects it. Might be a security risk, default is off'
+        , action  = 'store_true'
+        , default = cfg.get ('warm_reconnect', False)
+        )
+    cmd.add_argument \
+        ( '--workers'
+        , help    = 'Number of parallel logins with --batch,'
+                    ' default=%(default)s'
+        , type    = int
+        , default = int (cfg.get ('workers', 8))
+        )
     cmd.add_argument \
         ( '--use-host-as-gw'
         , help    = 'Use host as connection gateway'
@@ -532,13 +2105,62 @@ def main () :
         , default = cfg.get ('use_host_as_gw', False)
         )
 
+    return cmd
+# end def option_parser
+
+def main () :
+    cmd  = option_parser ()
     args = cmd.parse_args ()
     if args.version :
         print ("snxconnect version %s by Ralf Schlatterbeck" % VERSION)
         sys.exit (0)
+    from snxlog import setup_logging, logger
+    try :
+        setup_logging (args)
+    except (ValueError, EnvironmentError) as err :
+        cmd.error ('logging: %s' % err)
+    if args.hold == 'exec' :
+        for opt in \
+            ( 'supervise', 'keepalive', 'probe'
+            , 'metrics_file', 'metrics_listen'
+            ) :
+            if getattr (args, opt) :
+                cmd.error \
+                    ( '--hold exec cannot be used with --%s'
+                    % opt.replace ('_', '-')
+                    )
+    if args.otp_provider :
+        from snxotp import parse_provider
+        try :
+            parse_provider (args.otp_provider)
+        except ValueError as err :
+            cmd.error (str (err))
+    requester = HTML_Requester
+    if args.async_login :
+        from snxasync import Async_HTML_Requester as requester
+    if args.batch :
+        from snxbatch import run_batch
+        sys.exit (run_batch (args, requester) > 0)
+    resolver = None
+    if args.gateways :
+        from snxgateway import select_gateway
+        from snxhttp    import make_resolver
+        from snxtrace   import open_tracer
+        context = None
+        if args.protocol == 'https' :
+            context = ssl_context (args.skip_cert)
+        resolver  = make_resolver (args, open_tracer (args.trace))
+        args.host = select_gateway (args, context, resolver)
+        if not args.host :
+            logger ('gateway').error ("No gateway is reachable")
+            sys.exit (1)
+        logger ('gateway').info ("Using gateway %s" % args.host)
+    if not args.host :
+        cmd.error ('the following arguments are required: -H/--host')
 
     # If absent, retrive username or password from netrc
     if not args.username or not args.password :
+        from netrc import netrc, NetrcParseError
         n = a = None
         try :
             n = netrc ()
@@ -554,10 +2176,20 @@ def main () :
                 args.password = pw
 
     # Proceed with login emulation on portal
-    rq = HTML_Requester (args)
-    result = rq.login ()
-    if result :
-        rq.call_snx ()
+    rq = requester (args, resolver = resolver)
+    if args.supervise :
+        from snxsupervise import Supervisor
+        Supervisor (rq).run ()
+        return
+    # Fail early instead of after a (possibly interactive) login
+    if not rq.clear_snx_port () :
+        sys.exit (1)
+    sock = rq.connect_snx ()
+    if sock :
+        rq.call_snx (sock)
+    # A degraded tunnel is an error, e.g., for a restart by systemd
+    if rq.drop_cause :
+        sys.exit (1)
 # end def main ()
 
 if __name__ == '__main__' :
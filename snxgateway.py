@@ -0,0 +1,274 @@
+#!/usr/bin/python
+
+""" Selection of the portal/gateway when several are configured: All
+    gateways are probed concurrently, we measure the TCP connect time,
+    the TLS handshake and the time until the portal answers the first
+    request. The result is combined with the history of earlier probes
+    (kept in a JSON file) so that gateways that performed well in the
+    past are preferred.
+"""
+
+from __future__        import print_function, unicode_literals
+import json
+import time
+import socket
+import threading
+
+class Probe_Result (object) :
+    """ Timing of a probe, all times in seconds """
+
+    def __init__ (self, host) :
+        self.host     = host
+        self.connect  = None
+        self.tls      = None
+        self.response = None
+        self.status   = None
+        self.error    = None
+    # end def __init__
+
+    @property
+    def ok (self) :
+        return self.error is None and self.status is not None \
+            and self.status < 500
+    # end def ok
+
+    @property
+    def total (self) :
+        return (self.connect or 0) + (self.tls or 0) + (self.response or 0)
+    # end def total
+
+    def __str__ (self) :
+        if not self.ok :
+            return "%s: failed (%s)" % (self.host, self.error or self.status)
+        return "%s: connect %.1fms tls %.1fms response %.1fms" \
+            % ( self.host, self.connect * 1e3, (self.tls or 0) * 1e3
+              , self.response * 1e3
+              )
+    # end def __str__
+
+# end class Probe_Result
+
+def probe \
+    ( host, protocol = 'https', path = '', timeout = 10, context = None
+    , resolver = None
+    ) :
+    """ Probe a portal, host may contain a port, IPv6 addresses are in
+        brackets. Blocking, this is run in a thread per gateway by
+        probe_all. The host is resolved with the resolver of the login
+        (if given) so that the probed address is the one used later.
+    >>> srv = socket.socket (socket.AF_INET6, socket.SOCK_STREAM)
+    >>> srv.bind (('::1', 0))
+    >>> srv.listen (1)
+    >>> def answer () :
+    ...     conn, addr = srv.accept ()
+    ...     data = conn.recv (1024)
+    ...     conn.sendall (b'HTTP/1.0 200 OK\\r\\n\\r\\n')
+    ...     conn.close ()
+    >>> t = threading.Thread (target = answer)
+    >>> t.start ()
+    >>> r = probe ('[::1]:%d' % srv.getsockname () [1], protocol = 'http')
+    >>> t.join ()
+    >>> srv.close ()
+    >>> r.ok, r.status
+    (True, 200)
+
+    Without a context https is probed with the default certificate
+    checks, a failing handshake is a failed probe:
+    >>> srv = socket.socket ()
+    >>> srv.bind (('127.0.0.1', 0))
+    >>> srv.listen (1)
+    >>> def answer () :
+    ...     conn, addr = srv.accept ()
+    ...     conn.sendall (b'HTTP/1.0 200 OK\\r\\n\\r\\n')
+    ...     conn.close ()
+    >>> t = threading.Thread (target = answer)
+    >>> t.start ()
+    >>> r = probe ('127.0.0.1:%d' % srv.getsockname () [1])
+    >>> t.join ()
+    >>> srv.close ()
+    >>> r.ok, r.connect is not None, r.error is not None
+    (False, True, True)
+    """
+    import ssl
+    from snxhttp import split_host, Resolver
+    r = Probe_Result (host)
+    hostname, port = split_host (host, 443 if protocol == 'https' else 80)
+    if resolver is None :
+        resolver = Resolver ()
+    if protocol == 'https' and context is None :
+        context = ssl.create_default_context ()
+    sock = None
+    try :
+        start = time.time ()
+        sock  = resolver.create_connection ((hostname, port), timeout)
+        r.connect = time.time () - start
+        if protocol == 'https' :
+            start = time.time ()
+            sock  = context.wrap_socket (sock, server_hostname = hostname)
+            r.tls = time.time () - start
+        rq = 'GET /%s HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n\r\n' \
+           % (path, host)
+        start = time.time ()
+        sock.sendall (rq.encode ('ascii'))
+        line = sock.recv (1024).split (b'\r\n', 1) [0]
+        r.response = time.time () - start
+        r.status   = int (line.split () [1])
+    except (socket.error, ValueError, IndexError) as err :
+        r.error = str (err) or err.__class__.__name__
+    finally :
+        if sock :
+            sock.close ()
+    return r
+# end def probe
+
+def probe_all (hosts, **kw) :
+    """ Probe all hosts concurrently, returns results in order of hosts
+    """
+    results = {}
+    def run (host) :
+        results [host] = probe (host, **kw)
+    threads = [threading.Thread (target = run, args = (h,)) for h in hosts]
+    for t in threads :
+        t.daemon = True
+        t.start ()
+    for t in threads :
+        t.join ()
+    return [results [h] for h in hosts]
+# end def probe_all
+
+class Gateway_History (object) :
+    """ Scored history of the gateways: We keep an exponentially
+        weighted moving average of the probe latency and the number of
+        consecutive failures per gateway.
+    >>> h = Gateway_History ()
+    >>> a, b = Probe_Result ('a'), Probe_Result ('b')
+    >>> a.connect, a.response, a.status = 0.010, 0.050, 200
+    >>> b.connect, b.response, b.status = 0.020, 0.030, 200
+    >>> h.best ([a, b]).host
+    'b'
+
+    A gateway that was slow in the past is penalized, a failing
+    gateway is never selected:
+    >>> h.entries ['b'] = dict (latency = 0.5, failures = 0)
+    >>> h.best ([a, b]).host
+    'a'
+    >>> a.error = 'Connection refused'
+    >>> h.best ([a, b]).host
+    'b'
+    >>> b.status = 503
+    >>> print (h.best ([a, b]))
+    None
+    >>> h.update ([a, b])
+    >>> h.entries ['a']
+    {'failures': 1}
+    >>> h.entries ['b'] ['failures']
+    1
+    """
+
+    alpha = 0.3
+
+    def __init__ (self, filename = None) :
+        self.filename = filename
+        self.entries  = {}
+        if filename :
+            try :
+                with open (filename, 'r') as f :
+                    self.entries = json.load (f)
+            except (IOError, OSError, ValueError) :
+                pass
+    # end def __init__
+
+    def best (self, results) :
+        """ Return the best healthy result or None """
+        ok = [r for r in results if r.ok]
+        if not ok :
+            return None
+        return min (ok, key = self.score)
+    # end def best
+
+    def save (self) :
+        if self.filename :
+            from snxconnect import write_private
+            write_private (self.filename, json.dumps (self.entries))
+    # end def save
+
+    def score (self, result) :
+        """ Lower is better: The current latency is averaged with the
+            history, recent failures are penalized.
+        """
+        e = self.entries.get (result.host, {})
+        latency = result.total
+        if 'latency' in e :
+            latency = (latency + e ['latency']) / 2.0
+        return latency * (1 + e.get ('failures', 0))
+    # end def score
+
+    def update (self, results) :
+        for r in results :
+            e = self.entries.setdefault (r.host, {})
+            if r.ok :
+                e ['failures'] = 0
+                if 'latency' in e :
+                    e ['latency'] = \
+                        self.alpha * r.total + (1 - self.alpha) * e ['latency']
+                else :
+                    e ['latency'] = r.total
+            else :
+                e ['failures'] = e.get ('failures', 0) + 1
+    # end def update
+
+# end class Gateway_History
+
+def select_gateway (args, context = None, resolver = None) :
+    """ Probe the gateways in args.gateways and return the best one,
+        the resolver should be passed on to the login.
+    >>> import threading
+    >>> try :
+    ...     from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    ... except ImportError :
+    ...     from http.server    import HTTPServer, BaseHTTPRequestHandler
+    >>> class Handler (BaseHTTPRequestHandler) :
+    ...     def do_GET (self) :
+    ...         self.send_response (200)
+    ...         self.end_headers ()
+    ...     def log_message (self, *args) :
+    ...         pass
+    >>> srv = HTTPServer (('127.0.0.1', 0), Handler)
+    >>> t = threading.Thread (target = srv.serve_forever)
+    >>> t.daemon = True
+    >>> t.start ()
+    >>> dead = socket.socket ()
+    >>> dead.bind (('127.0.0.1', 0))
+    >>> good = '127.0.0.1:%d' % srv.server_address [1]
+    >>> bad  = '127.0.0.1:%d' % dead.getsockname () [1]
+    >>> class Args (object) :
+    ...     gateways = ','.join ((bad, good))
+    ...     gateway_history = None
+    ...     protocol = 'http'
+    ...     file = 'sslvpn/Login/Login'
+    ...     timeout = 5
+    ...     debug = False
+    >>> select_gateway (Args ()) == good
+    True
+    >>> srv.shutdown ()
+    >>> dead.close ()
+    """
+    hosts   = [h.strip () for h in args.gateways.split (',') if h.strip ()]
+    history = Gateway_History (args.gateway_history)
+    results = probe_all \
+        ( hosts
+        , protocol = args.protocol
+        , path     = args.file
+        , timeout  = args.timeout
+        , context  = context
+        , resolver = resolver
+        )
+    best = history.best (results)
+    history.update (results)
+    history.save ()
+    from snxlog import logger
+    for r in results :
+        logger ('gateway').debug ("probe %s" % r)
+    if best :
+        return best.host
+# end def select_gateway
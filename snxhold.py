@@ -0,0 +1,147 @@
+#!/usr/bin/python
+
+""" Holding the tunnel after the connection info was handed to snx
+    (--hold): With 'lean' the requester releases the state of the login
+    and returns the freed memory to the OS. With 'exec' the process is
+    replaced by a minimal watcher, this module run by python without
+    site packages, which inherits the control socket of snx and only
+    waits until snx closes it. The pid stays the same, so a service
+    manager still sees the process. This module must not import more
+    than the watcher needs, its report is logged by a child process.
+"""
+
+from __future__        import print_function
+import os
+import sys
+import errno
+
+# The options of snxconnect needed by snxlog.setup_logging
+log_options = \
+    ('debug', 'log', 'log_format', 'log_level', 'log_max_bytes', 'log_backups')
+
+def rss_kb (pid = 'self') :
+    """ Current resident set size in kB from /proc, None without /proc
+    >>> rss_kb () > 0, rss_kb (pid = 'nonexisting')
+    (True, None)
+    """
+    try :
+        with open ('/proc/%s/status' % pid) as f :
+            for line in f :
+                if line.startswith ('VmRSS:') :
+                    return int (line.split () [1])
+    except (IOError, OSError, ValueError) :
+        pass
+    return None
+# end def rss_kb
+
+def trim_memory () :
+    """ Collect garbage and give free heap memory back to the OS, the
+        latter only works with glibc.
+    """
+    import gc
+    gc.collect ()
+    try :
+        import ctypes
+        ctypes.CDLL ('libc.so.6').malloc_trim (0)
+    except (ImportError, OSError, AttributeError) :
+        pass
+# end def trim_memory
+
+def exec_watcher (sock, args) :
+    """ Replace this process by the watcher for the control socket
+        sock, the RSS before and the logging options in args are passed
+        for the report of the watcher. Returns only if the exec fails
+        (with an OSError).
+    """
+    import json
+    fd = sock.fileno ()
+    if hasattr (os, 'set_inheritable') :
+        os.set_inheritable (fd, True)
+    options = dict ((k, getattr (args, k)) for k in log_options)
+    argv = \
+        [ sys.executable, '-S', '-E', os.path.abspath (__file__)
+        , '%d' % fd, '%d' % (rss_kb () or 0), json.dumps (options)
+        ]
+    sys.stdout.flush ()
+    sys.stderr.flush ()
+    os.execv (sys.executable, argv)
+# end def exec_watcher
+
+def watch (fd) :
+    """ Block until the peer closes the socket fd
+    >>> import socket
+    >>> a, b = socket.socketpair ()
+    >>> n = a.send (b'x')
+    >>> a.close ()
+    >>> watch (b.fileno ())
+    >>> b.close ()
+    """
+    while True :
+        try :
+            data = os.read (fd, 4096)
+        except OSError as err :
+            if err.errno == errno.EINTR :
+                continue
+            raise
+        if not data :
+            return
+# end def watch
+
+def report (options, before, after) :
+    """ Log the RSS of the watcher like snxconnect would, with the
+        logging options passed by exec_watcher. This is done by a child
+        process, so the watcher does not keep the logging modules.
+    >>> import json, tempfile
+    >>> fd, fn = tempfile.mkstemp ()
+    >>> os.close (fd)
+    >>> options = dict \\
+    ...     ( debug = False, log = fn, log_format = 'json', log_level = None
+    ...     , log_max_bytes = 4096, log_backups = 0
+    ...     )
+    >>> report (json.dumps (options), 4711, 815)
+    >>> with open (fn) as f :
+    ...     d = json.loads (f.read ())
+    >>> print (d ['msg'])
+    Holding tunnel in watcher: RSS 4711 kB before, 815 kB after
+    >>> d ['logger'], d ['rss_before_kb'], d ['rss_after_kb']
+    ('snxconnect.snx', 4711, 815)
+    >>> os.unlink (fn)
+    """
+    pid = os.fork ()
+    if pid :
+        os.waitpid (pid, 0)
+        return
+    status = 1
+    try :
+        import json
+        from argparse import Namespace
+        from snxlog   import setup_logging, stop_logging, logger
+        setup_logging (Namespace (**json.loads (options)))
+        logger ('snx').info \
+            ( "Holding tunnel in watcher: RSS %d kB before, %s kB after"
+            % (before, after)
+            , extra = dict
+                (fields = dict (rss_before_kb = before, rss_after_kb = after))
+            )
+        stop_logging ()
+        status = 0
+    finally :
+        os._exit (status)
+# end def report
+
+def main (argv) :
+    """ The watcher: argv is the fd of the control socket, the RSS
+        before the exec and the logging options as JSON.
+    """
+    fd     = int (argv [1])
+    before = int (argv [2])
+    report (argv [3], before, rss_kb ())
+    try :
+        watch (fd)
+    except KeyboardInterrupt :
+        return 1
+    return 0
+# end def main
+
+if __name__ == '__main__' :
+    sys.exit (main (sys.argv))
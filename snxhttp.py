@@ -0,0 +1,870 @@
+#!/usr/bin/python
+
+""" HTTP transport and page parsing for snxconnect: A keep-alive
+    connection pool plugged into urllib and a streaming scraper for the
+    portal pages. This is imported only when we talk to the portal.
+"""
+
+from __future__        import print_function, unicode_literals
+import errno
+import socket
+import threading
+import time
+import zlib
+try :
+    from urllib2 import build_opener, HTTPCookieProcessor, Request
+    from urllib2 import HTTPHandler, HTTPSHandler, URLError, HTTPError
+    from urllib  import urlencode
+    from httplib import IncompleteRead, HTTPException
+    from httplib import HTTPConnection, HTTPSConnection
+    from httplib import BadStatusLine as RemoteDisconnected
+except ImportError :
+    from urllib.request import build_opener, HTTPCookieProcessor, Request
+    from urllib.request import HTTPHandler, HTTPSHandler
+    from urllib.error   import URLError, HTTPError
+    from urllib.parse   import urlencode
+    from http.client    import IncompleteRead, HTTPException
+    from http.client    import HTTPConnection, HTTPSConnection
+    from http.client    import RemoteDisconnected
+try :
+    from cookielib import LWPCookieJar, Cookie
+except ImportError :
+    from http.cookiejar import LWPCookieJar, Cookie
+try :
+    from HTMLParser import HTMLParser
+except ImportError :
+    from html.parser import HTMLParser
+from snxtrace          import Null_Tracer
+
+# The urllib and cookie names are re-exported, so other modules do not
+# repeat the py2/py3 import shim above.
+__all__ = \
+    [ 'split_host', 'Resolver', 'make_resolver', 'Pooled_Response'
+    , 'Response_Too_Large', 'Decoded_Response', 'Connection_Stat', 'TLS_Connection'
+    , 'Connection_Pool', 'Keepalive_Handler', 'Element', 'Page_Scraper'
+    , 'Response'
+    , 'build_opener', 'HTTPCookieProcessor', 'Request', 'HTTPError'
+    , 'HTTPException', 'urlencode', 'LWPCookieJar', 'Cookie'
+    ]
+
+def split_host (host, port = None) :
+    """ Split optional port from host
+    >>> split_host ('vpn.example.com', 443)
+    ('vpn.example.com', 443)
+    >>> split_host ('vpn.example.com:8443', 443)
+    ('vpn.example.com', 8443)
+    >>> split_host ('[2001:db8::1]:8443')
+    ('2001:db8::1', 8443)
+    """
+    if host.startswith ('[') :
+        h, sep, rest = host [1:].partition (']')
+        if rest.startswith (':') :
+            port = int (rest [1:])
+        return h, port
+    if host.count (':') == 1 :
+        h, p = host.split (':')
+        return h, int (p)
+    return host, port
+# end def split_host
+
+class Resolver (object) :
+    """ Caching DNS resolver: Lookups can be started in the background
+        with prefetch, results are cached for ttl seconds. Addresses are
+        sorted so that the preferred family (socket.AF_INET or
+        socket.AF_INET6) comes first, family 0 keeps the order of
+        getaddrinfo. Lookups for a specific family can be requested,
+        e.g., snx needs an IPv4 address of the gateway.
+    >>> r = Resolver (ttl = 60, prefer = socket.AF_INET)
+    >>> r.prefetch ('127.0.0.1')
+    >>> r.resolve ('127.0.0.1')
+    '127.0.0.1'
+    >>> r.resolve ('127.0.0.1', socket.AF_INET)
+    '127.0.0.1'
+    >>> r.resolve (b'127.0.0.1', socket.AF_INET)
+    '127.0.0.1'
+    """
+
+    def __init__ (self, ttl = 300, prefer = 0, tracer = None) :
+        self.ttl     = ttl
+        self.prefer  = prefer
+        self.tracer  = tracer or Null_Tracer ()
+        self.cache   = {}
+        self.pending = {}
+        self.lock    = threading.Lock ()
+    # end def __init__
+
+    def addresses (self, host, family = 0) :
+        """ Return list of addresses of host, blocks until a running
+            lookup is finished. Raises socket.error if the lookup fails.
+        """
+        if isinstance (host, bytes) :
+            host = host.decode ('ascii')
+        key = (host, family)
+        with self.lock :
+            entry = self.cache.get (key)
+            if entry and entry [0] > time.time () :
+                return entry [1]
+            ev = self.pending.get (key)
+        if ev :
+            ev.wait ()
+            with self.lock :
+                entry = self.cache.get (key)
+            if entry and entry [0] > time.time () :
+                return entry [1]
+        return self.lookup (host, family)
+    # end def addresses
+
+    def lookup (self, host, family = 0) :
+        """ Do the lookup and cache the result """
+        with self.tracer.span ('dns', host = host, family = family) :
+            infos = socket.getaddrinfo \
+                (host, None, family, socket.SOCK_STREAM)
+        addrs = []
+        for fam, t, p, c, sa in infos :
+            if sa [0] not in addrs :
+                addrs.append (sa [0])
+        if self.prefer and not family :
+            fams = dict ((sa [0], fam) for fam, t, p, c, sa in infos)
+            addrs.sort (key = lambda a: fams [a] != self.prefer)
+        with self.lock :
+            self.cache [(host, family)] = (time.time () + self.ttl, addrs)
+        return addrs
+    # end def lookup
+
+    def prefetch (self, host, family = 0) :
+        """ Start lookup in the background, errors are ignored here,
+            they are reported when the address is really needed.
+        """
+        if isinstance (host, bytes) :
+            host = host.decode ('ascii')
+        key = (host, family)
+        with self.lock :
+            entry = self.cache.get (key)
+            if key in self.pending or entry and entry [0] > time.time () :
+                return
+            self.pending [key] = ev = threading.Event ()
+        def run () :
+            try :
+                self.lookup (host, family)
+            except socket.error :
+                pass
+            finally :
+                with self.lock :
+                    del self.pending [key]
+                ev.set ()
+        t = threading.Thread (target = run)
+        t.daemon = True
+        t.start ()
+    # end def prefetch
+
+    def resolve (self, host, family = 0) :
+        return self.addresses (host, family) [0]
+    # end def resolve
+
+    def create_connection (self, address, timeout = None, source = None) :
+        """ Replacement for socket.create_connection using our cache,
+            the addresses are tried in order.
+        """
+        host, port = address
+        err = None
+        for addr in self.addresses (host) :
+            try :
+                with self.tracer.span ('tcp', address = addr, port = port) :
+                    return socket.create_connection \
+                        ((addr, port), timeout, source)
+            except socket.error as e :
+                err = e
+        raise err
+    # end def create_connection
+
+# end class Resolver
+
+def make_resolver (args, tracer = None) :
+    """ Resolver configured by the --dns-ttl and --prefer options
+    >>> class Args (object) :
+    ...     dns_ttl = 60
+    ...     prefer  = 'ipv6'
+    >>> r = make_resolver (Args ())
+    >>> r.ttl, r.prefer == socket.AF_INET6
+    (60, True)
+    """
+    prefer = dict \
+        (ipv4 = socket.AF_INET, ipv6 = socket.AF_INET6).get (args.prefer)
+    return Resolver (args.dns_ttl, prefer or 0, tracer)
+# end def make_resolver
+
+class Pooled_Response (object) :
+    """ Wrap a response from a pooled connection: The connection is
+        given back to the pool when the response has been read
+        completely, it is discarded if the response is closed early.
+        Provides the interface urllib expects from its responses.
+    """
+
+    def __init__ (self, pool, key, conn, response, url, stat) :
+        self.pool     = pool
+        self.key      = key
+        self.conn     = conn
+        self.response = response
+        self.url      = url
+        self.stat     = stat
+        self.reused   = stat.reused
+        self.code     = self.status = response.status
+        self.msg      = response.reason
+        self.headers  = response.msg
+    # end def __init__
+
+    def __iter__ (self) :
+        while True :
+            line = self.readline ()
+            if not line :
+                break
+            yield line
+    # end def __iter__
+
+    def close (self) :
+        if self.conn is None :
+            return
+        if self.response.isclosed () and not self.response.will_close :
+            self.pool.put (self.key, self.conn)
+        else :
+            self.conn.close ()
+        self.conn = None
+    # end def close
+
+    def geturl (self) :
+        return self.url
+    # end def geturl
+
+    def getcode (self) :
+        return self.code
+    # end def getcode
+
+    def info (self) :
+        return self.headers
+    # end def info
+
+    def read (self, *args) :
+        try :
+            return self.response.read (*args)
+        finally :
+            if self.response.isclosed () :
+                self.close ()
+    # end def read
+
+    def readline (self, *args) :
+        line = self.response.readline (*args)
+        if self.response.isclosed () :
+            self.close ()
+        return line
+    # end def readline
+
+# end class Pooled_Response
+
+class Response_Too_Large (HTTPException) :
+    pass
+# end class Response_Too_Large
+
+class Decoded_Response (object) :
+    """ Read a response decoding its Content-Encoding (gzip or deflate)
+        while streaming, at most chunksize bytes are decompressed at a
+        time. Bytes on the wire (after the chunked transfer encoding)
+        and decoded bytes are counted, if more than max_size bytes are
+        decoded Response_Too_Large is raised, so a huge page (or a
+        compression bomb) does not exhaust our memory. An incomplete
+        read ends the body: the partial data is decoded and returned,
+        incomplete is set. When the body has been read, done is called
+        with the response.
+    >>> import io, gzip
+    >>> class F (io.BytesIO) :
+    ...     def __init__ (self, data, enc) :
+    ...         io.BytesIO.__init__ (self, data)
+    ...         self.headers = {'Content-Encoding': enc}
+    ...     def info (self) :
+    ...         return self.headers
+    >>> body = b'var modulus = 1;\\n' * 1000
+    >>> buf = io.BytesIO ()
+    >>> with gzip.GzipFile (fileobj = buf, mode = 'wb') as g :
+    ...     g.write (body) and None
+    >>> r = Decoded_Response (F (buf.getvalue (), 'gzip'))
+    >>> r.readline (), r.read () == body [17:], r.wire < 200, r.decoded
+    (b'var modulus = 1;\\n', True, True, 17000)
+    >>> r.incomplete, r.encoding
+    (False, 'gzip')
+    >>> raw = zlib.compressobj (9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    >>> data = raw.compress (body) + raw.flush ()
+    >>> r = Decoded_Response (F (data, 'deflate'), chunksize = 100)
+    >>> sum (1 for line in r), r.decoded
+    (1000, 17000)
+    >>> r = Decoded_Response (F (buf.getvalue () [:-20], 'gzip'))
+    >>> len (r.read ()) < 17000, r.incomplete
+    (True, True)
+    >>> f = F (buf.getvalue (), 'gzip')
+    >>> def partial (n) :
+    ...     raise IncompleteRead (buf.getvalue () [:-8])
+    >>> f.read = partial
+    >>> r = Decoded_Response (f, chunksize = 100)
+    >>> r.read () == body, r.incomplete
+    (True, True)
+    >>> try :
+    ...     Decoded_Response (F (buf.getvalue (), 'gzip'), 1000).read ()
+    ... except Response_Too_Large as err :
+    ...     print (err)
+    response exceeds 1000 bytes
+    """
+
+    def __init__ (self, f, max_size = None, chunksize = 8192, done = None) :
+        self.f          = f
+        self.max_size   = max_size
+        self.chunksize  = chunksize
+        self.done       = done
+        self.wire       = 0
+        self.decoded    = 0
+        self.incomplete = False
+        self.ended      = False
+        self.eof        = False
+        self.buffer     = b''
+        headers         = f.info ()
+        self.encoding   = headers.get ('Content-Encoding', '').strip ().lower ()
+        self.dec        = None
+        if self.encoding in ('gzip', 'x-gzip', 'deflate') :
+            # Automatic header detection accepts gzip and zlib, we fall
+            # back to raw deflate (sent by some servers) on error
+            self.dec = zlib.decompressobj (32 + zlib.MAX_WBITS)
+        elif max_size :
+            length = headers.get ('Content-Length')
+            if length and length.isdigit () and int (length) > max_size :
+                raise Response_Too_Large \
+                    ("response exceeds %d bytes" % max_size)
+    # end def __init__
+
+    def __iter__ (self) :
+        while True :
+            line = self.readline ()
+            if not line :
+                break
+            yield line
+    # end def __iter__
+
+    def close (self) :
+        self.f.close ()
+    # end def close
+
+    def decompress (self, data) :
+        try :
+            return self.dec.decompress (data, self.chunksize)
+        except zlib.error as err :
+            if self.wire > len (data) or self.encoding != 'deflate' :
+                raise HTTPException ("bad %s data: %s" % (self.encoding, err))
+            self.dec = zlib.decompressobj (-zlib.MAX_WBITS)
+            return self.decompress (data)
+    # end def decompress
+
+    def fill (self) :
+        """ Add the next decoded chunk to the buffer, set eof at the end
+        """
+        if self.dec and self.dec.unconsumed_tail :
+            data = self.decompress (self.dec.unconsumed_tail)
+        else :
+            try :
+                raw = self.f.read (self.chunksize)
+            except IncompleteRead as err :
+                raw = err.partial
+                self.incomplete = True
+            self.wire += len (raw)
+            data = raw
+            if self.dec :
+                data = self.decompress (raw)
+                if not raw :
+                    data = self.dec.flush ()
+                    if not getattr (self.dec, 'eof', True) :
+                        self.incomplete = True
+            self.ended = not raw or self.incomplete
+        self.eof = self.ended and not (self.dec and self.dec.unconsumed_tail)
+        self.decoded += len (data)
+        if self.max_size and self.decoded > self.max_size :
+            self.close ()
+            raise Response_Too_Large \
+                ("response exceeds %d bytes" % self.max_size)
+        self.buffer += data
+        if self.eof and self.done :
+            done, self.done = self.done, None
+            done (self)
+    # end def fill
+
+    def geturl (self) :
+        return self.f.geturl ()
+    # end def geturl
+
+    def getcode (self) :
+        return self.f.getcode ()
+    # end def getcode
+
+    def info (self) :
+        return self.f.info ()
+    # end def info
+
+    def read (self, n = -1) :
+        if n is None or n < 0 :
+            while not self.eof :
+                self.fill ()
+            n = len (self.buffer)
+        while not self.buffer and not self.eof :
+            self.fill ()
+        data, self.buffer = self.buffer [:n], self.buffer [n:]
+        return data
+    # end def read
+
+    def readline (self) :
+        while b'\n' not in self.buffer and not self.eof :
+            self.fill ()
+        n = self.buffer.find (b'\n') + 1 or len (self.buffer)
+        return self.read (n)
+    # end def readline
+
+# end class Decoded_Response
+
+class Connection_Stat (object) :
+    """ Statistics of one request done via the Connection_Pool """
+
+    def __init__ (self, method, url, reused, resumed = None) :
+        self.method  = method
+        self.url     = url
+        self.reused  = reused
+        self.resumed = resumed
+    # end def __init__
+
+    def __str__ (self) :
+        """ resumed is None for http and for reused connections
+        >>> print (Connection_Stat ('GET', 'https://vpn/', False, True))
+        GET https://vpn/ (new connection, TLS session resumed)
+        >>> print (Connection_Stat ('GET', 'https://vpn/', False, False))
+        GET https://vpn/ (new connection, full TLS handshake)
+        >>> print (Connection_Stat ('GET', 'http://vpn/', True))
+        GET http://vpn/ (reused connection)
+        """
+        tls = ''
+        if self.resumed is not None :
+            tls = [', full TLS handshake', ', TLS session resumed'] \
+                [self.resumed]
+        return "%s %s (%s connection%s)" \
+            % (self.method, self.url, ['new', 'reused'][self.reused], tls)
+    # end def __str__
+
+# end class Connection_Stat
+
+class TLS_Connection (HTTPSConnection) :
+    """ HTTPS connection that offers the TLS session of an earlier
+        connection to the same host (set by the Connection_Pool). If the
+        server still knows the session the handshake is abbreviated: no
+        certificate is sent and verified and one round-trip is saved.
+        Whether this happened is in sock.session_reused.
+    """
+
+    session = None
+
+    def connect (self) :
+        if self.session is None :
+            return HTTPSConnection.connect (self)
+        HTTPConnection.connect (self)
+        host = self._tunnel_host or self.host
+        self.sock = self._context.wrap_socket \
+            (self.sock, server_hostname = host, session = self.session)
+    # end def connect
+
+# end class TLS_Connection
+
+class Connection_Pool (object) :
+    """ Keep-alive connections by scheme and host. Connections are
+        taken out of the pool while a request is running, so this can
+        be used by concurrent requests. The SSL context of a host is
+        created by calling make_context when the first https connection
+        to it is opened. The TLS session of the last connection to a
+        host is kept and offered when a new connection is opened, e.g.
+        after the portal closed an idle connection or for a reconnect.
+        Sessions are only kept in memory: the ssl module cannot
+        serialize them.
+    >>> try :
+    ...     from http.server import HTTPServer, BaseHTTPRequestHandler
+    ... except ImportError :
+    ...     from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    >>> class Handler (BaseHTTPRequestHandler) :
+    ...     protocol_version = 'HTTP/1.1'
+    ...     def do_GET (self) :
+    ...         if self.path == '/redirect' :
+    ...             self.send_response (302)
+    ...             self.send_header ('Location', '/page')
+    ...             self.send_header ('Content-Length', '0')
+    ...             self.end_headers ()
+    ...             return
+    ...         self.send_response (200)
+    ...         self.send_header ('Content-Length', '2')
+    ...         self.end_headers ()
+    ...         self.wfile.write (b'ok')
+    ...         # Like a server closing an idle keep-alive connection
+    ...         self.close_connection = self.path == '/drop'
+    ...     def log_message (self, *args) :
+    ...         pass
+    >>> srv = HTTPServer (('127.0.0.1', 0), Handler)
+    >>> t = threading.Thread (target = srv.serve_forever)
+    >>> t.daemon = True
+    >>> t.start ()
+    >>> pool = Connection_Pool ()
+    >>> op   = build_opener (Keepalive_Handler (pool))
+    >>> url  = 'http://127.0.0.1:%d/' % srv.server_port
+    >>> def get (path) :
+    ...     pool.collect ()
+    ...     f = op.open (url + path, timeout = 5)
+    ...     body = f.read ()
+    ...     for s in pool.collected () :
+    ...         print (s.url [len (url):], ['new', 'reused'][s.reused])
+    ...     return f.stat is s
+    >>> get ('page')
+    page new
+    True
+
+    A redirect is followed over the same connection:
+    >>> get ('redirect')
+    redirect reused
+    page reused
+    True
+
+    The server closes the connection after /drop, the next request
+    finds the connection closed and is sent again over a new one:
+    >>> get ('drop')
+    drop reused
+    True
+    >>> get ('page')
+    page new
+    True
+    >>> pool.close ()
+    >>> srv.shutdown ()
+    >>> srv.server_close ()
+    """
+
+    def __init__ (self, make_context = None, resolver = None, tracer = None) :
+        self.make_context = make_context
+        self.resolver     = resolver
+        self.tracer       = tracer or Null_Tracer ()
+        self.contexts     = {}
+        self.sessions     = {}
+        self.idle    = {}
+        self.local   = threading.local ()
+        self.lock    = threading.Lock ()
+    # end def __init__
+
+    def close (self) :
+        with self.lock :
+            for conns in self.idle.values () :
+                for conn in conns :
+                    conn.close ()
+            self.idle = {}
+    # end def close
+
+    def get (self, key, timeout) :
+        """ Return a connection and a flag if it is reused """
+        with self.lock :
+            conns = self.idle.get (key)
+            if conns :
+                conn = conns.pop ()
+                conn.timeout = timeout
+                if conn.sock :
+                    conn.sock.settimeout (timeout)
+                return conn, True
+        scheme, host, tunnel = key
+        # With a proxy host is the proxy, TLS is done with the target
+        target = tunnel or host
+        if scheme == 'https' :
+            with self.lock :
+                if target not in self.contexts and self.make_context :
+                    self.contexts [target] = self.make_context ()
+                context = self.contexts.get (target)
+                session = self.sessions.get (target)
+            conn = TLS_Connection (host, timeout = timeout, context = context)
+            conn.session = session
+        else :
+            conn = HTTPConnection (host, timeout = timeout)
+        if self.resolver :
+            # Not used by python2, it resolves the host itself
+            conn._create_connection = self.resolver.create_connection
+        return conn, False
+    # end def get
+
+    def remember (self, key, sock) :
+        """ Keep the TLS session of sock for the next connection to the
+            host. With TLS 1.3 the server sends the session ticket after
+            the handshake, so this is called after the first response.
+        """
+        session = getattr (sock, 'session', None)
+        if session is not None :
+            with self.lock :
+                self.sessions [key [2] or key [1]] = session
+    # end def remember
+
+    def put (self, key, conn) :
+        with self.lock :
+            self.idle.setdefault (key, []).append (conn)
+    # end def put
+
+    def open (self, scheme, req) :
+        """ Send req over a pooled connection (key is scheme, host and
+            the target of a proxy tunnel), this does what urllib's
+            do_open does. A reused connection may have been closed by
+            the server while idle, then the request is sent again over
+            a new connection. This is only done if the server closed the
+            connection without sending a response, so a request is not
+            sent twice when the server has answered or timed out.
+        """
+        tunnel  = getattr (req, '_tunnel_host', None)
+        key     = (scheme, req.host, tunnel)
+        headers = dict (req.unredirected_hdrs)
+        headers.update \
+            ((k, v) for k, v in req.headers.items () if k not in headers)
+        headers ['Connection'] = 'keep-alive'
+        headers = dict ((k.title (), v) for k, v in headers.items ())
+        tunnel_headers = {}
+        if 'Proxy-Authorization' in headers :
+            tunnel_headers ['Proxy-Authorization'] = \
+                headers.pop ('Proxy-Authorization')
+        while True :
+            conn, reused = self.get (key, req.timeout)
+            resumed = None
+            try :
+                if not reused :
+                    if tunnel :
+                        conn.set_tunnel (tunnel, headers = tunnel_headers)
+                    # Includes the CONNECT and TLS handshake for https
+                    with self.tracer.span ('connect', host = req.host) as sp :
+                        conn.connect ()
+                        resumed = getattr (conn.sock, 'session_reused', None)
+                        if resumed is not None :
+                            sp.set (resumed = resumed)
+                # The connection drops its socket if the server closes
+                sock = conn.sock
+                with self.tracer.span ('ttfb', reused = reused) :
+                    conn.request \
+                        (req.get_method (), req.selector, req.data, headers)
+                    r = conn.getresponse ()
+                if resumed is not None :
+                    self.remember (key, sock)
+            except (socket.error, HTTPException) as err :
+                conn.close ()
+                if reused and self.stale (err) :
+                    continue
+                raise URLError (err)
+            break
+        url  = req.get_full_url ()
+        stat = Connection_Stat (req.get_method (), url, reused, resumed)
+        if getattr (self.local, 'stats', None) is not None :
+            self.local.stats.append (stat)
+        return Pooled_Response (self, key, conn, r, url, stat)
+    # end def open
+
+    @staticmethod
+    def stale (err) :
+        """ True if err means that the server had closed the connection
+            before our request: It is closed without a response or the
+            request could not be sent, a timeout is not.
+        >>> Connection_Pool.stale (RemoteDisconnected ('closed'))
+        True
+        >>> Connection_Pool.stale (socket.error (errno.EPIPE, 'pipe'))
+        True
+        >>> Connection_Pool.stale (socket.timeout ('timed out'))
+        False
+        """
+        if isinstance (err, RemoteDisconnected) :
+            return True
+        return getattr (err, 'errno', None) in (errno.EPIPE, errno.ECONNRESET)
+    # end def stale
+
+    def collect (self) :
+        """ Start collecting the Connection_Stat of the requests of the
+            calling thread (including redirects), see collected.
+        """
+        self.local.stats = []
+    # end def collect
+
+    def collected (self) :
+        """ Return and stop collecting the statistics of this thread """
+        stats = getattr (self.local, 'stats', None) or []
+        self.local.stats = None
+        return stats
+    # end def collected
+
+# end class Connection_Pool
+
+class Keepalive_Handler (HTTPHandler, HTTPSHandler) :
+    """ Replaces the urllib handlers for http and https, requests are
+        sent via persistent connections of the Connection_Pool.
+    """
+
+    def __init__ (self, pool) :
+        HTTPHandler.__init__ (self)
+        self.pool = pool
+    # end def __init__
+
+    def http_open (self, req) :
+        return self.pool.open ('http', req)
+    # end def http_open
+
+    def https_open (self, req) :
+        return self.pool.open ('https', req)
+    # end def https_open
+
+    https_request = HTTPHandler.http_request
+
+# end class Keepalive_Handler
+
+class Element (object) :
+    """ An element found by the Page_Scraper """
+
+    def __init__ (self, tag, attrs) :
+        self.tag    = tag
+        self.attrs  = dict ((k, v or '') for k, v in attrs)
+        self.text   = ''
+        self.inputs = []
+    # end def __init__
+
+    def __getitem__ (self, name) :
+        return self.attrs [name]
+    # end def __getitem__
+
+# end class Element
+
+class Page_Scraper (HTMLParser) :
+    """ Incremental parser for portal pages: We only need the script
+        elements, the forms with their input elements and the text of
+        an element with class errorMessage.
+        Data is fed in chunks, the until function is called with the
+        scraper and returns True when everything needed has been found,
+        then the rest of the page is ignored.
+    >>> p = Page_Scraper (until = Page_Scraper.has_extender)
+    >>> p.feed ('<html><script src="/js/RSA.js"></script><form id="f" ')
+    >>> p.feed ('action="/a" method="post"><input name="x" value="1">')
+    >>> p.feed ('</form><span class="big errorMessage">Bad</span><script>')
+    >>> p.done
+    False
+    >>> p.feed ('/* Extender.user_name = "u";</script>')
+    >>> p.done
+    True
+    >>> p.feed ('<p>ignored</p>')
+    >>> [s ['src'] for s in p.scripts if 'src' in s.attrs]
+    ['/js/RSA.js']
+    >>> p.form (id = 'f').inputs [0].attrs
+    {'name': 'x', 'value': '1'}
+    >>> p.error
+    'Bad'
+    >>> p.extender_script ().text
+    '/* Extender.user_name = "u";'
+    >>> p.tags
+    6
+    """
+
+    void = set \
+        (( 'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input'
+         , 'link', 'meta', 'param', 'source', 'track', 'wbr'
+        ))
+
+    def __init__ (self, until = None) :
+        HTMLParser.__init__ (self)
+        self.until   = until
+        self.done    = False
+        self.scripts = []
+        self.forms   = []
+        self.error   = None
+        self.tags    = 0
+        self.text    = None
+        self.form_   = None
+        self.depth   = 0
+    # end def __init__
+
+    def extender_script (self) :
+        for script in self.scripts :
+            if '/* Extender.user_name' in script.text :
+                return script
+    # end def extender_script
+
+    def feed (self, data) :
+        if not self.done :
+            HTMLParser.feed (self, data)
+    # end def feed
+
+    def form (self, **attrs) :
+        """ Return first form matching all given attributes """
+        for form in self.forms :
+            if all (form.attrs.get (k) == v for k, v in attrs.items ()) :
+                return form
+    # end def form
+
+    def handle_data (self, data) :
+        if self.text is not None :
+            self.text.text += data
+    # end def handle_data
+
+    def handle_endtag (self, tag) :
+        if tag == 'script' and self.text is not None :
+            self.text = None
+        elif tag == 'form' :
+            self.form_ = None
+        elif self.depth :
+            self.depth -= 1
+            if not self.depth :
+                self.error = self.text.text.strip ()
+                self.text  = None
+        self.check ()
+    # end def handle_endtag
+
+    def handle_starttag (self, tag, attrs) :
+        self.tags += 1
+        if self.depth :
+            if tag not in self.void :
+                self.depth += 1
+            return
+        e = Element (tag, attrs)
+        if tag == 'script' :
+            self.scripts.append (e)
+            self.text = e
+        elif tag == 'form' :
+            self.forms.append (e)
+            self.form_ = e
+        elif tag == 'input' :
+            if self.form_ :
+                self.form_.inputs.append (e)
+        elif 'errorMessage' in e.attrs.get ('class', '').split () :
+            self.text  = e
+            self.depth = 1
+        self.check ()
+    # end def handle_starttag
+
+    def check (self) :
+        if self.until and not self.done :
+            self.done = bool (self.until (self))
+    # end def check
+
+    @staticmethod
+    def has_extender (scraper) :
+        return scraper.extender_script () is not None
+    # end def has_extender
+
+    @staticmethod
+    def has_login_params (scraper) :
+        """ RSA javascript and login form are both found """
+        return \
+            (   scraper.form (id = 'loginForm')
+            and scraper.form_ is None
+            and any ('RSA' in s.attrs.get ('src', '') for s in scraper.scripts)
+            )
+    # end def has_login_params
+
+# end class Page_Scraper
+
+class Response (object) :
+    """ A page retrieved from the portal, see HTML_Requester.fetch """
+
+    def __init__ (self, f, page = None) :
+        self.f    = f
+        self.page = page
+        self.purl = f.geturl ()
+        self.info = f.info ()
+    # end def __init__
+
+# end class Response
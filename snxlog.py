@@ -0,0 +1,209 @@
+#!/usr/bin/python
+
+""" Logging for snxconnect: Messages go to the loggers
+    snxconnect.<subsystem> (see subsystems) so the level can be set per
+    subsystem, e.g. --log-level info,http=debug. Structured fields are
+    passed as extra = dict (fields = {...}) and written as key=value
+    pairs or JSON. When logging to syslog (with systemd this ends up in
+    the journal) or to a rotating file the records are put into a queue
+    and written by a separate thread, so a slow log target does not
+    block the select loop. Credentials are redacted by the requester
+    before a message is logged (see Redactor), so this also holds for
+    handlers configured by a program using snxclient.
+"""
+
+from __future__        import print_function, unicode_literals
+import os
+import re
+import sys
+import json
+import logging
+from logging           import handlers
+
+subsystems = \
+    ( 'login', 'http', 'parse', 'crypto', 'snx', 'keepalive', 'probe'
+    , 'supervise', 'gateway', 'metrics'
+    )
+
+def logger (subsystem = None) :
+    if subsystem :
+        return logging.getLogger ('snxconnect.' + subsystem)
+    return logging.getLogger ('snxconnect')
+# end def logger
+
+class Redactor (object) :
+    """ Remove credentials from log messages: Values of keys that look
+        like credentials and the secrets returned by the secrets
+        function (e.g. the password, which may appear in a form we
+        don't recognize) are replaced with ***.
+    >>> r = Redactor (lambda : ['s3cret', None])
+    >>> print (r.redact ("extender_vars: {'password': b'otp1', 'user': b'u'}"))
+    extender_vars: {'password': b'***', 'user': b'u'}
+    >>> print (r.redact ('Extender.password = "otp"; Set-Cookie: SID=a; Path=/'))
+    Extender.password = "***"; Set-Cookie: ***; Path=/
+    >>> print (r.redact ('answer s3cret, spinning=1'))
+    answer ***, spinning=1
+    """
+
+    keys = re.compile \
+        ( r'''(\b(?:password|passwd|pin|secret|cookie|snx_info)['"]?'''
+          r'''\s*[:=]\s*b?['"]?)([^'"\s,;&}]+)'''
+        , re.I
+        )
+
+    def __init__ (self, secrets = None) :
+        self.secrets = secrets or (lambda : ())
+    # end def __init__
+
+    def redact (self, text) :
+        for s in self.secrets () :
+            # Very short secrets would mangle the whole message
+            if s and len (s) >= 3 :
+                text = text.replace (s, '***')
+        return self.keys.sub (r'\1***', text)
+    # end def redact
+
+# end class Redactor
+
+def quote (value) :
+    """ Quote a value for key=value output if necessary
+    >>> print (quote ('snx'), quote ('snx ready'), quote (1.5))
+    snx "snx ready" 1.5
+    """
+    value = '%s' % value
+    if not value or re.search (r'[\s"=]', value) :
+        return json.dumps (value)
+    return value
+# end def quote
+
+class KV_Formatter (logging.Formatter) :
+    """ time=... level=info logger=snxconnect.snx msg="..." key=value
+    >>> r = logging.LogRecord \\
+    ...     ('snxconnect.snx', logging.INFO, __file__, 1, 'snx ready', (), None)
+    >>> r.fields = dict (polls = 3)
+    >>> print (KV_Formatter ().format (r).split (' ', 1) [1])
+    level=info logger=snxconnect.snx msg="snx ready" polls=3
+    """
+
+    def format (self, record) :
+        items = \
+            [ ('time',   self.formatTime (record, '%Y-%m-%dT%H:%M:%S'))
+            , ('level',  record.levelname.lower ())
+            , ('logger', record.name)
+            , ('msg',    record.getMessage ())
+            ]
+        items.extend (sorted (getattr (record, 'fields', {}).items ()))
+        return ' '.join ('%s=%s' % (k, quote (v)) for k, v in items)
+    # end def format
+
+# end class KV_Formatter
+
+class JSON_Formatter (logging.Formatter) :
+    """ One JSON object per record
+    >>> r = logging.LogRecord \\
+    ...     ('snxconnect.snx', logging.INFO, __file__, 1, 'snx ready', (), None)
+    >>> r.fields = dict (polls = 3)
+    >>> d = json.loads (JSON_Formatter ().format (r))
+    >>> d ['msg'], d ['level'], d ['polls']
+    ('snx ready', 'info', 3)
+    """
+
+    def format (self, record) :
+        d = dict (getattr (record, 'fields', {}))
+        d.update \
+            ( time   = record.created
+            , level  = record.levelname.lower ()
+            , logger = record.name
+            , msg    = record.getMessage ()
+            )
+        return json.dumps (d, sort_keys = True, default = str)
+    # end def format
+
+# end class JSON_Formatter
+
+queue_listeners = []
+
+formatters = dict \
+    ( plain = lambda : logging.Formatter ('%(message)s')
+    , kv    = KV_Formatter
+    , json  = JSON_Formatter
+    )
+
+def parse_levels (spec) :
+    """ Parse the --log-level option into (logger name, level) pairs
+    >>> parse_levels ('info,http=debug, snx=WARNING')
+    [('snxconnect', 20), ('snxconnect.http', 10), ('snxconnect.snx', 30)]
+    >>> try :
+    ...     parse_levels ('tcp=debug')
+    ... except ValueError as err :
+    ...     print (err)
+    unknown log subsystem: tcp
+    """
+    levels = []
+    for item in (spec or '').split (',') :
+        item = item.strip ()
+        if not item :
+            continue
+        name, sep, level = item.rpartition ('=')
+        if name and name not in subsystems :
+            raise ValueError ("unknown log subsystem: %s" % name)
+        lvl = logging.getLevelName (level.upper ())
+        if not isinstance (lvl, int) :
+            raise ValueError ("unknown log level: %s" % level)
+        levels.append ((logger (name or None).name, lvl))
+    return levels
+# end def parse_levels
+
+def setup_logging (args) :
+    """ Configure the snxconnect loggers from the command line options,
+        the default is plain messages to stdout.
+    """
+    root = logger ()
+    root.propagate = False
+    root.setLevel (logging.DEBUG if args.debug else logging.INFO)
+    for name, level in parse_levels (args.log_level) :
+        logging.getLogger (name).setLevel (level)
+    target = args.log or '-'
+    fmt    = args.log_format or ('plain' if target == '-' else 'kv')
+    if target == '-' :
+        handler = logging.StreamHandler (sys.stdout)
+    elif target == 'syslog' :
+        address = '/dev/log' if os.path.exists ('/dev/log') else None
+        handler = handlers.SysLogHandler \
+            ( address  = address or ('localhost', handlers.SYSLOG_UDP_PORT)
+            , facility = handlers.SysLogHandler.LOG_DAEMON
+            )
+        handler.ident = 'snxconnect[%d]: ' % os.getpid ()
+    else :
+        handler = handlers.RotatingFileHandler \
+            ( target
+            , maxBytes    = args.log_max_bytes
+            , backupCount = args.log_backups
+            )
+    handler.setFormatter (formatters [fmt] ())
+    # The console is not queued: Messages must appear before prompts
+    if target == '-' or not hasattr (handlers, 'QueueHandler') :
+        root.addHandler (handler)
+        return
+    import atexit
+    try :
+        from queue import Queue
+    except ImportError :
+        from Queue import Queue
+    q        = Queue ()
+    listener = handlers.QueueListener (q, handler)
+    listener.start ()
+    root.addHandler (handlers.QueueHandler (q))
+    queue_listeners.append (listener)
+    atexit.register (stop_logging)
+# end def setup_logging
+
+def stop_logging () :
+    """ Write the queued records and flush the handlers, this must be
+        done before the process exits or is replaced by exec.
+    """
+    while queue_listeners :
+        queue_listeners.pop ().stop ()
+    for handler in logger ().handlers :
+        handler.flush ()
+# end def stop_logging
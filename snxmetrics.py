@@ -0,0 +1,375 @@
+#!/usr/bin/python
+
+""" Metrics in the Prometheus text format: Served via HTTP on a local
+    port (--metrics-listen) and/or written periodically to a file for
+    the textfile collector of the node exporter (--metrics-file). The
+    HTTP endpoint is a listener of the select loop of the requester, it
+    only answers while we are waiting for snx (or in the backoff of the
+    supervisor), no thread is started. Stage durations are taken from
+    the spans of the tracer, see snxtrace.
+"""
+
+from __future__        import print_function, unicode_literals
+import os
+import time
+import socket
+import threading
+from snxtrace          import Tracer
+
+helptext = dict \
+    ( snxconnect_start_time_seconds =
+        'Start time of snxconnect since the epoch'
+    , snxconnect_tunnel_up =
+        '1 while snx is connected'
+    , snxconnect_tunnel_uptime_seconds =
+        'Seconds since snx connected, 0 if not connected'
+    , snxconnect_stage_duration_seconds =
+        'Duration of the stages of login and snx startup'
+    , snxconnect_logins_total =
+        'Successful logins by path (cookie, cached or password)'
+    , snxconnect_cookie_logins_total =
+        'Attempts to log in with saved cookies by result (hit or miss)'
+    , snxconnect_probes_total =
+        'Probes through the tunnel by target and result (ok or lost)'
+    , snxconnect_probe_loss_ratio =
+        'Fraction of lost probes in the probe window by target'
+    , snxconnect_probe_rtt_seconds =
+        'Mean RTT of the probes in the probe window by target'
+    , snxconnect_probe_jitter_seconds =
+        'Mean RTT difference of consecutive probes by target'
+    , snxconnect_response_bytes_total =
+        'Bytes of portal responses on the wire and decoded'
+    , snxconnect_tls_handshakes_total =
+        'TLS handshakes with the portal by session resumption'
+    , snxconnect_reconnects_total =
+        'Reconnects of the supervisor by cause'
+    , snxconnect_snx_answer_ok =
+        '1 if snx answered the last connection info, 0 if it refused'
+    , snxconnect_snx_answer_bytes =
+        'Length of the last answer of snx'
+    , snxconnect_snx_answer_status =
+        'First word of the last framed answer of snx (not interpreted)'
+    , snxconnect_snx_answer_time_seconds =
+        'Time of the last answer of snx since the epoch'
+    )
+
+def escape (value) :
+    """ Escape a label value
+    >>> print (escape ('a"b\\\\c\\n'))
+    a\\"b\\\\c\\n
+    """
+    return value.replace ('\\', '\\\\').replace ('"', '\\"') \
+        .replace ('\n', '\\n')
+# end def escape
+
+def format_labels (labels) :
+    if not labels :
+        return ''
+    return '{%s}' % ','.join ('%s="%s"' % (k, escape (v)) for k, v in labels)
+# end def format_labels
+
+class Metrics (object) :
+    """ Counters, gauges and histograms with labels. They are updated
+        by several threads (e.g. the resolver and the executor of the
+        async login), updates and rendering hold the lock.
+    >>> m = Metrics ()
+    >>> m.start = 1000
+    >>> m.inc ('snxconnect_reconnects_total', cause = 'snx terminated')
+    >>> m.observe ('snxconnect_stage_duration_seconds', 0.02, stage = 'dns')
+    >>> m.observe ('snxconnect_stage_duration_seconds', 3, stage = 'dns')
+    >>> print (m.render ()) # doctest: +ELLIPSIS
+    # HELP snxconnect_start_time_seconds Start time ...
+    # TYPE snxconnect_start_time_seconds gauge
+    snxconnect_start_time_seconds 1000
+    ...
+    # TYPE snxconnect_reconnects_total counter
+    snxconnect_reconnects_total{cause="snx terminated"} 1
+    ...
+    snxconnect_stage_duration_seconds_bucket{stage="dns",le="0.01"} 0
+    snxconnect_stage_duration_seconds_bucket{stage="dns",le="0.025"} 1
+    ...
+    snxconnect_stage_duration_seconds_bucket{stage="dns",le="+Inf"} 2
+    snxconnect_stage_duration_seconds_sum{stage="dns"} 3.02
+    snxconnect_stage_duration_seconds_count{stage="dns"} 2
+    <BLANKLINE>
+    """
+
+    buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+    def __init__ (self) :
+        self.start      = time.time ()
+        self.since      = None
+        self.counters   = {}
+        self.gauges     = {}
+        self.histograms = {}
+        self.lock       = threading.RLock ()
+    # end def __init__
+
+    def inc (self, name, value = 1, **labels) :
+        key = tuple (sorted (labels.items ()))
+        with self.lock :
+            d = self.counters.setdefault (name, {})
+            d [key] = d.get (key, 0) + value
+    # end def inc
+
+    def observe (self, name, value, **labels) :
+        key = tuple (sorted (labels.items ()))
+        with self.lock :
+            d = self.histograms.setdefault (name, {})
+            h = d.get (key)
+            if h is None :
+                h = d [key] = [[0] * len (self.buckets), 0, 0]
+            for n, b in enumerate (self.buckets) :
+                if value <= b :
+                    h [0][n] += 1
+            h [1] += value
+            h [2] += 1
+    # end def observe
+
+    def set (self, name, value, **labels) :
+        with self.lock :
+            d = self.gauges.setdefault (name, {})
+            d [tuple (sorted (labels.items ()))] = value
+    # end def set
+
+    def tunnel (self, up) :
+        """ Called when snx connects (up=True) and terminates """
+        self.since = time.time () if up else None
+    # end def tunnel
+
+    def render (self) :
+        with self.lock :
+            now = time.time ()
+            self.set ('snxconnect_start_time_seconds', self.start)
+            self.set ('snxconnect_tunnel_up', int (self.since is not None))
+            self.set \
+                ( 'snxconnect_tunnel_uptime_seconds'
+                , now - self.since if self.since else 0
+                )
+            lines = []
+            def header (name, tp) :
+                if name in helptext :
+                    lines.append ('# HELP %s %s' % (name, helptext [name]))
+                lines.append ('# TYPE %s %s' % (name, tp))
+            for tp, d in (('gauge', self.gauges), ('counter', self.counters)) :
+                for name in sorted (d) :
+                    header (name, tp)
+                    for labels, v in sorted (d [name].items ()) :
+                        l = format_labels (labels)
+                        lines.append ('%s%s %s' % (name, l, fmt (v)))
+            for name in sorted (self.histograms) :
+                header (name, 'histogram')
+                for labels, (counts, total, n) in \
+                    sorted (self.histograms [name].items ()) :
+                    for b, c in zip (self.buckets, counts) :
+                        l = format_labels (labels + (('le', fmt (b)),))
+                        lines.append ('%s_bucket%s %d' % (name, l, c))
+                    l = format_labels (labels + (('le', '+Inf'),))
+                    lines.append ('%s_bucket%s %d' % (name, l, n))
+                    l = format_labels (labels)
+                    lines.append ('%s_sum%s %s' % (name, l, fmt (total)))
+                    lines.append ('%s_count%s %d' % (name, l, n))
+            return '\n'.join (lines) + '\n'
+    # end def render
+
+# end class Metrics
+
+def fmt (value) :
+    """ Format a sample value
+    >>> fmt (3), fmt (0.5), fmt (1e-7), fmt (1.0)
+    ('3', '0.5', '1e-07', '1')
+    """
+    return '%.10g' % value
+# end def fmt
+
+class Metrics_Tracer (Tracer) :
+    """ Tracer that records the spans in the metrics, the spans are
+        written to f (if given) as with the Tracer.
+    >>> m = Metrics ()
+    >>> t = Metrics_Tracer (m)
+    >>> with t.span ('login.cookies') as s :
+    ...     s.set (ok = False)
+    >>> with t.span ('snx.handshake') as s :
+    ...     s.set (answer = 12)
+    >>> for ok in (False, True) :
+    ...     with t.span ('login') as s :
+    ...         s.set (path = 'password', ok = ok)
+    >>> m.counters ['snxconnect_cookie_logins_total']
+    {(('result', 'miss'),): 1}
+    >>> m.counters ['snxconnect_logins_total']
+    {(('path', 'password'),): 1}
+    >>> m.gauges ['snxconnect_snx_answer_ok']
+    {(): 1}
+    >>> h = m.histograms ['snxconnect_stage_duration_seconds']
+    >>> sorted (k [0][1] for k in h)
+    ['login', 'login.cookies', 'snx.handshake']
+    """
+
+    def __init__ (self, metrics, f = None) :
+        Tracer.__init__ (self, f)
+        self.metrics = metrics
+    # end def __init__
+
+    def emit (self, name, start, duration, id, parent, attrs) :
+        m = self.metrics
+        # Spans end in other threads, too: the snx answer is one update
+        with m.lock :
+            m.observe \
+                ('snxconnect_stage_duration_seconds', duration, stage = name)
+            if name == 'login.cookies' :
+                result = 'hit' if attrs.get ('ok') else 'miss'
+                m.inc ('snxconnect_cookie_logins_total', result = result)
+            elif name == 'login' and attrs.get ('ok') :
+                m.inc \
+                    ('snxconnect_logins_total', path = attrs.get ('path', ''))
+            elif name == 'snx.handshake' :
+                m.set ('snxconnect_snx_answer_ok', int ('answer' in attrs))
+                m.set ('snxconnect_snx_answer_bytes', attrs.get ('answer', 0))
+                m.set ('snxconnect_snx_answer_time_seconds', time.time ())
+                if attrs.get ('status') is not None :
+                    m.set ('snxconnect_snx_answer_status', attrs ['status'])
+        if self.f :
+            Tracer.emit (self, name, start, duration, id, parent, attrs)
+    # end def emit
+
+# end class Metrics_Tracer
+
+class Metrics_Client (object) :
+    """ A connection to the metrics endpoint, reads the request without
+        blocking and answers with the metrics.
+    """
+
+    def __init__ (self, sock, server) :
+        self.sock   = sock
+        self.server = server
+        self.data   = b''
+        self.sock.setblocking (False)
+        server.listeners.append (self)
+    # end def __init__
+
+    def close (self) :
+        self.server.listeners.remove (self)
+        self.sock.close ()
+    # end def close
+
+    def fileno (self) :
+        return self.sock.fileno ()
+    # end def fileno
+
+    def handle (self) :
+        try :
+            data = self.sock.recv (4096)
+        except socket.error :
+            return self.close ()
+        self.data += data
+        if data and b'\r\n\r\n' not in self.data and len (self.data) < 8192 :
+            return
+        line = self.data.split (b'\r\n', 1) [0].split ()
+        if len (line) < 2 or line [0] != b'GET' :
+            self.respond ('405 Method Not Allowed', b'')
+        elif line [1].split (b'?') [0] != b'/metrics' :
+            self.respond ('404 Not Found', b'')
+        else :
+            body = self.server.metrics.render ().encode ('utf-8')
+            self.respond ('200 OK', body)
+    # end def handle
+
+    def respond (self, status, body) :
+        head = \
+            ( 'HTTP/1.0 %s\r\n'
+              'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+              'Content-Length: %d\r\nConnection: close\r\n\r\n'
+            % (status, len (body))
+            )
+        try :
+            # The answer is small, it fits into the socket buffer
+            self.sock.setblocking (True)
+            self.sock.settimeout (1)
+            self.sock.sendall (head.encode ('ascii') + body)
+        except socket.error :
+            pass
+        self.close ()
+    # end def respond
+
+# end class Metrics_Client
+
+class Metrics_Server (object) :
+    """ Listener for the requester answering GET /metrics, clients are
+        added to listeners while their request is read.
+    >>> import select
+    >>> m = Metrics ()
+    >>> listeners = []
+    >>> srv = Metrics_Server ('127.0.0.1:0', m, listeners)
+    >>> c = socket.create_connection (srv.sock.getsockname ())
+    >>> c.sendall (b'GET /metrics HTTP/1.1\\r\\nHost: x\\r\\n\\r\\n')
+    >>> while listeners or srv.clients == 0 :
+    ...     r, w, x = select.select ([srv] + listeners, [], [], 5)
+    ...     for l in r :
+    ...         l.handle ()
+    >>> answer = c.recv (65536).decode ('utf-8')
+    >>> answer.split ('\\r\\n') [0]
+    'HTTP/1.0 200 OK'
+    >>> 'snxconnect_tunnel_up 0' in answer
+    True
+    >>> c.close ()
+    >>> srv.close ()
+    """
+
+    def __init__ (self, address, metrics, listeners) :
+        from snxhttp import split_host
+        host, port     = split_host (address, 9776)
+        self.metrics   = metrics
+        self.listeners = listeners
+        self.clients   = 0
+        info = socket.getaddrinfo (host, port, 0, socket.SOCK_STREAM)
+        fam, tp, proto, cn, sa = info [0]
+        self.sock = socket.socket (fam, tp, proto)
+        self.sock.setsockopt (socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind (sa)
+        self.sock.listen (5)
+    # end def __init__
+
+    def close (self) :
+        self.sock.close ()
+    # end def close
+
+    def fileno (self) :
+        return self.sock.fileno ()
+    # end def fileno
+
+    def handle (self) :
+        try :
+            conn, addr = self.sock.accept ()
+        except socket.error :
+            return
+        self.clients += 1
+        Metrics_Client (conn, self)
+    # end def handle
+
+# end class Metrics_Server
+
+def write_textfile (filename, metrics) :
+    """ Write metrics atomically for the textfile collector, the file
+        must be readable by the node exporter. Like write_private of
+        snxconnect each writer has its own temporary file.
+    >>> import tempfile, shutil
+    >>> d  = tempfile.mkdtemp ()
+    >>> fn = os.path.join (d, 'snxconnect.prom')
+    >>> write_textfile (fn, Metrics ())
+    >>> oct (os.stat (fn).st_mode & 0o777), os.listdir (d)
+    ('0o644', ['snxconnect.prom'])
+    >>> shutil.rmtree (d)
+    """
+    import tempfile
+    fd, tmp = tempfile.mkstemp \
+        (dir = os.path.dirname (filename) or '.', prefix = '.tmp')
+    try :
+        with os.fdopen (fd, 'w') as f :
+            f.write (metrics.render ())
+        os.chmod (tmp, 0o644)
+        # os.replace is python3 only, rename replaces on POSIX, too
+        getattr (os, 'replace', os.rename) (tmp, filename)
+    except BaseException :
+        os.unlink (tmp)
+        raise
+# end def write_textfile
@@ -0,0 +1,464 @@
+#!/usr/bin/python3
+
+""" Local stand-in for a Checkpoint portal and for snx, used for
+    testing and benchmarking snxconnect without a real gateway.
+
+    python snxmock.py portal [options]
+        Serve Login, the RSA javascript, MultiChallenge, ActivateLogin,
+        Portal/Main, Portal/LoggedIn and SNX/extender pages with
+        configurable session timeout, latency, page size and failure
+        injection. Pages are gzip compressed if the client accepts it.
+        Use snxconnect with
+        -p http -H 127.0.0.1:<port>, any username is accepted with the
+        password given by --password.
+
+    snxmock.py -Z
+        Behaves like 'snx -Z': Forks a daemon listening on
+        127.0.0.1:7776 that checks the layout of the connection info
+        sent by snxconnect, answers and keeps the connection open for
+        SNXMOCK_HOLD seconds (default 0). Use with --snxpath. The result
+        of the check is appended to the file SNXMOCK_LOG if set, the
+        status in the answer is taken from SNXMOCK_STATUS (default 0).
+        With SNXMOCK_DELAY the daemon starts to listen after this many
+        seconds (after closing stdin/out/err like snx does).
+
+    snxmock.py -d
+        Terminate the daemon started with -Z, like 'snx -d'.
+"""
+
+from __future__        import print_function, unicode_literals
+import os
+import sys
+import time
+import random
+import socket
+import tempfile
+import threading
+from argparse          import ArgumentParser
+try :
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer   import ThreadingMixIn
+    from urlparse       import parse_qs
+except ImportError :
+    from http.server    import HTTPServer, BaseHTTPRequestHandler
+    from socketserver   import ThreadingMixIn
+    from urllib.parse   import parse_qs
+import snxproto
+
+snx_port   = 7776
+pidfile    = os.environ.get \
+    ('SNXMOCK_PIDFILE', os.path.join (tempfile.gettempdir (), 'snxmock.pid'))
+
+def gzip_compress (data) :
+    """ Like gzip.compress which python2 does not have
+    >>> import gzip, io
+    >>> gzip.GzipFile (fileobj = io.BytesIO (gzip_compress (b'x'))).read ()
+    b'x'
+    """
+    import gzip, io
+    buf = io.BytesIO ()
+    with gzip.GzipFile (fileobj = buf, mode = 'wb') as f :
+        f.write (data)
+    return buf.getvalue ()
+# end def gzip_compress
+
+class Portal_Handler (BaseHTTPRequestHandler) :
+    protocol_version = 'HTTP/1.1'
+    # Send headers and body in one segment, otherwise Nagle and delayed
+    # ACK add 40ms to every response
+    wbufsize         = 65536
+
+    def authenticated (self) :
+        """ Valid session, each request extends the session """
+        srv = self.server
+        sid = self.session ()
+        if sid not in srv.sessions :
+            return False
+        now = time.time ()
+        if srv.session_timeout and now - srv.seen [sid] > srv.session_timeout :
+            del srv.sessions [sid]
+            return False
+        srv.seen [sid] = now
+        return True
+    # end def authenticated
+
+    def do_GET (self) :
+        self.dispatch ()
+    # end def do_GET
+
+    def do_POST (self) :
+        n = int (self.headers.get ('Content-Length', 0))
+        self.form = parse_qs (self.rfile.read (n).decode ('ascii'))
+        self.dispatch ()
+    # end def do_POST
+
+    def dispatch (self) :
+        srv  = self.server
+        path = self.path.split ('?') [0]
+        srv.requests += 1
+        if srv.latency :
+            time.sleep (srv.latency)
+        if srv.failure_rate and random.random () < srv.failure_rate :
+            return self.send (b'Injected failure', status = 500)
+        for suffix, method in self.pages :
+            if path.endswith (suffix) :
+                return getattr (self, method) ()
+        self.send (b'Not found', status = 404)
+    # end def dispatch
+
+    def extender (self) :
+        if not self.authenticated () :
+            return self.redirect ('/sslvpn/Login/Login')
+        page = \
+            ( '<html><head><script>\n/* Extender.user_name = "%s";'
+              ' Extender.password = "%s"; Extender.host_name = "127.0.0.1";'
+              ' Extender.port = "443"; Extender.server_cn = "mock";'
+              ' Extender.server_fingerprint = "MOCK FINGERPRINT"; */\n'
+              '</script></head><body>%s</body></html>'
+            % (self.server.sessions [self.session ()], 'otp', self.padding ())
+            )
+        self.send (page.encode ('utf-8'))
+    # end def extender
+
+    def activate (self) :
+        if not self.authenticated () :
+            return self.redirect ('/sslvpn/Login/Login')
+        if 'ActivateLogin=activate' in self.path :
+            return self.redirect ('/sslvpn/Portal/Main')
+        self.send (('<html><body>%s</body></html>' % self.padding ()).encode ())
+    # end def activate
+
+    def log_message (self, *args) :
+        if self.server.verbose :
+            BaseHTTPRequestHandler.log_message (self, *args)
+    # end def log_message
+
+    def login (self) :
+        if self.command == 'GET' :
+            page = \
+                ( '<html><head><script src="/sslvpn/js/RSA.js"></script>'
+                  '</head><body>'
+                  '<form id="loginForm" action="/sslvpn/Login/Login"'
+                  ' method="post"><input name="userName">'
+                  '<input type="password" name="password"></form>%s'
+                  '</body></html>'
+                % self.padding ()
+                )
+            return self.send (page.encode ('utf-8'))
+        srv  = self.server
+        user = self.form.get ('userName', [''])[0]
+        if self.password () != srv.password :
+            page = '<html><body><span class="errorMessage">Access denied'
+            page = page + '</span></body></html>'
+            return self.send (page.encode ('utf-8'))
+        sid = '%x' % random.getrandbits (64)
+        if srv.mfa :
+            srv.pending [sid] = user
+            return self.redirect ('/sslvpn/Login/MultiChallenge', sid)
+        srv.sessions [sid] = user
+        srv.seen [sid]     = time.time ()
+        self.redirect ('/sslvpn/Login/ActivateLogin', sid)
+    # end def login
+
+    def logged_in (self) :
+        if not self.authenticated () :
+            return self.redirect ('/sslvpn/Login/Login')
+        js = 'nNextTimeout = %d;\n' % (self.server.session_timeout or 600)
+        self.send (js.encode ('ascii'), ctype = 'text/javascript')
+    # end def logged_in
+
+    def main (self) :
+        if not self.authenticated () :
+            return self.redirect ('/sslvpn/Login/Login')
+        self.send (('<html><body>%s</body></html>' % self.padding ()).encode ())
+    # end def main
+
+    def multi_challenge (self) :
+        srv = self.server
+        sid = self.session ()
+        if sid not in srv.pending :
+            return self.redirect ('/sslvpn/Login/Login')
+        if self.command == 'POST' :
+            if self.password () == srv.mfa :
+                srv.sessions [sid] = srv.pending.pop (sid)
+                srv.seen [sid]     = time.time ()
+                return self.redirect ('/sslvpn/Login/ActivateLogin')
+            page = '<html><body><span class="errorMessage">Wrong code'
+            page = page + '</span></body></html>'
+            return self.send (page.encode ('utf-8'))
+        page = \
+            ( '<html><body><form name="MCForm" method="post"'
+              ' action="/sslvpn/Login/MultiChallenge">'
+              '<input type="hidden" name="params" value="%s">'
+              '<input type="password" name="password"></form>%s'
+              '</body></html>'
+            % (sid, self.padding ())
+            )
+        self.send (page.encode ('utf-8'))
+    # end def multi_challenge
+
+    def padding (self) :
+        """ Stand-in for the inline javascript of the real pages """
+        return self.server.padding
+    # end def padding
+
+    def password (self) :
+        """ Decrypt the password in the form, return None on error """
+        import rsa
+        try :
+            c = bytearray.fromhex (self.form ['password'][0])
+            c.reverse ()
+            return rsa.decrypt (bytes (c), self.server.privkey).decode ('utf-8')
+        except (KeyError, ValueError, rsa.DecryptionError) :
+            return None
+    # end def password
+
+    def redirect (self, location, sid = None) :
+        self.send_response (302)
+        self.send_header ('Location', location)
+        self.send_header ('Content-Length', '0')
+        if sid :
+            self.send_header ('Set-Cookie', 'SNXMOCK=%s; Path=/' % sid)
+        self.end_headers ()
+    # end def redirect
+
+    def rsa_script (self) :
+        pub = self.server.pubkey
+        js  = "var modulus = '%x';\nvar exponent = '%x';\n" % (pub.n, pub.e)
+        self.send (js.encode ('ascii'), ctype = 'text/javascript')
+    # end def rsa_script
+
+    def send (self, body, status = 200, ctype = 'text/html; charset=utf-8') :
+        self.send_response (status)
+        self.send_header ('Content-Type', ctype)
+        accept = self.headers.get ('Accept-Encoding', '')
+        if 'gzip' in [e.split (';') [0].strip () for e in accept.split (',')] :
+            body = gzip_compress (body)
+            self.send_header ('Content-Encoding', 'gzip')
+        self.send_header ('Content-Length', str (len (body)))
+        self.end_headers ()
+        self.wfile.write (body)
+    # end def send
+
+    def session (self) :
+        for c in self.headers.get ('Cookie', '').split (';') :
+            k, sep, v = c.strip ().partition ('=')
+            if k == 'SNXMOCK' :
+                return v
+    # end def session
+
+    pages = \
+        ( ('Login/Login',          'login')
+        , ('Login/MultiChallenge', 'multi_challenge')
+        , ('Login/ActivateLogin',  'activate')
+        , ('js/RSA.js',            'rsa_script')
+        , ('Portal/Main',          'main')
+        , ('Portal/LoggedIn',      'logged_in')
+        , ('SNX/extender',         'extender')
+        )
+
+# end class Portal_Handler
+
+class Mock_Portal (ThreadingMixIn, HTTPServer) :
+    """ The portal, serve_forever may be run in a thread:
+    >>> p = Mock_Portal (page_size = 100)
+    >>> p.port > 0
+    True
+    >>> len (p.padding)
+    100
+    >>> p.server_close ()
+    """
+    daemon_threads = True
+
+    def __init__ \
+        ( self
+        , port            = 0
+        , latency         = 0
+        , page_size       = 0
+        , failure_rate    = 0
+        , password        = 'secret'
+        , mfa             = None
+        , verbose         = False
+        , session_timeout = 0
+        ) :
+        import rsa
+        HTTPServer.__init__ (self, ('127.0.0.1', port), Portal_Handler)
+        self.port          = self.server_address [1]
+        self.latency       = latency
+        self.failure_rate  = failure_rate
+        self.password      = password
+        self.mfa           = mfa
+        self.verbose       = verbose
+        self.padding       = ('<!-- %s -->' % ('x' * page_size)) [:page_size]
+        self.sessions      = {}
+        self.seen          = {}
+        self.pending       = {}
+        self.session_timeout = session_timeout
+        self.requests      = 0
+        self.pubkey, self.privkey = rsa.newkeys (512)
+    # end def __init__
+
+    def start (self) :
+        t = threading.Thread (target = self.serve_forever)
+        t.daemon = True
+        t.start ()
+    # end def start
+
+# end class Mock_Portal
+
+def check_snx_info (data) :
+    """ Check the connection info, return list of errors
+    >>> ci = snxproto.Connection_Info \\
+    ...     ( 0x7f000001, b'127.0.0.1', 443, b'cn', b'user', b'pw', b'fp')
+    >>> info = ci.encode ()
+    >>> check_snx_info (info)
+    []
+    >>> check_snx_info (info [:-2])
+    ['connection info has 982 bytes, expected 984']
+    >>> check_snx_info (b'\\0' * 984)
+    ['bad magic 0000']
+    >>> ci.server_cn = b''
+    >>> ci.port = 0
+    >>> check_snx_info (ci.encode ())
+    ['empty server_cn', 'bad port 0']
+    """
+    try :
+        ci = snxproto.Connection_Info.decode (data)
+    except snxproto.Protocol_Error as err :
+        return [str (err)]
+    errors = []
+    if not ci.gateway_ip :
+        errors.append ('no gateway address')
+    for name in \
+        ('gateway_host', 'server_cn', 'user_name', 'password', 'fingerprint') :
+        if not getattr (ci, name) :
+            errors.append ('empty %s' % name)
+    if not 0 < ci.port < 65536 :
+        errors.append ('bad port %d' % ci.port)
+    return errors
+# end def check_snx_info
+
+def fake_snx () :
+    """ Emulate 'snx -Z': fork a daemon and exit. The daemon closes
+        stdin/out/err (so the caller's communicate returns) and starts
+        to listen after SNXMOCK_DELAY seconds, without a delay we listen
+        before forking so there is no race with the caller. Like a
+        running snx we keep listening while the connection is held.
+    """
+    hold  = float (os.environ.get ('SNXMOCK_HOLD', 0))
+    delay = float (os.environ.get ('SNXMOCK_DELAY', 0))
+    log   = os.environ.get ('SNXMOCK_LOG')
+    sock  = socket.socket (socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt (socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if not delay :
+        sock.bind (('127.0.0.1', snx_port))
+        sock.listen (1)
+    if os.fork () :
+        return
+    os.setsid ()
+    with open (pidfile, 'w') as f :
+        f.write ('%d\n' % os.getpid ())
+    for fd in (0, 1, 2) :
+        os.close (fd)
+    if delay :
+        time.sleep (delay)
+        sock.bind (('127.0.0.1', snx_port))
+        sock.listen (1)
+    conn, addr = sock.accept ()
+    size = snxproto.info.size
+    info = b''
+    while len (info) < size :
+        data = conn.recv (size - len (info))
+        if not data :
+            break
+        info += data
+    errors = check_snx_info (info)
+    if log :
+        with open (log, 'a') as f :
+            f.write ('%s\n' % ('; '.join (errors) or 'ok'))
+    if not errors :
+        status  = int (os.environ.get ('SNXMOCK_STATUS', 0))
+        payload = snxproto.word.pack (status)
+        conn.sendall (snxproto.Answer (snxproto.magic, payload).encode ())
+        time.sleep (hold)
+    conn.close ()
+    sock.close ()
+    os._exit (0)
+# end def fake_snx
+
+def stop_snx () :
+    """ Emulate 'snx -d': terminate the daemon """
+    import signal
+    try :
+        with open (pidfile) as f :
+            os.kill (int (f.read ()), signal.SIGTERM)
+    except (IOError, OSError, ValueError) :
+        pass
+# end def stop_snx
+
+def main () :
+    if sys.argv [1:] == ['-Z'] :
+        fake_snx ()
+        return
+    if sys.argv [1:] == ['-d'] :
+        stop_snx ()
+        return
+    cmd = ArgumentParser ()
+    sub = cmd.add_subparsers (dest = 'command')
+    p = sub.add_parser ('portal', help = 'Run the mock portal')
+    p.add_argument \
+        ( '-P', '--port'
+        , help    = 'Port to listen on, default=%(default)s'
+        , type    = int
+        , default = 8080
+        )
+    p.add_argument \
+        ( '-l', '--latency'
+        , help    = 'Delay in seconds for each request, default=%(default)s'
+        , type    = float
+        , default = 0
+        )
+    p.add_argument \
+        ( '-s', '--page-size'
+        , help    = 'Padding added to each page, default=%(default)s'
+        , type    = int
+        , default = 0
+        )
+    p.add_argument \
+        ( '-f', '--failure-rate'
+        , help    = 'Fraction of requests answered with an error,'
+                    ' default=%(default)s'
+        , type    = float
+        , default = 0
+        )
+    p.add_argument \
+        ( '--password'
+        , help    = 'Accepted password, default="%(default)s"'
+        , default = 'secret'
+        )
+    p.add_argument \
+        ( '--mfa'
+        , help    = 'Require this MultiChallenge code'
+        )
+    p.add_argument \
+        ( '--session-timeout'
+        , help    = 'Sessions expire after this many seconds without a'
+                    ' request, 0 for never, default=%(default)s'
+        , type    = float
+        , default = 0
+        )
+    args = cmd.parse_args ()
+    if args.command != 'portal' :
+        cmd.print_help ()
+        sys.exit (1)
+    portal = Mock_Portal \
+        ( args.port, args.latency, args.page_size, args.failure_rate
+        , args.password, args.mfa, verbose = True
+        , session_timeout = args.session_timeout
+        )
+    print ("Mock portal on http://127.0.0.1:%d" % portal.port)
+    portal.serve_forever ()
+# end def main
+
+if __name__ == '__main__' :
+    main ()
@@ -0,0 +1,429 @@
+#!/usr/bin/python
+
+""" Providers for the code of a MultiChallenge login (--otp-provider):
+    A TOTP generator with a seed from a protected file, a line read from
+    a named pipe or an inherited file descriptor or the output of a
+    helper command. With these a supervised or batch login does not
+    wait for a person. Without a provider the code given with -MC is
+    used or the user is prompted. A provider is asked for a new code
+    for each challenge, attempt counts the codes rejected before, a
+    provider must return within timeout seconds or raise OTP_Error.
+"""
+
+from __future__        import print_function, unicode_literals
+import os
+import hmac
+import time
+import select
+import struct
+import hashlib
+from base64            import b32decode
+try :
+    from urlparse import urlparse, parse_qs
+except ImportError :
+    from urllib.parse import urlparse, parse_qs
+try :
+    input = raw_input
+except NameError :
+    pass
+
+class OTP_Error (Exception) :
+    pass
+# end class OTP_Error
+
+def totp (key, t, digits = 6, period = 30, digest = 'sha1') :
+    """ Time-based one-time password (RFC 6238) for time t
+    >>> key = b'12345678901234567890'
+    >>> totp (key, 59, digits = 8), totp (key, 1111111109, digits = 8)
+    ('94287082', '07081804')
+    >>> totp (key, 59)
+    '287082'
+    """
+    counter = struct.pack (b'>Q', int (t // period))
+    mac     = hmac.new (key, counter, getattr (hashlib, digest)).digest ()
+    mac     = bytearray (mac)
+    offset  = mac [-1] & 0x0f
+    value   = struct.unpack (b'>L', bytes (mac [offset:offset + 4])) [0]
+    return '%0*d' % (digits, (value & 0x7fffffff) % 10 ** digits)
+# end def totp
+
+def parse_seed (text) :
+    """ Parse a TOTP seed, either the base32 secret or an otpauth URI
+        as used for QR codes, returns the arguments for totp.
+    >>> parse_seed ('GEZD GNBV GY3T QOJQ\\n') ['key']
+    b'1234567890'
+    >>> d = parse_seed ('otpauth://totp/vpn:u?secret=GEZDGNBVGY3TQOJQ'
+    ...     '&digits=8&period=60&algorithm=SHA256')
+    >>> sorted (d.items ())
+    [('digest', 'sha256'), ('digits', 8), ('key', b'1234567890'), ('period', 60)]
+    """
+    text = text.strip ()
+    args = {}
+    if text.startswith ('otpauth:') :
+        query = parse_qs (urlparse (text).query)
+        text  = query.get ('secret', [''])[0]
+        if 'digits' in query :
+            args ['digits'] = int (query ['digits'][0])
+        if 'period' in query :
+            args ['period'] = int (query ['period'][0])
+        if 'algorithm' in query :
+            args ['digest'] = query ['algorithm'][0].lower ()
+    secret = ''.join (text.split ()).upper ()
+    secret = secret + '=' * (-len (secret) % 8)
+    try :
+        args ['key'] = b32decode (secret.encode ('ascii'))
+    except (TypeError, ValueError) :
+        raise OTP_Error ("invalid TOTP seed")
+    if not args ['key'] :
+        raise OTP_Error ("empty TOTP seed")
+    return args
+# end def parse_seed
+
+def read_line (fd, timeout, buffer = b'') :
+    """ Read a line from fd within timeout seconds, data after the line
+        is returned, too. Returns the line and the rest.
+    >>> r, w = os.pipe ()
+    >>> n = os.write (w, b'123456\\n654')
+    >>> line, rest = read_line (r, 1)
+    >>> line, rest
+    ('123456', b'654')
+    >>> try :
+    ...     read_line (r, 0.01, rest)
+    ... except OTP_Error as err :
+    ...     print (err)
+    no code within 0.01 seconds
+    >>> n = os.write (w, b'321\\n')
+    >>> read_line (r, 1, rest) [0]
+    '654321'
+    >>> os.close (r), os.close (w)
+    (None, None)
+    """
+    deadline = time.time () + timeout
+    data     = buffer
+    while b'\n' not in data :
+        left = deadline - time.time ()
+        r = []
+        if left > 0 :
+            r, w, x = select.select ([fd], [], [], left)
+        if not r :
+            raise OTP_Error ("no code within %g seconds" % timeout)
+        chunk = os.read (fd, 4096)
+        if not chunk :
+            break
+        data += chunk
+    line, sep, rest = data.partition (b'\n')
+    line = line.strip ().decode ('utf-8')
+    if not line :
+        raise OTP_Error ("no code received")
+    return line, rest
+# end def read_line
+
+class Static_Provider (object) :
+    """ The code given on the command line, retrying makes no sense """
+
+    retry = False
+
+    def __init__ (self, code) :
+        self.value = code
+    # end def __init__
+
+    def code (self, attempt, timeout) :
+        return self.value
+    # end def code
+
+# end class Static_Provider
+
+class Prompt_Provider (object) :
+    """ Ask the user, there is no timeout for a person """
+
+    retry = True
+
+    def code (self, attempt, timeout) :
+        prompt = 'MultiChallenge code: '
+        if attempt :
+            prompt = 'MultiChallenge code (rejected, try again): '
+        return input (prompt).strip ()
+    # end def code
+
+# end class Prompt_Provider
+
+class TOTP_Provider (object) :
+    """ Generate the code from the seed in filename (see parse_seed),
+        the file must not be accessible by others. A code is used only
+        once: after a rejected code (or for the next login within the
+        same period) we wait for the next one.
+    >>> import tempfile
+    >>> fd, fn = tempfile.mkstemp ()
+    >>> n = os.write (fd, b'GEZDGNBVGY3TQOJQGEZDGNBVGY3TQOJQ\\n')
+    >>> os.close (fd)
+    >>> p = TOTP_Provider (fn)
+    >>> p.now = lambda : 59
+    >>> p.code (0, 10)
+    '287082'
+    >>> try :
+    ...     p.code (1, 0.1)
+    ... except OTP_Error as err :
+    ...     print (err)
+    no new TOTP code within 0.1 seconds
+    >>> p.now = lambda : 60
+    >>> p.code (1, 10) == totp (b'12345678901234567890', 60)
+    True
+    >>> os.chmod (fn, 0o644)
+    >>> try :
+    ...     p.code (0, 10)
+    ... except OTP_Error as err :
+    ...     print (err) # doctest: +ELLIPSIS
+    TOTP seed file ... is accessible by others
+    >>> os.unlink (fn)
+    """
+
+    retry = True
+
+    def __init__ (self, filename) :
+        self.filename = filename
+        self.counter  = None
+        self.now      = time.time
+    # end def __init__
+
+    def code (self, attempt, timeout) :
+        args   = self.seed ()
+        period = args.get ('period', 30)
+        t      = self.now ()
+        if self.counter is not None and int (t // period) <= self.counter :
+            wait = (self.counter + 1) * period - t
+            if wait > timeout :
+                raise OTP_Error \
+                    ("no new TOTP code within %g seconds" % timeout)
+            time.sleep (wait)
+            t = (self.counter + 1) * period
+        self.counter = int (t // period)
+        return totp (t = t, **args)
+    # end def code
+
+    def seed (self) :
+        try :
+            with open (self.filename, 'r') as f :
+                if os.fstat (f.fileno ()).st_mode & 0o077 :
+                    raise OTP_Error \
+                        ( "TOTP seed file %s is accessible by others"
+                        % self.filename
+                        )
+                return parse_seed (f.read ())
+        except (IOError, OSError) as err :
+            raise OTP_Error ("TOTP seed: %s" % err)
+    # end def seed
+
+# end class TOTP_Provider
+
+class Fifo_Provider (object) :
+    """ Read one line per code from a named pipe. We keep a write end
+        open ourselves, so we wait for a writer instead of reading EOF.
+    >>> import tempfile, shutil
+    >>> d  = tempfile.mkdtemp ()
+    >>> fn = os.path.join (d, 'otp')
+    >>> os.mkfifo (fn)
+    >>> p = Fifo_Provider (fn)
+    >>> try :
+    ...     p.code (0, 0.01)
+    ... except OTP_Error as err :
+    ...     print (err)
+    no code within 0.01 seconds
+    >>> w = os.open (fn, os.O_WRONLY)
+    >>> n = os.write (w, b'4711\\n0815\\n')
+    >>> p.code (0, 1), p.code (1, 1)
+    ('4711', '0815')
+    >>> os.close (w), p.close ()
+    (None, None)
+    >>> shutil.rmtree (d)
+    """
+
+    retry = True
+
+    def __init__ (self, path) :
+        self.path   = path
+        self.fd     = None
+        self.wfd    = None
+        self.buffer = b''
+    # end def __init__
+
+    def close (self) :
+        for fd in (self.fd, self.wfd) :
+            if fd is not None :
+                os.close (fd)
+        self.fd = self.wfd = None
+    # end def close
+
+    def code (self, attempt, timeout) :
+        if self.fd is None :
+            try :
+                self.fd  = os.open (self.path, os.O_RDONLY | os.O_NONBLOCK)
+                self.wfd = os.open (self.path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as err :
+                self.close ()
+                raise OTP_Error ("OTP fifo: %s" % err)
+        line, self.buffer = read_line (self.fd, timeout, self.buffer)
+        return line
+    # end def code
+
+# end class Fifo_Provider
+
+class FD_Provider (object) :
+    """ Read one line per code from an inherited file descriptor """
+
+    retry = True
+
+    def __init__ (self, fd) :
+        self.fd     = fd
+        self.buffer = b''
+    # end def __init__
+
+    def code (self, attempt, timeout) :
+        try :
+            line, self.buffer = read_line (self.fd, timeout, self.buffer)
+        except (IOError, OSError) as err :
+            raise OTP_Error ("OTP fd %d: %s" % (self.fd, err))
+        return line
+    # end def code
+
+# end class FD_Provider
+
+class Command_Provider (object) :
+    """ Run a helper command (via the shell) for each code, the first
+        line of its output is the code. The number of rejected codes is
+        passed in the environment as SNXCONNECT_OTP_ATTEMPT.
+    >>> p = Command_Provider ('echo 12$SNXCONNECT_OTP_ATTEMPT')
+    >>> p.code (0, 5), p.code (1, 5)
+    ('120', '121')
+    >>> for cmd in ('exit 3', 'sleep 5', 'echo 4711; exec sleep 5') :
+    ...     try :
+    ...         Command_Provider (cmd).code (0, 0.2)
+    ...     except OTP_Error as err :
+    ...         print (err)
+    OTP command failed with status 3
+    no code within 0.2 seconds
+    OTP command did not exit within 0.2 seconds
+    """
+
+    retry = True
+
+    def __init__ (self, command) :
+        self.command = command
+    # end def __init__
+
+    def code (self, attempt, timeout) :
+        from subprocess import Popen, PIPE
+        deadline = time.time () + timeout
+        env = dict (os.environ, SNXCONNECT_OTP_ATTEMPT = '%d' % attempt)
+        try :
+            p = Popen (self.command, shell = True, stdout = PIPE, env = env)
+        except OSError as err :
+            raise OTP_Error ("OTP command: %s" % err)
+        try :
+            line, rest = read_line (p.stdout.fileno (), timeout)
+        except OTP_Error :
+            if p.poll () is None :
+                p.kill ()
+            p.wait ()
+            if p.returncode > 0 :
+                raise OTP_Error \
+                    ("OTP command failed with status %d" % p.returncode)
+            raise
+        finally :
+            p.stdout.close ()
+        # Popen.wait has no timeout in python2, so we poll. The helper
+        # may exit just after writing the code, it gets a short grace.
+        deadline = max (deadline, time.time () + 0.1)
+        while p.poll () is None :
+            if time.time () >= deadline :
+                p.kill ()
+                p.wait ()
+                raise OTP_Error \
+                    ("OTP command did not exit within %g seconds" % timeout)
+            time.sleep (0.01)
+        if p.returncode :
+            raise OTP_Error \
+                ("OTP command failed with status %d" % p.returncode)
+        return line
+    # end def code
+
+# end class Command_Provider
+
+class Shared_Provider (object) :
+    """ One provider used by several threads (the workers of --batch):
+        Only one thread at a time gets a code, so a line read from a
+        fifo or fd goes to exactly one login and a TOTP code is not
+        used twice. Closing is left to the owner of the provider.
+    >>> import threading
+    >>> class Slow_Provider (Static_Provider) :
+    ...     busy = 0
+    ...     def code (self, attempt, timeout) :
+    ...         self.busy += 1
+    ...         busy = self.busy
+    ...         time.sleep (0.01)
+    ...         self.busy -= 1
+    ...         return '%d' % busy
+    >>> p = Shared_Provider (Slow_Provider (None))
+    >>> codes = []
+    >>> def login () :
+    ...     codes.append (p.code (0, 1))
+    >>> threads = [threading.Thread (target = login) for i in range (4)]
+    >>> for t in threads : t.start ()
+    >>> for t in threads : t.join ()
+    >>> codes, p.retry
+    (['1', '1', '1', '1'], False)
+    """
+
+    def __init__ (self, provider) :
+        import threading
+        self.provider = provider
+        self.retry    = provider.retry
+        self.lock     = threading.Lock ()
+    # end def __init__
+
+    def code (self, attempt, timeout) :
+        with self.lock :
+            return self.provider.code (attempt, timeout)
+    # end def code
+
+# end class Shared_Provider
+
+def parse_provider (spec) :
+    """ Parse the --otp-provider option into kind and argument without
+        creating the provider, so the option can be checked early.
+    >>> parse_provider ('fd:3'), parse_provider ('cmd:otp vpn')
+    (('fd', 3), ('cmd', 'otp vpn'))
+    >>> try :
+    ...     parse_provider ('sms:123')
+    ... except ValueError as err :
+    ...     print (err)
+    unknown OTP provider: sms:123
+    """
+    kind, sep, arg = spec.partition (':')
+    if sep and arg :
+        if kind in ('totp', 'fifo') :
+            return kind, os.path.expanduser (arg)
+        if kind == 'fd' and arg.isdigit () :
+            return kind, int (arg)
+        if kind == 'cmd' :
+            return kind, arg
+    raise ValueError ("unknown OTP provider: %s" % spec)
+# end def parse_provider
+
+def make_provider (spec) :
+    """ Provider from the --otp-provider option
+    >>> for s in ('totp:~/.snxotp', 'fifo:/run/otp', 'fd:3', 'cmd:otp vpn') :
+    ...     print (type (make_provider (s)).__name__)
+    TOTP_Provider
+    Fifo_Provider
+    FD_Provider
+    Command_Provider
+    """
+    providers = dict \
+        ( totp = TOTP_Provider
+        , fifo = Fifo_Provider
+        , fd   = FD_Provider
+        , cmd  = Command_Provider
+        )
+    kind, arg = parse_provider (spec)
+    return providers [kind] (arg)
+# end def make_provider
@@ -0,0 +1,379 @@
+#!/usr/bin/python
+
+""" Probing the quality of the tunnel: While snx is connected we
+    periodically probe targets behind the tunnel (--probe), either with
+    a TCP connect (the RTT is the time to the SYN/ACK, a refused
+    connection is an answer, too) or with a datagram to a UDP echo
+    service. For each target rolling statistics (RTT, loss and jitter)
+    of the last --probe-window probes are kept. The probes run in the
+    select loop of the requester, no thread is started. Probes are sent
+    every --probe-interval seconds, after a lost probe or while a
+    threshold is exceeded five times as often. When the statistics of
+    all targets exceed a threshold the tunnel is considered degraded and
+    the requester restarts snx, with --supervise this reconnects.
+"""
+
+from __future__        import print_function, unicode_literals
+import os
+import time
+import errno
+import socket
+from collections       import deque
+
+def parse_target (spec) :
+    """ Parse a probe target [tcp:|udp:]host:port
+    >>> parse_target ('10.1.2.3:22')
+    ('tcp', '10.1.2.3', 22)
+    >>> parse_target ('udp:intranet.example.com:7')
+    ('udp', 'intranet.example.com', 7)
+    >>> parse_target ('tcp:[2001:db8::1]:443')
+    ('tcp', '2001:db8::1', 443)
+    >>> try :
+    ...     parse_target ('intranet')
+    ... except ValueError as err :
+    ...     print (err)
+    probe target needs a port: intranet
+    """
+    from snxhttp import split_host
+    proto = 'tcp'
+    for p in ('tcp', 'udp') :
+        if spec.startswith (p + ':') :
+            proto = p
+            spec  = spec [len (p) + 1:]
+    host, port = split_host (spec)
+    if port is None :
+        raise ValueError ("probe target needs a port: %s" % spec)
+    return proto, host, port
+# end def parse_target
+
+class Probe_Stats (object) :
+    """ Rolling statistics of the last window probes, a result is the
+        RTT in seconds or None for a lost probe. The jitter is the mean
+        difference of the RTT of consecutive answered probes.
+    >>> s = Probe_Stats (window = 5)
+    >>> for r in (0.010, 0.030, None, 0.020, 0.020, 0.040) :
+    ...     s.add (r)
+    >>> s.count, s.loss, round (s.rtt, 4), round (s.jitter, 4)
+    (5, 0.2, 0.0275, 0.01)
+    >>> print (s.degraded (max_loss = 0.5))
+    None
+    >>> s.degraded (max_loss = 0.1), s.degraded (max_rtt = 0.025)
+    ('loss 20%', 'rtt 28 ms')
+    >>> s.degraded (max_jitter = 0.005)
+    'jitter 10 ms'
+    >>> for r in (None, None, None, None) :
+    ...     s.add (r)
+    >>> s.loss, s.rtt, s.jitter, s.degraded (max_loss = 0.5, max_rtt = 0.01)
+    (0.8, 0.04, None, 'loss 80%')
+    """
+
+    min_samples = 5
+
+    def __init__ (self, window = 20) :
+        self.results = deque (maxlen = window)
+    # end def __init__
+
+    def add (self, rtt) :
+        self.results.append (rtt)
+    # end def add
+
+    @property
+    def answered (self) :
+        return [r for r in self.results if r is not None]
+    # end def answered
+
+    @property
+    def count (self) :
+        return len (self.results)
+    # end def count
+
+    @property
+    def jitter (self) :
+        rtts = self.answered
+        if len (rtts) < 2 :
+            return None
+        diffs = [abs (b - a) for a, b in zip (rtts, rtts [1:])]
+        return sum (diffs) / len (diffs)
+    # end def jitter
+
+    @property
+    def loss (self) :
+        if not self.results :
+            return None
+        return 1.0 * (self.count - len (self.answered)) / self.count
+    # end def loss
+
+    @property
+    def rtt (self) :
+        rtts = self.answered
+        if not rtts :
+            return None
+        return sum (rtts) / len (rtts)
+    # end def rtt
+
+    def degraded (self, max_loss = 0, max_rtt = 0, max_jitter = 0) :
+        """ Return the first threshold (0 is off) that is exceeded or
+            None. We need min_samples results for a verdict.
+        """
+        if self.count < self.min_samples :
+            return None
+        if max_loss and self.loss > max_loss :
+            return 'loss %.0f%%' % (self.loss * 100)
+        rtt = self.rtt
+        if max_rtt and rtt is not None and rtt > max_rtt :
+            return 'rtt %.0f ms' % (rtt * 1e3)
+        jitter = self.jitter
+        if max_jitter and jitter is not None and jitter > max_jitter :
+            return 'jitter %.0f ms' % (jitter * 1e3)
+        return None
+    # end def degraded
+
+    def summary (self) :
+        return dict \
+            ( count  = self.count
+            , loss   = self.loss
+            , rtt    = self.rtt
+            , jitter = self.jitter
+            )
+    # end def summary
+
+# end class Probe_Stats
+
+class Probe (object) :
+    """ A single probe in the select loop of the prober: A non-blocking
+        TCP connect (we wait for the socket to become writable) or a
+        UDP datagram that must be echoed. The prober is called back
+        with the RTT or None if the probe is lost or times out.
+    >>> import select
+    >>> class Fake_Prober (object) :
+    ...     listeners = []
+    ...     def add_timer (self, delay, callback) :
+    ...         pass
+    ...     def done (self, probe, rtt) :
+    ...         print (probe.target, rtt is not None)
+    >>> srv = socket.socket ()
+    >>> srv.bind (('127.0.0.1', 0))
+    >>> srv.listen (1)
+    >>> port = srv.getsockname () [1]
+    >>> p = Fake_Prober ()
+    >>> def serve () :
+    ...     while p.listeners :
+    ...         w = [l for l in p.listeners if l.writing]
+    ...         r, w, x = select.select (p.listeners, w, [], 1)
+    ...         for l in set (r + w) :
+    ...             l.handle ()
+    >>> Probe (p, 'up', 'tcp', ('127.0.0.1', port), 1).start ()
+    >>> serve ()
+    up True
+    >>> srv.close ()
+    >>> Probe (p, 'refused', 'tcp', ('127.0.0.1', port), 1).start ()
+    >>> serve ()
+    refused True
+    """
+
+    def __init__ (self, prober, target, proto, address, timeout) :
+        self.prober  = prober
+        self.target  = target
+        self.proto   = proto
+        self.address = address
+        self.timeout = timeout
+        self.sock    = None
+        self.done    = False
+        self.writing = False
+        self.payload = os.urandom (16)
+    # end def __init__
+
+    def close (self) :
+        """ Abort the probe without calling back """
+        self.done = True
+        if self in self.prober.listeners :
+            self.prober.listeners.remove (self)
+        if self.sock :
+            self.sock.close ()
+            self.sock = None
+    # end def close
+
+    def expire (self) :
+        if not self.done :
+            self.finish (None)
+    # end def expire
+
+    def fileno (self) :
+        return self.sock.fileno ()
+    # end def fileno
+
+    def finish (self, rtt) :
+        if self.done :
+            return
+        self.close ()
+        self.prober.done (self, rtt)
+    # end def finish
+
+    def handle (self) :
+        if self.proto == 'tcp' :
+            err = self.sock.getsockopt (socket.SOL_SOCKET, socket.SO_ERROR)
+            return self.result (err)
+        try :
+            data = self.sock.recv (4096)
+        except socket.error as err :
+            return self.result (err.errno)
+        if data == self.payload :
+            self.result (0)
+    # end def handle
+
+    def result (self, err) :
+        """ A refused connection (or port unreachable for UDP) comes
+            from the target, so the tunnel works.
+        """
+        if err in (0, errno.ECONNREFUSED) :
+            self.finish (time.time () - self.start_time)
+        else :
+            self.finish (None)
+    # end def result
+
+    def start (self) :
+        tp = socket.SOCK_STREAM if self.proto == 'tcp' else socket.SOCK_DGRAM
+        self.start_time = time.time ()
+        try :
+            self.sock = socket.socket (socket.AF_INET, tp)
+            self.sock.setblocking (False)
+            if self.proto == 'tcp' :
+                err = self.sock.connect_ex (self.address)
+                if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK) :
+                    return self.result (err)
+                self.writing = True
+            else :
+                self.sock.connect (self.address)
+                self.sock.send (self.payload)
+        except socket.error as err :
+            return self.result (err.errno)
+        self.prober.listeners.append (self)
+        self.prober.add_timer (self.timeout, self.expire)
+    # end def start
+
+# end class Probe
+
+class Prober (object) :
+    """ Probe all targets in rounds while snx is connected, the
+        requester calls start when snx is connected and stop when it
+        terminates. Timers of an earlier start are ignored.
+    """
+
+    def __init__ (self, rq) :
+        args           = rq.args
+        self.rq        = rq
+        self.listeners = rq.listeners
+        self.add_timer = rq.add_timer
+        self.interval  = args.probe_interval
+        self.timeout   = args.probe_timeout
+        self.window    = args.probe_window
+        self.limits    = dict \
+            ( max_loss   = args.probe_max_loss
+            , max_rtt    = args.probe_max_rtt
+            , max_jitter = args.probe_max_jitter
+            )
+        self.targets   = []
+        for spec in args.probe.split (',') :
+            if spec.strip () :
+                self.targets.append ((spec.strip (), parse_target (spec)))
+        self.stats     = {}
+        self.probes    = []
+        self.active    = False
+        self.round     = 0
+        self.lost      = False
+    # end def __init__
+
+    def done (self, probe, rtt) :
+        rq = self.rq
+        self.probes.remove (probe)
+        self.stats [probe.target].add (rtt)
+        self.lost = self.lost or rtt is None
+        if rq.metrics :
+            result = 'lost' if rtt is None else 'ok'
+            rq.metrics.inc \
+                ( 'snxconnect_probes_total'
+                , target = probe.target
+                , result = result
+                )
+            s = self.stats [probe.target]
+            for name, v in \
+                ( ('snxconnect_probe_loss_ratio',     s.loss)
+                , ('snxconnect_probe_rtt_seconds',    s.rtt)
+                , ('snxconnect_probe_jitter_seconds', s.jitter)
+                ) :
+                if v is not None :
+                    rq.metrics.set (name, v, target = probe.target)
+        if rtt is None :
+            rq.debug \
+                ("probe %s lost" % probe.target, 'probe', target = probe.target)
+        else :
+            rq.debug \
+                ( "probe %s: %.1f ms" % (probe.target, rtt * 1e3), 'probe'
+                , target = probe.target, rtt_ms = round (rtt * 1e3, 1)
+                )
+        if self.probes :
+            return
+        reasons = \
+            [self.stats [t].degraded (**self.limits) for t, a in self.targets]
+        if all (reasons) :
+            self.stop ()
+            specs = [t for t, a in self.targets]
+            rq.tunnel_degraded \
+                (', '.join ('%s %s' % x for x in zip (specs, reasons)))
+            return
+        delay = self.interval
+        if self.lost or any (reasons) :
+            delay = max (1, self.interval / 5.0)
+        self.schedule (delay)
+    # end def done
+
+    def run (self, round) :
+        """ Start a round of probes, one per target """
+        if not self.active or round != self.round :
+            return
+        self.lost = False
+        # All probes of the round must be known before the first one
+        # finishes, the round ends when the last one is done
+        for spec, (proto, host, port) in self.targets :
+            try :
+                ip = self.rq.resolver.resolve (host, socket.AF_INET)
+            except socket.error :
+                ip = None
+            self.probes.append \
+                (Probe (self, spec, proto, (ip, port), self.timeout))
+        for probe in list (self.probes) :
+            if probe.address [0] is None :
+                probe.finish (None)
+            else :
+                probe.start ()
+    # end def run
+
+    def schedule (self, delay) :
+        round = self.round
+        self.add_timer (delay, lambda : self.run (round))
+    # end def schedule
+
+    def start (self) :
+        """ Start probing with fresh statistics, the first round starts
+            after a short delay so the routes of the tunnel are set up.
+        """
+        self.stats  = dict \
+            ((t, Probe_Stats (self.window)) for t, a in self.targets)
+        self.active = True
+        self.round += 1
+        self.schedule (min (5, self.interval))
+    # end def start
+
+    def stop (self) :
+        self.active = False
+        self.round += 1
+        for p in self.probes :
+            p.close ()
+        self.probes = []
+    # end def stop
+
+    def summary (self) :
+        return dict ((t, s.summary ()) for t, s in self.stats.items ())
+    # end def summary
+
+# end class Prober
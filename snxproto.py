@@ -0,0 +1,319 @@
+#!/usr/bin/python
+
+""" Codec for the (undocumented) protocol of the snx control socket on
+    localhost:7776. We send the connection info, a fixed size record
+    with a header of a magic number and the length of the rest. The
+    answer of snx seems to use the same header, the layout of its
+    payload is not known: we only frame it and keep the payload for
+    inspection, its first 32-bit word is traced as status but not
+    interpreted. An answer that cannot be
+    framed (different magic or an implausible length) is kept as an
+    unframed Answer so that we do not reject snx versions that answer
+    differently. We assume native byte-order like the java framework.
+"""
+
+from __future__        import print_function, unicode_literals
+import os
+import socket
+from struct            import Struct
+
+port   = 7776
+magic  = b'\x13\x11\x00\x00'
+header = Struct (b'=4sL')
+info   = Struct (b'=4sLL64sL6s256s256s128s256sH')
+word   = Struct (b'=L')
+
+info_fields = \
+    ( 'magic', 'length', 'gateway_ip', 'gateway_host', 'port', 'reserved'
+    , 'server_cn', 'user_name', 'password', 'fingerprint', 'flags'
+    )
+
+class Protocol_Error (ValueError) :
+    pass
+# end class Protocol_Error
+
+class Connection_Info (object) :
+    """ The connection info sent to snx, string fields are bytes
+    >>> ci = Connection_Info \\
+    ...     ( gateway_ip = 0x7f000001, gateway_host = b'vpn', port = 443
+    ...     , server_cn = b'cn', user_name = b'user', password = b'pw'
+    ...     , fingerprint = b'FP'
+    ...     )
+    >>> data = ci.encode ()
+    >>> len (data) == info.size == 0x3d0 + header.size
+    True
+    >>> Connection_Info.decode (data) == ci
+    True
+    >>> for d in (data [:-1], b'x' + data [1:]) :
+    ...     try :
+    ...         Connection_Info.decode (d)
+    ...     except Protocol_Error as err :
+    ...         print (err)
+    connection info has 983 bytes, expected 984
+    bad magic 7811
+    """
+
+    def __init__ \
+        ( self
+        , gateway_ip   = 0
+        , gateway_host = b''
+        , port         = 443
+        , server_cn    = b''
+        , user_name    = b''
+        , password     = b''
+        , fingerprint  = b''
+        , flags        = 1 # ???
+        ) :
+        self.gateway_ip   = gateway_ip
+        self.gateway_host = gateway_host
+        self.port         = port
+        self.server_cn    = server_cn
+        self.user_name    = user_name
+        self.password     = password
+        self.fingerprint  = fingerprint
+        self.flags        = flags
+    # end def __init__
+
+    @classmethod
+    def decode (cls, data) :
+        if len (data) != info.size :
+            raise Protocol_Error \
+                ( "connection info has %d bytes, expected %d"
+                % (len (data), info.size)
+                )
+        values = dict (zip (info_fields, info.unpack (data)))
+        if values ['magic'] != magic :
+            raise Protocol_Error \
+                ("bad magic %s" % hexdump (values ['magic'] [:2]))
+        if values ['length'] != info.size - header.size :
+            raise Protocol_Error ("bad length %d" % values ['length'])
+        for k in info_fields :
+            if isinstance (values [k], bytes) :
+                values [k] = values [k].rstrip (b'\0')
+        del values ['magic'], values ['length'], values ['reserved']
+        return cls (**values)
+    # end def decode
+
+    def encode (self) :
+        return info.pack \
+            ( magic
+            , info.size - header.size
+            , self.gateway_ip
+            , self.gateway_host
+            , self.port
+            , b''
+            , self.server_cn
+            , self.user_name
+            , self.password
+            , self.fingerprint
+            , self.flags
+            )
+    # end def encode
+
+    def __eq__ (self, other) :
+        return self.__dict__ == other.__dict__
+    # end def __eq__
+
+    def __ne__ (self, other) :
+        return not self == other
+    # end def __ne__
+
+# end class Connection_Info
+
+class Answer (object) :
+    """ Answer of snx, framed answers have a magic and the payload
+    >>> a = Answer (magic, word.pack (0) + b'\\x01\\x02')
+    >>> a.status, a.words, a
+    (0, (0,), Answer (status=0, payload=000000000102))
+    >>> b = Answer (None, b'\\x07')
+    >>> b.status, b.words, b
+    (None, (), Answer (unframed, payload=07))
+    """
+
+    def __init__ (self, magic, payload) :
+        self.magic   = magic
+        self.payload = payload
+        self.framed  = magic is not None
+    # end def __init__
+
+    @property
+    def status (self) :
+        """ First word of a framed answer, only recorded for analysis:
+            its meaning is unknown, so it is not checked.
+        """
+        if self.framed and len (self.payload) >= word.size :
+            return word.unpack_from (self.payload) [0]
+    # end def status
+
+    @property
+    def words (self) :
+        """ Payload as 32-bit words, for the analysis of answers """
+        n = len (self.payload) // word.size
+        return tuple \
+            ( word.unpack_from (self.payload, i * word.size) [0]
+              for i in range (n)
+            )
+    # end def words
+
+    def encode (self) :
+        return header.pack (self.magic, len (self.payload)) + self.payload
+    # end def encode
+
+    def __repr__ (self) :
+        if not self.framed :
+            return "Answer (unframed, payload=%s)" % hexdump (self.payload)
+        return "Answer (status=%s, payload=%s)" \
+            % (self.status, hexdump (self.payload))
+    # end def __repr__
+
+# end class Answer
+
+class Decoder (object) :
+    """ Incremental framing of messages (header and payload), data may
+        arrive in arbitrary pieces.
+    >>> a = Answer (magic, word.pack (5) + b'abc').encode ()
+    >>> d = Decoder ()
+    >>> [d.feed (a [i:i+1]) for i in range (len (a))] [-2:]
+    [[], [Answer (status=5, payload=05000000616263)]]
+    >>> d.feed (a + a [:3]), d.buffer
+    ([Answer (status=5, payload=05000000616263)], b'\\x13\\x11\\x00')
+    >>> try :
+    ...     d.feed (b'\\x00' + header.pack (magic, 1 << 30) [4:])
+    ... except Protocol_Error as err :
+    ...     print (err)
+    implausible length 1073741824
+
+    Random data either gives messages or a Protocol_Error, it never
+    fails otherwise, whatever the pieces are:
+    >>> import random
+    >>> rnd = random.Random (42)
+    >>> for n in range (2000) :
+    ...     data = bytes (bytearray (rnd.randrange (256) for i in range (40)))
+    ...     if rnd.random () < 0.5 :
+    ...         data = header.pack (magic, rnd.randrange (32)) + data
+    ...     d = Decoder ()
+    ...     i = 0
+    ...     try :
+    ...         while i < len (data) :
+    ...             j = i + rnd.randrange (1, 9)
+    ...             for m in d.feed (data [i:j]) :
+    ...                 assert m.encode () in data
+    ...             i = j
+    ...     except Protocol_Error :
+    ...         pass
+    """
+
+    max_length = 65536
+
+    def __init__ (self) :
+        self.buffer = b''
+    # end def __init__
+
+    def feed (self, data) :
+        """ Add data, return list of complete messages """
+        self.buffer += data
+        messages = []
+        while len (self.buffer) >= header.size :
+            m, length = header.unpack_from (self.buffer)
+            if m != magic :
+                raise Protocol_Error ("bad magic %s" % hexdump (m [:2]))
+            if length > self.max_length :
+                raise Protocol_Error ("implausible length %d" % length)
+            end = header.size + length
+            if len (self.buffer) < end :
+                break
+            messages.append (Answer (m, self.buffer [header.size:end]))
+            self.buffer = self.buffer [end:]
+        return messages
+    # end def feed
+
+# end class Decoder
+
+def hexdump (data) :
+    return ''.join ('%02x' % b for b in bytearray (data))
+# end def hexdump
+
+def listening_inodes (port = port, proc = '/proc/net') :
+    """ Return the set of inodes of sockets listening on port (on any
+        address) from /proc/net/tcp and tcp6, this tells us if snx
+        listens and if it is a new snx. Returns None if the information
+        is not available (not on Linux).
+    >>> s = socket.socket ()
+    >>> s.bind (('127.0.0.1', 0))
+    >>> p = s.getsockname () [1]
+    >>> listening_inodes (p)
+    set()
+    >>> s.listen (1)
+    >>> listening_inodes (p) == set ((os.fstat (s.fileno ()).st_ino,))
+    True
+    >>> s.close ()
+    >>> print (listening_inodes (p, proc = '/nonexisting'))
+    None
+    """
+    inodes = set ()
+    found  = False
+    for name in ('tcp', 'tcp6') :
+        try :
+            f = open (os.path.join (proc, name))
+        except (IOError, OSError) :
+            continue
+        found = True
+        with f :
+            next (f)
+            for line in f :
+                fields = line.split ()
+                # local address is hex ip:port, state 0A is LISTEN
+                if fields [3] != '0A' :
+                    continue
+                if int (fields [1].rsplit (':', 1) [1], 16) == port :
+                    inodes.add (int (fields [9]))
+    if found :
+        return inodes
+# end def listening_inodes
+
+def read_answer (sock, timeout = None) :
+    """ Read one answer from sock, partial reads are handled by the
+        Decoder. Returns None if snx closes the socket or does not
+        answer within timeout seconds. If the data cannot be framed or
+        the rest of a message does not arrive in time, what we got is
+        returned as unframed Answer.
+    >>> a, b = socket.socketpair ()
+    >>> msg = Answer (magic, word.pack (0)).encode ()
+    >>> a.sendall (msg [:5])
+    >>> a.sendall (msg [5:])
+    >>> read_answer (b, 1)
+    Answer (status=0, payload=00000000)
+    >>> a.sendall (b'garbage')
+    >>> read_answer (b, 1)
+    Answer (unframed, payload=67617262616765)
+    >>> print (read_answer (b, 0.01))
+    None
+    >>> a.close ()
+    >>> print (read_answer (b, 1))
+    None
+    >>> b.close ()
+    """
+    dec  = Decoder ()
+    data = b''
+    sock.settimeout (timeout)
+    try :
+        while True :
+            try :
+                chunk = sock.recv (4096)
+            except socket.timeout :
+                chunk = b''
+            if not chunk :
+                break
+            data += chunk
+            try :
+                messages = dec.feed (chunk)
+            except Protocol_Error :
+                return Answer (None, data)
+            if messages :
+                return messages [0]
+    finally :
+        sock.settimeout (None)
+    if data :
+        return Answer (None, data)
+    return None
+# end def read_answer
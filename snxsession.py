@@ -0,0 +1,189 @@
+#!/usr/bin/python
+
+""" Session store: The cookies and the snx connection info (for warm
+    reconnect) of many profiles (host, realm, user) are kept in one
+    SQLite database. Each write is a transaction, so concurrent
+    snxconnect processes do not clobber each other's profiles, expired
+    entries are deleted when the store is opened. The database is only
+    readable by the owner.
+"""
+
+from __future__        import print_function, unicode_literals
+import os
+import json
+import time
+import sqlite3
+
+cookie_attrs = \
+    ( 'version', 'name', 'value', 'port', 'port_specified', 'domain'
+    , 'domain_specified', 'domain_initial_dot', 'path', 'path_specified'
+    , 'secure', 'expires', 'discard', 'comment', 'comment_url'
+    )
+
+schema = '''
+    create table if not exists session
+        ( host    text not null
+        , realm   text not null
+        , user    text not null
+        , kind    text not null
+        , data    blob not null
+        , expires real not null
+        , updated real not null
+        , primary key (host, realm, user, kind)
+        )
+'''
+
+def cookie_to_dict (cookie) :
+    d = dict ((k, getattr (cookie, k)) for k in cookie_attrs)
+    d ['rest'] = cookie._rest
+    d ['rfc2109'] = cookie.rfc2109
+    return d
+# end def cookie_to_dict
+
+class Session_Store (object) :
+    """ Cookies and snx info per profile in an SQLite database
+    >>> import tempfile, shutil
+    >>> from snxhttp import LWPCookieJar
+    >>> try :
+    ...     from http.cookiejar import Cookie
+    ... except ImportError :
+    ...     from cookielib import Cookie
+    >>> d = tempfile.mkdtemp ()
+    >>> fn = os.path.join (d, 'sessions')
+    >>> store = Session_Store (fn, session_ttl = 60)
+    >>> oct (os.stat (fn).st_mode & 0o777)
+    '0o600'
+    >>> jar = LWPCookieJar ()
+    >>> jar.set_cookie (Cookie \\
+    ...     ( 0, 'sid', 'abc', None, False, 'vpn', False, False, '/', True
+    ...     , True, None, True, None, None, {'HttpOnly': None}
+    ...     ))
+    >>> p1, p2 = ('vpn', 'ssl_vpn', 'alice'), ('vpn', 'ssl_vpn', 'bob')
+    >>> store.save_cookies (p1, jar)
+    >>> store.save_snx_info (p1, 'vpn', b'\\x13\\x11', 60)
+    >>> j2 = LWPCookieJar ()
+    >>> store.load_cookies (p2, j2), store.load_cookies (p1, j2)
+    (False, True)
+    >>> [(c.name, c.value, c.discard, c.has_nonstandard_attr ('HttpOnly'))
+    ...  for c in j2]
+    [('sid', 'abc', True, True)]
+    >>> Session_Store (fn).load_snx_info (p1)
+    ('vpn', b'\\x13\\x11')
+    >>> store.forget (p1, 'snx_info')
+    >>> print (store.load_snx_info (p1))
+    None
+
+    Expired entries are evicted:
+    >>> store.save_snx_info (p2, 'vpn', b'x', -1)
+    >>> store.evict ()
+    >>> store.profiles ()
+    [('vpn', 'ssl_vpn', 'alice')]
+    >>> store.close ()
+    >>> shutil.rmtree (d)
+    """
+
+    def __init__ (self, filename, session_ttl = 86400) :
+        self.filename    = filename
+        self.session_ttl = session_ttl
+        # Create the file only readable by us before sqlite opens it,
+        # journal files get the same permissions from sqlite
+        fd = os.open (filename, os.O_RDWR | os.O_CREAT, 0o600)
+        os.close (fd)
+        os.chmod (filename, 0o600)
+        self.db = sqlite3.connect (filename, timeout = 10)
+        with self.db :
+            self.db.execute (schema)
+        self.evict ()
+    # end def __init__
+
+    def close (self) :
+        self.db.close ()
+    # end def close
+
+    def evict (self) :
+        with self.db :
+            self.db.execute \
+                ('delete from session where expires < ?', (time.time (),))
+    # end def evict
+
+    def forget (self, profile, kind) :
+        with self.db :
+            self.db.execute \
+                ( 'delete from session'
+                  ' where host = ? and realm = ? and user = ? and kind = ?'
+                , tuple (profile) + (kind,)
+                )
+    # end def forget
+
+    def get (self, profile, kind) :
+        """ Return data of a not expired entry or None """
+        row = self.db.execute \
+            ( 'select data from session where host = ? and realm = ?'
+              ' and user = ? and kind = ? and expires >= ?'
+            , tuple (profile) + (kind, time.time ())
+            ).fetchone ()
+        if row :
+            return bytes (row [0])
+    # end def get
+
+    def load_cookies (self, profile, jar) :
+        """ Add the saved cookies of profile to jar, return True if
+            there were any.
+        """
+        from snxhttp import Cookie
+        data = self.get (profile, 'cookies')
+        if not data :
+            return False
+        now = time.time ()
+        for d in json.loads (data.decode ('utf-8')) :
+            c = Cookie (**d)
+            if not c.is_expired (now) :
+                jar.set_cookie (c)
+        return bool (len (jar))
+    # end def load_cookies
+
+    def profiles (self) :
+        rows = self.db.execute \
+            ('select distinct host, realm, user from session order by 1, 2, 3')
+        return [tuple (r) for r in rows]
+    # end def profiles
+
+    def put (self, profile, kind, data, expires) :
+        with self.db :
+            self.db.execute \
+                ( 'insert or replace into session'
+                  ' (host, realm, user, kind, data, expires, updated)'
+                  ' values (?, ?, ?, ?, ?, ?, ?)'
+                , tuple (profile)
+                + (kind, sqlite3.Binary (data), expires, time.time ())
+                )
+    # end def put
+
+    def save_cookies (self, profile, jar) :
+        """ Save all cookies of jar (including session cookies), the
+            entry expires with the last cookie, session cookies are
+            kept for session_ttl seconds.
+        """
+        now     = time.time ()
+        cookies = [cookie_to_dict (c) for c in jar]
+        expires = [c ['expires'] or now + self.session_ttl for c in cookies]
+        data    = json.dumps (cookies).encode ('utf-8')
+        self.put (profile, 'cookies', data, max (expires or [now]))
+    # end def save_cookies
+
+    def load_snx_info (self, profile) :
+        """ Return gateway host and snx info or None """
+        data = self.get (profile, 'snx_info')
+        if data :
+            d = json.loads (data.decode ('utf-8'))
+            return d ['host'], bytes (bytearray.fromhex (d ['snx_info']))
+    # end def load_snx_info
+
+    def save_snx_info (self, profile, host, info, ttl) :
+        from binascii import hexlify
+        d = dict (host = host, snx_info = hexlify (info).decode ('ascii'))
+        data = json.dumps (d).encode ('utf-8')
+        self.put (profile, 'snx_info', data, time.time () + ttl)
+    # end def save_snx_info
+
+# end class Session_Store
@@ -0,0 +1,271 @@
+#!/usr/bin/python
+
+""" Supervisor for snxconnect: Keep the VPN up, when snx terminates we
+    reconnect, first with the saved snx info (if warm reconnect is
+    enabled), then via the cookie path of the login and finally with a
+    full login. Failed attempts are retried with jittered exponential
+    backoff. The state can be queried via a unix socket, e.g.
+    socat - UNIX-CONNECT:/path/to/status-socket
+    When the probes (see snxprobe) find the tunnel degraded snx is
+    restarted, if this happens twice in a row the saved snx info is
+    not used for the next reconnect, we log in again.
+"""
+
+from __future__        import print_function, unicode_literals
+import os
+import json
+import time
+import random
+import socket
+try :
+    from httplib import HTTPException
+except ImportError :
+    from http.client import HTTPException
+from snxconnect        import ERROR
+
+class Status_Server (object) :
+    """ Listener for the requester: Every client connecting to the unix
+        socket gets the state of the supervisor as a JSON line.
+    """
+
+    def __init__ (self, path, supervisor) :
+        self.path       = path
+        self.supervisor = supervisor
+        try :
+            os.unlink (path)
+        except OSError :
+            pass
+        self.sock = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+        old = os.umask (0o077)
+        try :
+            self.sock.bind (path)
+        finally :
+            os.umask (old)
+        self.sock.listen (5)
+    # end def __init__
+
+    def close (self) :
+        self.sock.close ()
+        try :
+            os.unlink (self.path)
+        except OSError :
+            pass
+    # end def close
+
+    def fileno (self) :
+        return self.sock.fileno ()
+    # end def fileno
+
+    def handle (self) :
+        conn, addr = self.sock.accept ()
+        try :
+            status = json.dumps (self.supervisor.status (), sort_keys = True)
+            conn.sendall ((status + '\n').encode ('utf-8'))
+        except socket.error :
+            pass
+        conn.close ()
+    # end def handle
+
+# end class Status_Server
+
+class Supervisor (object) :
+    """ Reconnect loop of --supervise: run repeats attempt until we are
+        interrupted. With the mock portal and the fake snx of snxmock,
+        which terminates right after accepting the snx info, failed
+        logins back off exponentially, a connect resets the backoff:
+    >>> import shutil, sys, tempfile
+    >>> from snxconnect import option_parser, HTML_Requester
+    >>> from snxmock    import Mock_Portal
+    >>> portal = Mock_Portal ()
+    >>> portal.start ()
+    >>> here = os.path.dirname (os.path.abspath (__file__))
+    >>> d    = tempfile.mkdtemp ()
+    >>> snx  = os.path.join (d, 'snx')
+    >>> with open (snx, 'w') as f :
+    ...     n = f.write ('#!/bin/sh\\nexec "%s" "%s" "$@"\\n'
+    ...         % (sys.executable, os.path.join (here, 'snxmock.py')))
+    >>> os.chmod (snx, 0o755)
+    >>> args = option_parser ({}).parse_args \\
+    ...     ( [ '-H', '127.0.0.1:%d' % portal.port, '-p', 'http'
+    ...       , '-U', 'user', '-P', 'wrong', '-S', snx, '--snx-reap'
+    ...       , '-c', os.path.join (d, 'cookies')
+    ...       , '--backoff-min', '1', '--backoff-max', '8'
+    ...       ]
+    ...     )
+    >>> rq = HTML_Requester (args)
+    >>> rq.quiet = True
+    >>> sv = Supervisor (rq)
+    >>> delays = [sv.attempt () for i in range (3)]
+    >>> sv.state, sv.failures, sv.last_error
+    ('backoff', 3, 'login failed')
+    >>> [1 <= delay / 2 ** i <= 2 for i, delay in enumerate (delays)]
+    [True, True, True]
+    >>> 4 <= sv.attempt () <= 8
+    True
+    >>> args.password = 'secret'
+    >>> 0.5 <= sv.attempt () <= 1
+    True
+    >>> sv.failures, sv.connects, sv.drops, sv.last_error
+    (0, 1, 1, 'snx terminated')
+
+    The status socket reports the state as a JSON line:
+    >>> path   = os.path.join (d, 'status')
+    >>> server = Status_Server (path, sv)
+    >>> client = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+    >>> client.connect (path)
+    >>> server.handle ()
+    >>> with client.makefile ('rb') as f :
+    ...     status = json.loads (f.readline ().decode ('utf-8'))
+    >>> client.close ()
+    >>> sorted (status)  # doctest: +NORMALIZE_WHITESPACE
+    ['connects', 'drops', 'failures', 'last_drop', 'last_error',
+     'last_recovery', 'since', 'state']
+    >>> status ['state'], status ['connects'], status ['last_error']
+    ('backoff', 1, 'snx terminated')
+    >>> server.close ()
+    >>> os.path.exists (path)
+    False
+    >>> rq.close ()
+    >>> portal.shutdown ()
+    >>> portal.server_close ()
+    >>> shutil.rmtree (d)
+    """
+
+    def __init__ (self, rq) :
+        self.rq           = rq
+        self.args         = rq.args
+        self.state        = None
+        self.since        = None
+        self.connects     = 0
+        self.drops        = 0
+        self.failures     = 0
+        self.last_error   = None
+        self.last_drop    = None
+        self.recovery     = None
+        self.degraded     = 0
+        self.server       = None
+        self.set_state ('starting')
+    # end def __init__
+
+    def backoff (self) :
+        """ Exponential backoff with jitter, the delay is between half
+            and the full exponential value.
+        """
+        d = self.args.backoff_min * 2 ** min (self.failures, 32)
+        d = min (self.args.backoff_max, d)
+        return random.uniform (d / 2.0, d)
+    # end def backoff
+
+    def connect (self) :
+        """ Try to get snx connected, return the control socket or None
+        """
+        rq = self.rq
+        rq.nextfile = self.args.file
+        sock = rq.connect_snx ()
+        if rq.connect_error != 'login failed' and len (rq.jar) :
+            # The session cookies are in our jar now
+            rq.has_cookies = True
+        if not sock :
+            self.last_error = rq.connect_error
+        return sock
+    # end def connect
+
+    def attempt (self) :
+        """ Connect and supervise snx until it terminates, returns the
+            delay before the next attempt. The failures counting for
+            the backoff are reset when snx was connected.
+        """
+        self.set_state ('connecting')
+        cause = None
+        try :
+            sock = self.connect ()
+        except (EnvironmentError, HTTPException) as err :
+            self.last_error = str (err)
+            cause = err.__class__.__name__
+            sock = None
+        if sock :
+            self.connected (sock)
+            # Back off if restarts do not fix a degraded tunnel
+            self.failures = self.degraded
+        else :
+            self.failures += 1
+            self.rq.log \
+                ( ERROR
+                , "Connect failed: %s" % self.last_error
+                , 'supervise', {}
+                )
+        if self.rq.metrics :
+            # Exception messages would give too many label values
+            self.rq.metrics.inc \
+                ( 'snxconnect_reconnects_total'
+                , cause = cause or self.last_error
+                )
+        self.set_state ('backoff')
+        return self.backoff ()
+    # end def attempt
+
+    def run (self) :
+        if self.args.status_socket :
+            self.server = Status_Server (self.args.status_socket, self)
+            self.rq.listeners.append (self.server)
+        try :
+            while True :
+                delay = self.attempt ()
+                self.rq.debug \
+                    ( "reconnect in %.1f seconds" % delay, 'supervise'
+                    , delay = round (delay, 1)
+                    )
+                self.rq.serve (duration = delay)
+        finally :
+            if self.server :
+                self.server.close ()
+    # end def run
+
+    def connected (self, sock) :
+        now = time.time ()
+        self.connects += 1
+        if self.last_drop :
+            self.recovery = now - self.last_drop
+        self.set_state ('connected')
+        self.rq.notice ("SNX connected, supervising connection", 'supervise')
+        if self.rq.args.hold == 'lean' :
+            self.rq.release_login_state ()
+        self.rq.wait_snx (sock)
+        self.drops     += 1
+        self.last_drop  = time.time ()
+        self.last_error = self.rq.drop_cause or 'snx terminated'
+        if self.rq.drop_cause == 'tunnel degraded' :
+            self.degraded += 1
+            if self.degraded > 1 and self.args.warm_reconnect :
+                # Restarting with the same parameters did not help
+                self.rq.forget_snx_info ()
+        else :
+            self.degraded = 0
+        self.rq.notice \
+            ( "SNX terminated, reconnecting", 'supervise'
+            , cause = self.last_error
+            )
+    # end def connected
+
+    def set_state (self, state) :
+        self.state = state
+        self.since = time.time ()
+    # end def set_state
+
+    def status (self) :
+        status = dict \
+            ( state         = self.state
+            , since         = self.since
+            , connects      = self.connects
+            , drops         = self.drops
+            , failures      = self.failures
+            , last_error    = self.last_error
+            , last_drop     = self.last_drop
+            , last_recovery = self.recovery
+            )
+        if self.rq.prober :
+            status ['probes'] = self.rq.prober.summary ()
+        return status
+    # end def status
+
+# end class Supervisor
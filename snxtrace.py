@@ -0,0 +1,172 @@
+#!/usr/bin/python
+
+""" Tracing of the stages of a login: Each stage is a span with a name,
+    start time, duration and attributes, spans nest per thread. With
+    --trace the finished spans are written as JSON lines (one object
+    per span, similar to OpenTelemetry spans) to the given file, e.g.,
+    /dev/stderr or /dev/fd/3. Without --trace a Null_Tracer is used
+    which does nothing.
+"""
+
+from __future__        import print_function, unicode_literals
+import json
+import time
+import random
+import threading
+
+class Span (object) :
+    """ A running span, use via Tracer.span as a context manager """
+
+    def __init__ (self, tracer, name, attrs) :
+        self.tracer = tracer
+        self.name   = name
+        self.attrs  = attrs
+        self.id     = '%016x' % random.getrandbits (64)
+        self.parent = None
+    # end def __init__
+
+    def __enter__ (self) :
+        stack = self.tracer.stack ()
+        if stack :
+            self.parent = stack [-1].id
+        stack.append (self)
+        self.start = time.time ()
+        return self
+    # end def __enter__
+
+    def __exit__ (self, tp, value, tb) :
+        duration = time.time () - self.start
+        self.tracer.stack ().pop ()
+        if tp is not None :
+            self.attrs ['error'] = '%s: %s' % (tp.__name__, value)
+        self.tracer.emit \
+            (self.name, self.start, duration, self.id, self.parent, self.attrs)
+    # end def __exit__
+
+    def set (self, **attrs) :
+        self.attrs.update (attrs)
+    # end def set
+
+# end class Span
+
+class Null_Span (object) :
+
+    def __enter__ (self) :
+        return self
+    # end def __enter__
+
+    def __exit__ (self, tp, value, tb) :
+        pass
+    # end def __exit__
+
+    def set (self, **attrs) :
+        pass
+    # end def set
+
+# end class Null_Span
+
+class Null_Tracer (object) :
+    """ Used when tracing is off, the same span is returned every time
+    >>> t = Null_Tracer ()
+    >>> with t.span ('x', a = 1) as s :
+    ...     s.set (b = 2)
+    >>> t.record ('y', 0, 1)
+    """
+
+    enabled = False
+    null    = Null_Span ()
+
+    def close (self) :
+        pass
+    # end def close
+
+    def record (self, name, start, duration, **attrs) :
+        pass
+    # end def record
+
+    def span (self, name, **attrs) :
+        return self.null
+    # end def span
+
+# end class Null_Tracer
+
+class Tracer (Null_Tracer) :
+    """ Write finished spans as JSON lines to a file object
+    >>> import io
+    >>> f = io.StringIO ()
+    >>> t = Tracer (f)
+    >>> with t.span ('login', host = 'vpn') :
+    ...     with t.span ('request') as s :
+    ...         s.set (status = 200)
+    >>> t.record ('parse', time.time (), 0.5)
+    >>> spans = [json.loads (l) for l in f.getvalue ().splitlines ()]
+    >>> [(s ['name'], s ['attrs']) for s in spans]
+    [('request', {'status': 200}), ('login', {'host': 'vpn'}), ('parse', {})]
+    >>> spans [0]['parent'] == spans [1]['id'], spans [1]['parent']
+    (True, None)
+    >>> len (set (s ['trace'] for s in spans))
+    1
+    """
+
+    enabled = True
+
+    def __init__ (self, f) :
+        self.f     = f
+        self.trace = '%032x' % random.getrandbits (128)
+        self.lock  = threading.Lock ()
+        self.local = threading.local ()
+    # end def __init__
+
+    def close (self) :
+        with self.lock :
+            if self.f :
+                self.f.close ()
+    # end def close
+
+    def emit (self, name, start, duration, id, parent, attrs) :
+        span = dict \
+            ( name     = name
+            , trace    = self.trace
+            , id       = id
+            , parent   = parent
+            , start    = round (start, 6)
+            , duration = round (duration, 6)
+            , thread   = threading.current_thread ().name
+            , attrs    = attrs
+            )
+        line = json.dumps (span, sort_keys = True) + '\n'
+        with self.lock :
+            self.f.write (line)
+            self.f.flush ()
+    # end def emit
+
+    def record (self, name, start, duration, **attrs) :
+        """ Emit a span measured by the caller, e.g. for work that is
+            interleaved with other work.
+        """
+        stack  = self.stack ()
+        parent = stack [-1].id if stack else None
+        id     = '%016x' % random.getrandbits (64)
+        self.emit (name, start, duration, id, parent, attrs)
+    # end def record
+
+    def span (self, name, **attrs) :
+        return Span (self, name, attrs)
+    # end def span
+
+    def stack (self) :
+        try :
+            return self.local.stack
+        except AttributeError :
+            self.local.stack = []
+            return self.local.stack
+    # end def stack
+
+# end class Tracer
+
+def open_tracer (filename) :
+    """ Return a Tracer appending to filename or a Null_Tracer """
+    if not filename :
+        return Null_Tracer ()
+    return Tracer (open (filename, 'a'))
+# end def open_tracer